@@ -0,0 +1,333 @@
+"""
+Render a schedule as an animation of the ions moving through the trap.
+
+    python -m animation SCHEDULE OUTPUT [--index K] [--fps 20] [--substeps 4] [--stride 1]
+
+``SCHEDULE`` is a pickle of one ``(positions_history, gates_schedule)`` pair or
+a schedule file from ``schedule_io.write_schedules``; ``OUTPUT`` ends in
+``.gif`` or ``.mp4`` (which needs ``ffmpeg`` on the path).
+
+The trap is drawn once; every frame only redraws the ions, their labels, the
+gate highlights and the step counter on top of the saved background (blitting),
+and is handed to the writer as soon as it is drawn, so the memory does not
+grow with the length of the schedule. Moves are interpolated over
+``substeps`` frames per step, and ``stride`` keeps every ``stride``-th step
+for quick previews of long schedules.
+"""
+
+import argparse
+import os
+import pickle
+import shutil
+import subprocess
+import time
+
+import numpy as np
+
+from structural import graph_tables
+from trap import IDLE, INTERACTION, STANDARD
+
+NODE_COLORS = {INTERACTION: "#f4a261", STANDARD: "#8fa3b8", IDLE: "#d9e2ec"}
+GATE_COLORS = {"RX": "#2a9d8f", "RY": "#457b9d", "MS": "#e63946"}
+ION_COLOR = "#264653"
+IDLE_OFFSET = 0.35  # an idle node is drawn up and to the right of its standard node
+SHARED_OFFSET = 0.14  # ions sharing an interaction node are drawn side by side
+
+
+def node_coordinates(nodes) -> np.ndarray:
+    """Return the ``(x, y)`` drawing position of every node, column right and row down."""
+    xy = np.array([[node[1], -node[0]] for node in nodes], dtype=float)
+    idle = np.array([len(node) == 3 for node in nodes])
+    xy[idle] += IDLE_OFFSET
+    return xy
+
+
+class TrapAnimation:
+    """
+    Frames of a schedule drawn on its trap.
+
+    Args:
+        positions_history (list): A list of positions for each step in the circuit.
+        gates_schedule (list): A list of gates where each gate is represented as a tuple.
+        graph (networkx.Graph): The graph representing the Penning trap.
+        substeps (int): The frames per step; moves are interpolated between them.
+        stride (int): Draw every ``stride``-th step only.
+        figsize (tuple): The figure size in inches.
+        dpi (int): The resolution.
+    """
+
+    def __init__(self, positions_history, gates_schedule, graph, substeps=4, stride=1, figsize=(7, 5), dpi=100):
+        if len(positions_history) != len(gates_schedule):
+            raise ValueError(
+                f"Length of positions history ({len(positions_history)}) does not match length of gates schedule ({len(gates_schedule)})."
+            )
+        if len(positions_history) == 0:
+            raise ValueError("Nothing to render: the positions history is empty.")
+        if substeps < 1 or stride < 1:
+            raise ValueError(f"substeps and stride must be at least 1. Found: {substeps}, {stride}")
+        self.graph = graph
+        self.gates_schedule = gates_schedule
+        self.substeps = substeps
+        self.stride = stride
+        nodes, index, self.node_type, _, _ = graph_tables(graph)
+        self.xy = node_coordinates(nodes)
+        self.ids = np.array([[index[p] for p in positions] for positions in positions_history], dtype=np.int64)
+        self.steps = list(range(0, len(positions_history), stride))
+        self._build_figure(figsize, dpi)
+
+    def __len__(self) -> int:
+        return len(self.steps) * self.substeps
+
+    def _build_figure(self, figsize, dpi):
+        # matplotlib is only needed for rendering; the Agg canvas needs no display.
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.collections import LineCollection, PathCollection
+        from matplotlib.figure import Figure
+        from matplotlib.textpath import TextPath
+        from matplotlib.transforms import Affine2D, IdentityTransform
+
+        self.figure = Figure(figsize=figsize, dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.figure)
+        ax = self.axes = self.figure.add_axes([0.02, 0.02, 0.96, 0.9])
+        ax.set_axis_off()
+        ax.set_aspect("equal")
+
+        nodes, index, _, _, _ = graph_tables(self.graph)
+        segments = [(self.xy[index[u]], self.xy[index[v]]) for u, v in self.graph.edges()]
+        ax.add_collection(LineCollection(segments, colors="#c5ced8", linewidths=1.5, zorder=1))
+        colors = [NODE_COLORS[code] for code in self.node_type]
+        sizes = np.where(self.node_type == IDLE, 60, 160)
+        ax.scatter(*self.xy.T, s=sizes, c=colors, edgecolors="white", linewidths=1, zorder=2)
+        margin = 0.6
+        ax.set_xlim(self.xy[:, 0].min() - margin, self.xy[:, 0].max() + margin)
+        ax.set_ylim(self.xy[:, 1].min() - margin, self.xy[:, 1].max() + margin)
+
+        # The dynamic artists are drawn by hand on top of the saved background.
+        n_ions = self.ids.shape[1]
+        self.couplings = LineCollection([], colors=GATE_COLORS["MS"], linewidths=3, zorder=3, animated=True)
+        ax.add_collection(self.couplings)
+        self.highlights = ax.scatter([], [], s=420, facecolors="none", linewidths=2.5, zorder=4, animated=True)
+        self.ions = ax.scatter(np.zeros(n_ions), np.zeros(n_ions), s=200, c=ION_COLOR, zorder=5, animated=True)
+        # The ion numbers are glyph paths laid out once; text artists would be
+        # laid out again on every frame.
+        glyphs = []
+        for j in range(n_ions):
+            path = TextPath((0, 0), str(j), size=8)
+            box = path.get_extents()
+            center = Affine2D().translate(-box.x0 - box.width / 2, -box.y0 - box.height / 2)
+            glyphs.append(path.transformed(center.scale(dpi / 72)))
+        self.labels = PathCollection(
+            glyphs,
+            offsets=np.zeros((n_ions, 2)),
+            offset_transform=ax.transData,
+            transform=IdentityTransform(),
+            facecolors="white",
+            edgecolors="none",
+            zorder=6,
+            animated=True,
+        )
+        ax.add_collection(self.labels, autolim=False)
+        self.title = self.figure.text(0.02, 0.95, "", fontsize=11, animated=True)
+        for k, (name, color) in enumerate(GATE_COLORS.items()):
+            self.figure.text(0.75 + 0.08 * k, 0.95, name, color=color, fontsize=11, fontweight="bold")
+
+        self.canvas.draw()
+        self.background = self.canvas.copy_from_bbox(self.figure.bbox)
+
+    def _ion_xy(self, t):
+        # Ions sharing a node are spread out so that both stay visible.
+        ids = self.ids[t]
+        xy = self.xy[ids].copy()
+        order = np.argsort(ids, kind="stable")
+        second = np.zeros(len(ids), dtype=bool)
+        second[order[1:]] = ids[order[1:]] == ids[order[:-1]]
+        first = np.isin(ids, ids[second]) & ~second
+        xy[second, 0] += SHARED_OFFSET
+        xy[first, 0] -= SHARED_OFFSET
+        return xy
+
+    def _draw(self, k):
+        step_index, sub = divmod(k, self.substeps)
+        t = self.steps[step_index]
+        after = self.steps[step_index + 1] if step_index + 1 < len(self.steps) else t
+        fraction = sub / self.substeps
+        xy = (1 - fraction) * self._ion_xy(t) + fraction * self._ion_xy(after)
+
+        # An MS gate lasts two steps and stays highlighted in the second one.
+        held = [gate for gate in self.gates_schedule[t - 1] if gate[0] == "MS"] if t > 0 else []
+        rings, ring_colors, couplings = [], [], []
+        for name, _, wires in held + list(self.gates_schedule[t]):
+            wires = (wires,) if isinstance(wires, (int, np.integer)) else tuple(wires)
+            rings += [xy[w] for w in wires]
+            ring_colors += [GATE_COLORS.get(name, "black")] * len(wires)
+            if len(wires) == 2:
+                couplings.append((xy[wires[0]], xy[wires[1]]))
+
+        self.canvas.restore_region(self.background)
+        self.couplings.set_segments(couplings)
+        self.highlights.set_offsets(np.array(rings).reshape(-1, 2))
+        self.highlights.set_edgecolors(ring_colors or "none")
+        self.ions.set_offsets(xy)
+        self.labels.set_offsets(xy)
+        self.title.set_text(f"step {t} / {len(self.ids) - 1}")
+        for artist in (self.couplings, self.highlights, self.ions, self.labels):
+            self.axes.draw_artist(artist)
+        self.figure.draw_artist(self.title)
+
+    def frames(self):
+        """
+        Yield the frames as ``(height, width, 4)`` RGBA arrays.
+
+        Every array is a view of the canvas that the next frame overwrites; copy
+        it to keep it.
+        """
+        for k in range(len(self)):
+            self._draw(k)
+            yield np.asarray(self.canvas.buffer_rgba())
+
+    def save(self, path, fps=20) -> dict:
+        """
+        Stream the frames to a ``.gif`` or ``.mp4`` file.
+
+        Returns:
+            dict: The number of ``frames`` and the ``seconds`` spent.
+        """
+        start = time.perf_counter()
+        writer = open_writer(path, fps, self.canvas.get_width_height())
+        try:
+            for frame in self.frames():
+                writer.write(frame)
+        finally:
+            writer.close()
+        return {"frames": len(self), "seconds": time.perf_counter() - start}
+
+
+class GifWriter:
+    """
+    Write an animated GIF one frame at a time.
+
+    Every frame gets its own palette (a local color table), so nothing but the
+    current frame is held in memory.
+
+    Args:
+        path (str): The file to write.
+        fps (float): The frames per second.
+        colors (int): The palette size per frame.
+    """
+
+    def __init__(self, path, fps, colors=128):
+        self.file = open(path, "wb")
+        self.duration = int(round(1000 / fps))
+        self.colors = colors
+        self.n_frames = 0
+
+    def write(self, frame) -> None:
+        """Append an RGBA or RGB frame."""
+        from PIL import GifImagePlugin, Image
+
+        image = Image.fromarray(np.ascontiguousarray(frame[..., :3])).quantize(
+            self.colors, method=Image.Quantize.FASTOCTREE
+        )
+        if self.n_frames == 0:
+            header, _ = GifImagePlugin.getheader(image, info={"loop": 0, "duration": self.duration})
+            self.file.write(b"".join(header))
+        data = GifImagePlugin.getdata(image, duration=self.duration, include_color_table=True)
+        self.file.write(b"".join(data))
+        self.n_frames += 1
+
+    def close(self) -> None:
+        """Finish the file."""
+        if not self.file.closed:
+            self.file.write(b";")
+            self.file.close()
+
+
+class FFmpegWriter:
+    """
+    Pipe raw frames to ``ffmpeg`` to encode an H.264 video.
+
+    Args:
+        path (str): The file to write.
+        fps (float): The frames per second.
+        size (tuple): The ``(width, height)`` of the frames.
+    """
+
+    def __init__(self, path, fps, size):
+        executable = shutil.which("ffmpeg")
+        if executable is None:
+            raise ValueError("ffmpeg is needed to write videos; write a .gif instead.")
+        width, height = size
+        self.process = subprocess.Popen(
+            [
+                executable, "-y", "-loglevel", "error",
+                "-f", "rawvideo", "-pix_fmt", "rgba", "-s", f"{width}x{height}", "-r", str(fps), "-i", "-",
+                "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2", "-pix_fmt", "yuv420p", "-c:v", "libx264", path,
+            ],
+            stdin=subprocess.PIPE,
+        )
+
+    def write(self, frame) -> None:
+        """Append an RGBA frame."""
+        self.process.stdin.write(np.ascontiguousarray(frame).tobytes())
+
+    def close(self) -> None:
+        """Finish the video."""
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise ValueError(f"ffmpeg failed with exit status {self.process.returncode}.")
+
+
+def open_writer(path, fps, size):
+    """Return the streaming writer for the extension of ``path``."""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".gif":
+        return GifWriter(path, fps)
+    if extension in (".mp4", ".mkv", ".mov"):
+        return FFmpegWriter(path, fps, size)
+    raise ValueError(f"Unknown animation format: {extension}")
+
+
+def render(positions_history, gates_schedule, path, graph=None, fps=20, substeps=4, stride=1) -> dict:
+    """
+    Render a schedule to a ``.gif`` or ``.mp4`` file, see ``TrapAnimation``.
+
+    Args:
+        graph (networkx.Graph): The trap, ``trap.create_trap_graph()`` if None.
+
+    Returns:
+        dict: The number of ``frames`` and the ``seconds`` spent.
+    """
+    if graph is None:
+        from trap import create_trap_graph
+
+        graph = create_trap_graph()
+    animation = TrapAnimation(positions_history, gates_schedule, graph, substeps, stride)
+    return animation.save(path, fps)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m animation", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("schedule", help="pickle of (positions_history, gates_schedule) or schedule file (.qs)")
+    parser.add_argument("output", help="the .gif or .mp4 file to write")
+    parser.add_argument("--index", type=int, default=0, help="candidate in a schedule file")
+    parser.add_argument("--fps", type=float, default=20)
+    parser.add_argument("--substeps", type=int, default=4, help="frames per step")
+    parser.add_argument("--stride", type=int, default=1, help="draw every k-th step only")
+    args = parser.parse_args(argv)
+
+    from trap import create_trap_graph
+
+    graph = create_trap_graph()
+    if args.schedule.endswith(".pkl"):
+        with open(args.schedule, "rb") as file:
+            positions_history, gates_schedule = pickle.load(file)
+    else:
+        from schedule_io import ScheduleFile
+
+        positions_history, gates_schedule = ScheduleFile(args.schedule, graph)[args.index]
+    result = render(positions_history, gates_schedule, args.output, graph, args.fps, args.substeps, args.stride)
+    print(f"Wrote {result['frames']} frames to {args.output} in {result['seconds']:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Measure the start-up cost of the verification and scoring entry points.
+
+    python benchmarks/startup.py [--repeat 5] [--output startup.json]
+
+Every entry point is timed in fresh interpreters, so nothing is shared between
+runs; the report gives the median and best wall time per entry point and
+whether it pulled in PennyLane.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# name -> (extra sys.path entry, statement timed after the interpreter starts)
+ENTRY_POINTS = {
+    "structural": ("", "import structural"),
+    "trap_graph": ("", "import trap; trap.create_trap_graph()"),
+    "schedule_io": ("", "import schedule_io"),
+    "score": ("", "import score"),
+    "verifier": ("", "import verifier"),
+    "fidelity": ("", "import fidelity"),
+    "compiler": ("fzurbonsen", "import compiler"),
+    "verify_structure": (
+        "",
+        "import trap, structural; structural.verify_structure([], [], trap.create_trap_graph())",
+    ),
+    "mixed_device": ("", "import verifier; verifier.get_mixed_device()"),
+}
+
+_PROBE = """
+import sys, time
+sys.path[:0] = {path!r}
+start = time.perf_counter()
+{statement}
+print(time.perf_counter() - start, "pennylane" in sys.modules)
+"""
+
+
+def time_entry_point(name, repeat=5) -> dict:
+    """
+    Time one entry point of ``ENTRY_POINTS`` in ``repeat`` fresh interpreters.
+
+    Returns:
+        dict: The ``median`` and ``best`` time in seconds, without the
+        interpreter start-up, and whether ``pennylane`` was imported.
+    """
+    folder, statement = ENTRY_POINTS[name]
+    path = [ROOT] + ([os.path.join(ROOT, folder)] if folder else [])
+    probe = _PROBE.format(path=path, statement=statement)
+    times, pennylane = [], False
+    for _ in range(repeat):
+        out = subprocess.run(
+            [sys.executable, "-c", probe], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.split()
+        times.append(float(out[-2]))
+        pennylane = out[-1] == "True"
+    return {"median": statistics.median(times), "best": min(times), "pennylane": pennylane}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5, help="fresh interpreters per entry point")
+    parser.add_argument("--output", default=None, help="JSON file for the results")
+    parser.add_argument("names", nargs="*", help=f"entry points to time (default: all of {', '.join(ENTRY_POINTS)})")
+    args = parser.parse_args(argv)
+    unknown = sorted(set(args.names) - set(ENTRY_POINTS))
+    if unknown:
+        parser.error(f"unknown entry points: {', '.join(unknown)}")
+
+    results = {}
+    for name in args.names or ENTRY_POINTS:
+        results[name] = time_entry_point(name, args.repeat)
+        entry = results[name]
+        print(
+            f"{name:<18} median {entry['median'] * 1e3:8.1f} ms  best {entry['best'] * 1e3:8.1f} ms"
+            f"  pennylane: {'yes' if entry['pennylane'] else 'no'}"
+        )
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+"""
+Time the verification, temperature and fidelity engines at several scales.
+
+    python benchmarks/suite.py [--steps 100 1000 10000] [--wires 4 8] [--only verifier ...]
+                               [--output results.json] [--compare baseline.json] [--threshold 0.25]
+
+Every benchmark runs on synthetic valid schedules on ``trap.create_trap_graph``:
+the compiled QFT, followed by routed pairs of canceling rotations and idle
+steps up to the requested length, so that the schedules pass the verifier and
+keep their MS gates at low temperatures. The results are written as JSON;
+``--compare`` flags every entry slower than the baseline by more than the
+threshold and exits with status 1 if there is one. Everything runs offline in
+this process.
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "fzurbonsen")]
+
+import trap  # noqa: E402
+
+STEPS = (100, 1000, 10000)
+WIRES = (4, 8)
+
+
+def synthetic_schedule(n_steps, n_wires, graph, seed=0) -> tuple:
+    """
+    Build a valid schedule of exactly ``n_steps`` steps that implements QFT.
+
+    Args:
+        n_steps (int): The number of steps, at least that of the compiled QFT.
+        n_wires (int): The number of ions.
+        graph (nx.Graph): The graph from ``trap.create_trap_graph``.
+        seed (int): The seed of the padding rotations.
+
+    Returns:
+        tuple: ``(positions_history, gates_schedule)``.
+    """
+    import router
+    from compiler import Compiler
+
+    rng = np.random.default_rng(seed)
+    positions_history, gates_schedule = Compiler(n_wires, graph).compile()
+    positions_history, gates_schedule = list(positions_history), list(gates_schedule)
+    while len(positions_history) < n_steps:
+        remaining = n_steps - len(positions_history)
+        operations = []
+        for _ in range(max(1, remaining // 3)):
+            name, wire, angle = rng.choice(["RX", "RY"]), int(rng.integers(n_wires)), float(rng.uniform(0.1, 3.0))
+            operations += [(name, angle, wire), (name, -angle, wire)]
+        positions, gates = router.route(operations, graph, initial_positions=list(positions_history[-1]))
+        if len(positions) > remaining:
+            break
+        positions_history += positions
+        gates_schedule += gates
+    while len(positions_history) < n_steps:
+        positions_history.append(positions_history[-1])
+        gates_schedule.append([])
+    return positions_history, gates_schedule
+
+
+def _verifier(positions_history, gates_schedule, graph, n_wires):
+    from verifier import verifier
+
+    verifier(positions_history, gates_schedule, graph, n_wires)
+
+
+def _verify_structure(positions_history, gates_schedule, graph, n_wires):
+    from structural import verify_structure
+
+    verify_structure(positions_history, gates_schedule, graph, n_wires)
+
+
+def _streaming(positions_history, gates_schedule, graph, n_wires):
+    from verifier import StreamingVerifier
+
+    stream = StreamingVerifier(graph, n_wires)
+    for positions, gates in zip(positions_history, gates_schedule):
+        stream.push(positions, gates)
+    stream.check_end()
+
+
+def _implements_qft(positions_history, gates_schedule, graph, n_wires):
+    from verifier import implements_qft
+
+    implements_qft(gates_schedule, n_wires)
+
+
+def _temperatures(positions_history, gates_schedule, graph, n_wires):
+    from fidelity import get_temperatures
+
+    get_temperatures(positions_history, graph)
+
+
+def _compiled_circuit_noisy(positions_history, gates_schedule, graph, n_wires):
+    from fidelity import compiled_circuit_noisy, get_temperatures
+
+    compiled_circuit_noisy(gates_schedule, get_temperatures(positions_history, graph), n_wires)()
+
+
+def _fidelity(backend):
+    def run(positions_history, gates_schedule, graph, n_wires):
+        from fidelity import fidelity
+
+        fidelity(positions_history, gates_schedule, graph, backend=backend, n_wires=n_wires)
+
+    return run
+
+
+def _trajectory(positions_history, gates_schedule, graph, n_wires):
+    from fidelity import get_temperatures
+    from trajectory import trajectory_fidelity
+
+    temperature = get_temperatures(positions_history, graph)
+    trajectory_fidelity(gates_schedule, temperature, n_wires, trajectories=50, max_workers=1)
+
+
+def _estimator(positions_history, gates_schedule, graph, n_wires):
+    from estimator import FidelityEstimator
+
+    FidelityEstimator(graph).estimate(positions_history, gates_schedule)
+
+
+# name -> (function(positions_history, gates_schedule, graph, n_wires), largest number of steps)
+BENCHMARKS = {
+    "verifier": (_verifier, None),
+    "verify_structure": (_verify_structure, None),
+    "streaming_verifier": (_streaming, None),
+    "implements_qft": (_implements_qft, None),
+    "get_temperatures": (_temperatures, None),
+    "compiled_circuit_noisy": (_compiled_circuit_noisy, 1000),
+    "fidelity[pennylane]": (_fidelity("pennylane"), 1000),
+    "fidelity[native]": (_fidelity("native"), None),
+    "fidelity[mps]": (_fidelity("mps"), None),
+    "trajectory_fidelity": (_trajectory, 1000),
+    "estimator": (_estimator, None),
+}
+
+
+def measure(function, min_time=0.5, max_runs=5) -> dict:
+    """
+    Time ``function()`` until ``min_time`` seconds or ``max_runs`` runs are spent.
+
+    A first, untimed call pays for lazy imports and cached tables, so that the
+    results do not depend on the order in which the benchmarks run.
+
+    Returns:
+        dict: The ``best`` and ``median`` time in seconds and the number of timed ``runs``.
+    """
+    function()
+    times = []
+    while not times or (len(times) < max_runs and sum(times) < min_time):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return {"best": min(times), "median": statistics.median(times), "runs": len(times)}
+
+
+def run_suite(steps=STEPS, wires=WIRES, names=None, min_time=0.5, max_runs=5, echo=print) -> dict:
+    """
+    Run the benchmarks on every combination of steps and wires.
+
+    The schedules are built once per combination and their construction is not
+    timed; PennyLane is imported and its devices created before the timing.
+
+    Args:
+        steps (tuple): The schedule lengths.
+        wires (tuple): The numbers of ions.
+        names (list): The benchmarks of ``BENCHMARKS`` to run, all if None.
+        min_time (float): See ``measure``.
+        max_runs (int): See ``measure``.
+        echo (callable): Called with a line per result, None to stay quiet.
+
+    Returns:
+        dict: ``meta`` describing the machine and ``results`` keyed by
+        ``"name/steps=T/wires=N"``, each with the ``measure`` entries and the
+        ``benchmark``, ``steps`` and ``wires``.
+    """
+    graph = trap.create_trap_graph()
+    names = list(BENCHMARKS) if names is None else names
+    if any("pennylane" in name or name == "compiled_circuit_noisy" for name in names):
+        from verifier import get_mixed_device
+
+        for n_wires in wires:
+            get_mixed_device(n_wires)
+
+    results = {}
+    for n_wires in wires:
+        for n_steps in steps:
+            positions_history, gates_schedule = synthetic_schedule(n_steps, n_wires, graph)
+            for name in names:
+                function, largest = BENCHMARKS[name]
+                if largest is not None and n_steps > largest:
+                    continue
+                entry = measure(
+                    lambda: function(positions_history, gates_schedule, graph, n_wires), min_time, max_runs
+                )
+                entry.update(benchmark=name, steps=n_steps, wires=n_wires)
+                results[f"{name}/steps={n_steps}/wires={n_wires}"] = entry
+                if echo is not None:
+                    echo(f"{name:<24} steps {n_steps:>6}  wires {n_wires:>2}  best {entry['best'] * 1e3:10.2f} ms")
+    return {"meta": _meta(), "results": results}
+
+
+def _meta():
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpus": os.cpu_count(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def compare(baseline, current, threshold=0.25, min_delta=1e-3) -> list:
+    """
+    Compare two ``run_suite`` results entry by entry.
+
+    An entry regresses when its best time exceeds the baseline's by more than
+    ``threshold`` (relative) and ``min_delta`` seconds, which keeps timer noise
+    on very fast entries from being flagged.
+
+    Returns:
+        list: ``(key, baseline seconds, current seconds, ratio, status)`` for
+        the entries in both results; ``status`` is ``"regression"``,
+        ``"improvement"`` or ``"ok"``.
+    """
+    rows = []
+    for key, entry in current["results"].items():
+        if key not in baseline["results"]:
+            continue
+        before, after = baseline["results"][key]["best"], entry["best"]
+        ratio = after / before if before > 0 else float("inf")
+        if after - before > min_delta and ratio > 1 + threshold:
+            status = "regression"
+        elif before - after > min_delta and ratio < 1 / (1 + threshold):
+            status = "improvement"
+        else:
+            status = "ok"
+        rows.append((key, before, after, ratio, status))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--steps", type=int, nargs="+", default=list(STEPS), help="schedule lengths")
+    parser.add_argument("--wires", type=int, nargs="+", default=list(WIRES), help="numbers of ions")
+    parser.add_argument("--only", nargs="+", default=None, help=f"benchmarks to run, of: {', '.join(BENCHMARKS)}")
+    parser.add_argument("--min-time", type=float, default=0.5, help="seconds spent per entry")
+    parser.add_argument("--max-runs", type=int, default=5, help="runs per entry")
+    parser.add_argument("--output", default=None, help="JSON file for the results")
+    parser.add_argument("--compare", default=None, help="baseline JSON file from --output")
+    parser.add_argument("--threshold", type=float, default=0.25, help="relative slowdown flagged as a regression")
+    args = parser.parse_args(argv)
+    unknown = sorted(set(args.only or ()) - set(BENCHMARKS))
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(unknown)}")
+    logging.basicConfig(level=logging.WARNING)
+
+    current = run_suite(args.steps, args.wires, args.only, args.min_time, args.max_runs)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(current, file, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        rows = compare(baseline, current, args.threshold)
+        for key, before, after, ratio, status in rows:
+            print(f"{status:<12} {key:<48} {before * 1e3:10.2f} ms -> {after * 1e3:10.2f} ms  x{ratio:.2f}")
+        if any(row[4] == "regression" for row in rows):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,246 @@
+import numpy as np
+
+from fidelity import MS_NOISE, get_temperatures, simulate_noisy_native
+from structural import encode_positions, graph_tables
+from trap import DEFAULT_WIRES
+
+
+class FidelityEstimator:
+    """
+    Analytic fidelity estimate from the MS depolarizing probabilities.
+
+    Every MS gate is followed by a depolarizing channel with probability
+    ``p = MS_NOISE * n (2n + 1)``, ``n`` being the average temperature of its
+    two ions (see ``fidelity.ms_error_probability``). The estimate is the
+    product of the per-gate survival terms ``1 - scale * p``; ``scale``
+    corrects for the part of a depolarizing error that leaves the state
+    unchanged and is fitted by ``calibrate``.
+
+    Args:
+        graph (nx.Graph): The graph representing the Penning trap.
+        scale (float): The correction factor of the error probabilities.
+    """
+
+    def __init__(self, graph, scale=1.0):
+        self.graph = graph
+        self.scale = scale
+        _, self.index, _, _, _ = graph_tables(graph)
+
+    def ms_errors(self, positions_history, gates_schedule) -> dict:
+        """
+        Return the depolarizing probability of every MS gate.
+
+        Args:
+            positions_history (list): A list of positions of the ions, or an
+                integer ``(T, N)`` array of node ids.
+            gates_schedule (list): A list of gates where each gate is represented as a tuple.
+
+        Returns:
+            dict: Arrays ``step``, ``wire0``, ``wire1``, ``temperature`` (the pair
+            average) and ``probability``, one entry per MS gate in schedule order.
+        """
+        temperature = get_temperatures(positions_history, self.graph)
+        steps, wire0, wire1 = [], [], []
+        for i, step in enumerate(gates_schedule):
+            for gate in step:
+                if gate[0] == "MS":
+                    steps.append(i)
+                    wire0.append(gate[2][0])
+                    wire1.append(gate[2][1])
+        steps = np.array(steps, dtype=np.int64)
+        wire0 = np.array(wire0, dtype=np.int64)
+        wire1 = np.array(wire1, dtype=np.int64)
+        average = (temperature[steps, wire0] + temperature[steps, wire1]) / 2
+        return {
+            "step": steps,
+            "wire0": wire0,
+            "wire1": wire1,
+            "temperature": average,
+            "probability": MS_NOISE * average * (2 * average + 1),
+        }
+
+    def estimate(self, positions_history, gates_schedule) -> float:
+        """Return the estimated fidelity, the product of ``1 - scale * p`` over the MS gates."""
+        probability = self.ms_errors(positions_history, gates_schedule)["probability"]
+        return float(np.prod(1 - self.scale * probability))
+
+    def attribution(self, positions_history, gates_schedule) -> dict:
+        """
+        Break the estimated fidelity loss down by MS gate, ion and segment.
+
+        The loss of a gate is ``-log(1 - scale * p)``, so the losses add up to
+        ``-log`` of the estimate. A gate's loss is shared between the heat
+        increments of its two ions up to its step in proportion to their part
+        of the average temperature. The increments of an ion are grouped into
+        segments: runs of consecutive moves (``"move"``) and runs of steps spent
+        at one node (``"dwell"``).
+
+        Args:
+            positions_history (list): A list of positions of the ions, or an
+                integer ``(T, N)`` array of node ids.
+            gates_schedule (list): A list of gates where each gate is represented as a tuple.
+
+        Returns:
+            dict: The ``fidelity`` estimate, the total ``loss``, the ``gates``
+            (``step``, ``wires``, ``temperature``, ``probability``, ``loss``),
+            the ``loss`` of every ion in ``ions`` and the ``segments`` (``ion``,
+            ``kind``, ``start`` and ``end`` steps, ``start_node``,
+            ``end_node``, ``heat``, ``loss``); gates and segments are sorted by
+            decreasing loss.
+        """
+        if isinstance(positions_history, np.ndarray) and positions_history.dtype.kind == "i":
+            pos = positions_history
+        else:
+            pos = encode_positions(positions_history, self.index)
+        errors = self.ms_errors(pos, gates_schedule)
+        loss = -np.log1p(-self.scale * errors["probability"])
+        n_steps, n_ions = pos.shape
+
+        # Loss per unit of heat of each ion at the step of each gate, summed
+        # over the gates at or after every step.
+        share = np.zeros((n_steps, n_ions))
+        hot = errors["temperature"] > 0
+        per_heat = np.zeros_like(loss)
+        per_heat[hot] = loss[hot] / (2 * errors["temperature"][hot])
+        np.add.at(share, (errors["step"], errors["wire0"]), per_heat)
+        np.add.at(share, (errors["step"], errors["wire1"]), per_heat)
+        share = np.cumsum(share[::-1], axis=0)[::-1]
+
+        moved = np.zeros((n_steps, n_ions), dtype=bool)
+        moved[1:] = pos[1:] != pos[:-1]
+        # The heat increments of the temperature model, step by step.
+        increment = np.diff(get_temperatures(pos, self.graph), axis=0, prepend=0)
+        step_loss = increment * share
+
+        nodes = list(self.index)
+        segments = []
+        for ion in range(n_ions):
+            start = 1
+            for t in range(2, n_steps + 1):
+                if t < n_steps and moved[t, ion] == moved[start, ion]:
+                    continue
+                segments.append(
+                    {
+                        "ion": ion,
+                        "kind": "move" if moved[start, ion] else "dwell",
+                        "start": start,
+                        "end": t - 1,
+                        "start_node": nodes[pos[start - 1, ion]],
+                        "end_node": nodes[pos[t - 1, ion]],
+                        "heat": float(increment[start:t, ion].sum()),
+                        "loss": float(step_loss[start:t, ion].sum()),
+                    }
+                )
+                start = t
+
+        gates = [
+            {
+                "step": int(errors["step"][k]),
+                "wires": (int(errors["wire0"][k]), int(errors["wire1"][k])),
+                "temperature": float(errors["temperature"][k]),
+                "probability": float(errors["probability"][k]),
+                "loss": float(loss[k]),
+            }
+            for k in np.argsort(-loss, kind="stable")
+        ]
+        total = float(loss.sum())
+        return {
+            "fidelity": float(np.exp(-total)),
+            "loss": total,
+            "gates": gates,
+            "ions": step_loss.sum(axis=0),
+            "segments": sorted(segments, key=lambda segment: -segment["loss"]),
+        }
+
+
+def random_schedule(graph, rng, n_steps=40, ms_fraction=0.5, n_wires=DEFAULT_WIRES):
+    """
+    Draw a random schedule for calibration.
+
+    Every step holds one gate on random wires and every ion does a random walk
+    on the trap (staying put with probability one half). The schedules are not
+    meant to pass the verifier, only to cover a range of temperatures.
+
+    Args:
+        graph (nx.Graph): The graph representing the Penning trap.
+        rng (np.random.Generator): The random generator.
+        n_steps (int): The number of steps.
+        ms_fraction (float): The probability that a gate is an MS gate.
+        n_wires (int): The number of ions.
+
+    Returns:
+        tuple: ``(positions, gates_schedule)`` with the positions as an integer
+        ``(T, N)`` array of node ids.
+    """
+    _, _, _, _, adjacency = graph_tables(graph)
+    neighbors = [np.flatnonzero(row) for row in adjacency]
+    pos = np.empty((n_steps, n_wires), dtype=np.int64)
+    pos[0] = rng.choice(len(adjacency), size=n_wires, replace=False)
+    for t in range(1, n_steps):
+        for ion in range(n_wires):
+            here = pos[t - 1, ion]
+            pos[t, ion] = rng.choice(neighbors[here]) if rng.random() < 0.5 else here
+    gates_schedule = []
+    for _ in range(n_steps):
+        if rng.random() < ms_fraction:
+            wires = tuple(int(w) for w in rng.choice(n_wires, size=2, replace=False))
+            gates_schedule.append([("MS", float(rng.uniform(-np.pi, np.pi)), wires)])
+        else:
+            name = "RX" if rng.random() < 0.5 else "RY"
+            wire = int(rng.integers(n_wires))
+            gates_schedule.append([(name, float(rng.uniform(-np.pi, np.pi)), wire)])
+    return pos, gates_schedule
+
+
+def calibrate(graph, n_schedules=32, seed=0, n_steps=40):
+    """
+    Fit the correction factor of ``FidelityEstimator`` against the exact engine.
+
+    Random schedules (see ``random_schedule``) are simulated with
+    ``fidelity.simulate_noisy_native``, with and without noise, and their
+    fidelity is the overlap of the two states. The scale is the least-squares
+    fit of ``-log F = scale * sum(p)``.
+
+    Args:
+        graph (nx.Graph): The graph representing the Penning trap.
+        n_schedules (int): The number of random schedules.
+        seed (int): The random seed.
+        n_steps (int): The number of steps of every schedule.
+
+    Returns:
+        tuple: The calibrated estimator and a report with the ``scale``, the
+        ``exact`` and ``estimated`` fidelities and the largest absolute
+        fidelity error and mean relative infidelity error before
+        (``*_unscaled``) and after calibration.
+    """
+    rng = np.random.default_rng(seed)
+    candidates = [random_schedule(graph, rng, n_steps) for _ in range(n_schedules)]
+    exact = []
+    for pos, schedule in candidates:
+        temperature = get_temperatures(pos, graph)
+        noisy = simulate_noisy_native(schedule, temperature, temperature.shape[1])
+        ideal = simulate_noisy_native(schedule, np.zeros_like(temperature), temperature.shape[1])
+        exact.append(np.vdot(ideal, noisy).real)
+    exact = np.array(exact)
+
+    estimator = FidelityEstimator(graph)
+    total = np.array(
+        [estimator.ms_errors(pos, schedule)["probability"].sum() for pos, schedule in candidates]
+    )
+    unscaled = np.array([estimator.estimate(pos, schedule) for pos, schedule in candidates])
+    target = -np.log(exact)
+    estimator.scale = float(total @ target / (total @ total)) if total.any() else 1.0
+    estimated = np.array([estimator.estimate(pos, schedule) for pos, schedule in candidates])
+
+    def relative(estimate):
+        return float(np.mean(np.abs((1 - estimate) - (1 - exact)) / np.maximum(1 - exact, 1e-15)))
+
+    return estimator, {
+        "scale": estimator.scale,
+        "exact": exact,
+        "estimated": estimated,
+        "max_error_unscaled": float(np.max(np.abs(unscaled - exact))),
+        "max_error": float(np.max(np.abs(estimated - exact))),
+        "relative_infidelity_error_unscaled": relative(unscaled),
+        "relative_infidelity_error": relative(estimated),
+    }
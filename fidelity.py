@@ -1,121 +1,253 @@
-import pennylane as qml
+import hashlib
+import logging
+from collections import OrderedDict
+from contextlib import nullcontext
+from functools import lru_cache
+
 import numpy as np
 
-mixed_device = qml.device("default.mixed", wires=8)
+from density import (
+    MixedState,
+    ms_matrix,
+    pure_state_fidelity,
+    qft_reference_state,
+    rx_matrix,
+    ry_matrix,
+)
+from fusion import fuse
+from mps import qft_fidelity, simulate_mps
+from profiling import active, gate_phase, instrumented, phase
+from structural import encode_positions, graph_tables
+from trap import DEFAULT_WIRES, IDLE
+from verifier import circuit, get_mixed_device
 
+logger = logging.getLogger(__name__)
 
-@qml.qnode(device=mixed_device)
-def circuit():
-    qml.QFT(wires=range(8))
-    return qml.density_matrix(wires=range(8))
+# Temperature increments of an ion per step: for a move, for staying at an idle
+# node and for staying anywhere else.
+MOVE_HEAT = 0.03
+IDLE_HEAT = 0.01
+DWELL_HEAT = 0.02
 
 
+@instrumented("temperatures")
 def get_temperatures(positions_history, graph):
     """
     Calculate the temperature of each ion based on its positions history and the graph.
 
+    The positions are encoded as integer node ids and the temperature increments
+    of all steps and ions are computed at once: ``MOVE_HEAT`` for a move,
+    ``IDLE_HEAT`` for staying at an idle node and ``DWELL_HEAT`` for staying
+    anywhere else. The temperatures are their running sum over the steps.
+
     Args:
-        positions_history (list): A list of positions of the ions.
+        positions_history (list): A list of positions of the ions, or an integer
+            ``(T, N)`` array of node ids in the order of ``graph.nodes()``.
         graph (nx.Graph): The graph representing the circuit.
 
     Returns:
-        list: A list of temperatures for each ion.
-    """
-    temperature = [[0.0] * len(positions_history[0])]
-    for i, pos in enumerate(positions_history):
-        temp = temperature[-1].copy()
-        for j, p in enumerate(pos):
-            if i > 0:
-                if p == positions_history[i - 1][j]:
-                    if graph.nodes[p]["type"] == "idle":
-                        temp[j] += 0.01
-                    else:
-                        temp[j] += 0.02
-                else:
-                    temp[j] += 0.03
-        temperature.append(temp)
-    temperature.pop(0)
-    return temperature
+        np.ndarray: The temperature of each ion at each step, shape ``(T, N)``.
 
+    Raises:
+        KeyError: If a position is not a node of the graph.
+    """
+    _, index, node_type, _, _ = graph_tables(graph)
+    if isinstance(positions_history, np.ndarray) and positions_history.dtype.kind == "i":
+        pos = positions_history
+    else:
+        pos = encode_positions(positions_history, index)
+    unknown = np.argwhere(pos < 0)
+    if len(unknown):
+        step, ion = unknown[0]
+        raise KeyError(positions_history[step][ion])
+    increment = np.where(node_type[pos] == IDLE, IDLE_HEAT, DWELL_HEAT)
+    increment[1:][pos[1:] != pos[:-1]] = MOVE_HEAT
+    increment[:1] = 0.0
+    return np.cumsum(increment, axis=0)
 
-# Create noisy circuit
 
-from pennylane.operation import Channel
+def _check_ions(temperature, n_wires):
+    if temperature.shape[1] != n_wires:
+        raise ValueError(f"Invalid number of ions: {temperature.shape[1]}, expected {n_wires}.")
+
+
+class TemperatureTracker:
+    """
+    Streaming counterpart of ``get_temperatures``.
+
+    Positions are pushed one step at a time and the temperature of every ion is
+    updated in O(N).
+
+    Args:
+        graph (nx.Graph): The graph representing the circuit.
+    """
+
+    def __init__(self, graph):
+        _, self.index, self.node_type, _, _ = graph_tables(graph)
+        self.previous = None
+        self.temperature = None
+
+    def push(self, positions) -> np.ndarray:
+        """
+        Advance by one step.
+
+        Args:
+            positions (tuple): The position of each ion at the new step.
+
+        Returns:
+            np.ndarray: The temperature of each ion at this step.
+        """
+        pos = np.array([self.index[p] for p in positions])
+        if self.previous is None:
+            self.temperature = np.zeros(len(pos))
+        else:
+            increment = np.where(self.node_type[pos] == IDLE, IDLE_HEAT, DWELL_HEAT)
+            increment[pos != self.previous] = MOVE_HEAT
+            self.temperature = self.temperature + increment
+        self.previous = pos
+        return self.temperature
+
+
+# Create noisy circuit
 
 eps = eps = 1e-14
 
 
-class DepolarizingChannel(Channel):
-    num_params = 1
-    num_wires = 2
-    grad_method = "A"
-    grad_recipe = ([[1, 0, 1], [-1, 0, 0]],)
-
-    def __init__(self, p, wires, id=None):
-        super().__init__(p, wires=wires, id=id)
-
-    @staticmethod
-    def compute_kraus_matrices(p):  # pylint:disable=arguments-differ
-        r"""Kraus matrices representing the depolarizing channel."""
-        if not 0.0 <= p <= 1.0:
-            raise ValueError("p must be in the interval [0,1]")
-
-        I = np.array([[1, 0], [0, 1]], dtype=complex)
-        X = np.array([[0, 1], [1, 0]], dtype=complex)
-        Y = np.array([[0, -1j], [1j, 0]], dtype=complex)
-        Z = np.array([[1, 0], [0, -1]], dtype=complex)
-
-        pauli_2qubit = [
-            np.kron(I, I),
-            np.kron(X, I),
-            np.kron(Y, I),
-            np.kron(Z, I),
-            np.kron(I, X),
-            np.kron(I, Y),
-            np.kron(I, Z),
-            np.kron(X, X),
-            np.kron(X, Y),
-            np.kron(X, Z),
-            np.kron(Y, X),
-            np.kron(Y, Y),
-            np.kron(Y, Z),
-            np.kron(Z, X),
-            np.kron(Z, Y),
-            np.kron(Z, Z),
-        ]
-        return [
-            np.sqrt(1 - p + eps) * pauli_2qubit[0],
-            np.sqrt(p / 15 + eps) * pauli_2qubit[1],
-            np.sqrt(p / 15 + eps) * pauli_2qubit[2],
-            np.sqrt(p / 15 + eps) * pauli_2qubit[3],
-            np.sqrt(p / 15 + eps) * pauli_2qubit[4],
-            np.sqrt(p / 15 + eps) * pauli_2qubit[5],
-            np.sqrt(p / 15 + eps) * pauli_2qubit[6],
-            np.sqrt(p / 15 + eps) * pauli_2qubit[7],
-            np.sqrt(p / 15 + eps) * pauli_2qubit[8],
-            np.sqrt(p / 15 + eps) * pauli_2qubit[9],
-            np.sqrt(p / 15 + eps) * pauli_2qubit[10],
-            np.sqrt(p / 15 + eps) * pauli_2qubit[11],
-            np.sqrt(p / 15 + eps) * pauli_2qubit[12],
-            np.sqrt(p / 15 + eps) * pauli_2qubit[13],
-            np.sqrt(p / 15 + eps) * pauli_2qubit[14],
-            np.sqrt(p / 15 + eps) * pauli_2qubit[15],
-        ]
-
-
-def compiled_circuit_noisy(gates_schedule, temperature) -> qml.QNode:
+@lru_cache(maxsize=None)
+def get_depolarizing_channel():
+    """Return the PennyLane ``DepolarizingChannel`` class, defined on first use."""
+    from pennylane.operation import Channel
+
+    class DepolarizingChannel(Channel):
+        num_params = 1
+        num_wires = 2
+        grad_method = "A"
+        grad_recipe = ([[1, 0, 1], [-1, 0, 0]],)
+
+        def __init__(self, p, wires, id=None):
+            super().__init__(p, wires=wires, id=id)
+
+        compute_kraus_matrices = staticmethod(depolarizing_kraus_matrices)
+
+    return DepolarizingChannel
+
+
+def __getattr__(name):
+    # ``DepolarizingChannel`` used to be defined at import time.
+    if name == "DepolarizingChannel":
+        return get_depolarizing_channel()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+@instrumented("kraus_matrices")
+def depolarizing_kraus_matrices(p):
+    r"""Kraus matrices representing the depolarizing channel."""
+    if not 0.0 <= p <= 1.0:
+        raise ValueError("p must be in the interval [0,1]")
+
+    I = np.array([[1, 0], [0, 1]], dtype=complex)
+    X = np.array([[0, 1], [1, 0]], dtype=complex)
+    Y = np.array([[0, -1j], [1j, 0]], dtype=complex)
+    Z = np.array([[1, 0], [0, -1]], dtype=complex)
+
+    pauli_2qubit = [
+        np.kron(I, I),
+        np.kron(X, I),
+        np.kron(Y, I),
+        np.kron(Z, I),
+        np.kron(I, X),
+        np.kron(I, Y),
+        np.kron(I, Z),
+        np.kron(X, X),
+        np.kron(X, Y),
+        np.kron(X, Z),
+        np.kron(Y, X),
+        np.kron(Y, Y),
+        np.kron(Y, Z),
+        np.kron(Z, X),
+        np.kron(Z, Y),
+        np.kron(Z, Z),
+    ]
+    return [
+        np.sqrt(1 - p + eps) * pauli_2qubit[0],
+        np.sqrt(p / 15 + eps) * pauli_2qubit[1],
+        np.sqrt(p / 15 + eps) * pauli_2qubit[2],
+        np.sqrt(p / 15 + eps) * pauli_2qubit[3],
+        np.sqrt(p / 15 + eps) * pauli_2qubit[4],
+        np.sqrt(p / 15 + eps) * pauli_2qubit[5],
+        np.sqrt(p / 15 + eps) * pauli_2qubit[6],
+        np.sqrt(p / 15 + eps) * pauli_2qubit[7],
+        np.sqrt(p / 15 + eps) * pauli_2qubit[8],
+        np.sqrt(p / 15 + eps) * pauli_2qubit[9],
+        np.sqrt(p / 15 + eps) * pauli_2qubit[10],
+        np.sqrt(p / 15 + eps) * pauli_2qubit[11],
+        np.sqrt(p / 15 + eps) * pauli_2qubit[12],
+        np.sqrt(p / 15 + eps) * pauli_2qubit[13],
+        np.sqrt(p / 15 + eps) * pauli_2qubit[14],
+        np.sqrt(p / 15 + eps) * pauli_2qubit[15],
+    ]
+
+
+# Prefactor of the MS depolarizing probability, pi^2 eta^4 / 4 with eta = 0.05.
+MS_NOISE = np.pi**2 * 0.05**4 / 4
+
+
+def ms_error_probability(gate, temp) -> float:
+    """
+    Depolarizing probability of an MS gate given the ion temperatures at its step.
+
+    Args:
+        gate (tuple): The MS gate ``("MS", angle, (wire_0, wire_1))``.
+        temp (list): The temperature of each ion at the step of the gate.
+
+    Returns:
+        float: The probability of the depolarizing channel following the gate.
+    """
+    temp1 = temp[gate[2][0]]
+    temp2 = temp[gate[2][1]]
+    average_temp = (temp1 + temp2) / 2
+    prob = MS_NOISE * average_temp * (2 * average_temp + 1)
+    assert 0.0 <= prob <= 1.0, (
+        f"Average temperature too high: ion {gate[2][0]}: {temp1}, ion {gate[2][1]}: {temp2}"
+    )
+    return prob
+
+
+@instrumented("qnode_build")
+def compiled_circuit_noisy(gates_schedule, temperature, n_wires=DEFAULT_WIRES, max_width=None) -> "qml.QNode":
     """
     Build a noisy circuit from the list of gates and the ion temperatures.
 
     Args:
         gates_schedule (list): A list of gates where each gate is represented as a tuple.
+        temperature (list): The temperature of each ion at each step.
+        n_wires (int): The number of wires.
+        max_width (int): Fuse the noise-free spans into ``qml.QubitUnitary``
+            blocks of up to this many wires (see ``fusion.fuse``); None applies
+            every gate on its own.
 
     Returns:
         qml.QNode: A Pennylane QNode representing the circuit.
     """
-    dev = qml.device("default.mixed", wires=8)
+    import pennylane as qml
+
+    DepolarizingChannel = get_depolarizing_channel()
 
-    @qml.qnode(dev)
+    if max_width is not None:
+        operations, _ = fuse(gates_schedule, temperature, max_width)
+
+        @qml.qnode(get_mixed_device(n_wires))
+        def fused():
+            for kind, param, wires in operations:
+                if kind == "U":
+                    qml.QubitUnitary(param, wires=wires)
+                else:
+                    DepolarizingChannel(param, wires=wires)
+            return qml.density_matrix(wires=range(n_wires))
+
+        return fused
+
+    @qml.qnode(get_mixed_device(n_wires))
     def circuit():
         for i, step in enumerate(gates_schedule):
             temp = temperature[i]
@@ -125,40 +257,254 @@ def compiled_circuit_noisy(gates_schedule, temperature) -> qml.QNode:
                 elif gate[0] == "RY":
                     qml.RY(gate[1], wires=gate[2])
                 elif gate[0] == "MS":
-                    temp1 = temp[gate[2][0]]
-                    temp2 = temp[gate[2][1]]
-                    average_temp = (temp1 + temp2) / 2
-                    prob = (
-                        (np.pi**2 * (0.05) ** 4)
-                        / 4
-                        * average_temp
-                        * (2 * average_temp + 1)
-                    )
-                    assert 0.0 <= prob <= 1.0, (
-                        f"Average temperature too high: ion {gate[2][0]}: {temp1}, ion {gate[2][1]}: {temp2}"
-                    )
+                    prob = ms_error_probability(gate, temp)
                     qml.IsingXX(gate[1], wires=gate[2])
                     DepolarizingChannel(prob, wires=gate[2])
-        return qml.density_matrix(wires=range(8))
+        return qml.density_matrix(wires=range(n_wires))
 
     return circuit
 
 
-def fidelity(positions_history, gates_schedule, graph) -> float:
+@instrumented("native_simulation")
+def simulate_noisy_native(gates_schedule, temperature, n_wires=DEFAULT_WIRES, max_width=None) -> np.ndarray:
+    """
+    Simulate the noisy circuit with the native density-matrix engine.
+
+    This is the NumPy counterpart of ``compiled_circuit_noisy``: the same gates and
+    depolarizing channels are applied, without building a device or a QNode.
+
+    Args:
+        gates_schedule (list): A list of gates where each gate is represented as a tuple.
+        temperature (list): The temperature of each ion at each step.
+        n_wires (int): The number of wires.
+        max_width (int): Fuse the noise-free spans into blocks of up to this
+            many wires (see ``fusion.fuse``); None applies every gate on its own.
+
+    Returns:
+        np.ndarray: The density matrix of the noisy circuit.
+    """
+    state = MixedState(n_wires=n_wires)
+    if max_width is not None:
+        operations, _ = fuse(gates_schedule, temperature, max_width)
+        profiled = active() is not None
+        for kind, param, wires in operations:
+            with gate_phase("fused" if kind == "U" else "depolarizing") if profiled else nullcontext():
+                if kind == "U":
+                    state.apply_unitary(param, wires)
+                else:
+                    state.apply_depolarizing(param, wires, eps=eps)
+        return state.matrix()
+    profiler = active()
+    for i, step in enumerate(gates_schedule):
+        _apply_step(state, step, temperature[i], profiler)
+    return state.matrix()
+
+
+def _apply_step(state, step, temp, profiler=None):
+    # With a profiler, every gate is recorded under its gate type.
+    for gate in step:
+        if profiler is None:
+            _apply_gate(state, gate, temp)
+        else:
+            with gate_phase(gate[0]):
+                _apply_gate(state, gate, temp)
+
+
+def _apply_gate(state, gate, temp):
+    if gate[0] == "RX":
+        state.apply_unitary(rx_matrix(gate[1]), gate[2])
+    elif gate[0] == "RY":
+        state.apply_unitary(ry_matrix(gate[1]), gate[2])
+    elif gate[0] == "MS":
+        prob = ms_error_probability(gate, temp)
+        state.apply_unitary(ms_matrix(gate[1]), gate[2])
+        state.apply_depolarizing(prob, gate[2], eps=eps)
+
+
+class IncrementalSimulator:
+    """
+    Native noisy simulator that resumes from checkpoints of earlier schedules.
+
+    After every ``checkpoint_every`` steps the density matrix is stored under a
+    hash of the gates and MS noise probabilities up to that step, which is all
+    the state depends on. Simulating a schedule that shares a prefix with an
+    earlier one starts from the latest matching checkpoint, so a local search
+    that only changes the tail of a schedule only replays the tail. Checkpoints
+    are evicted least recently used first once they exceed ``memory_budget``
+    bytes.
+
+    Args:
+        graph (nx.Graph): The graph representing the Penning trap.
+        checkpoint_every (int): The number of steps between checkpoints.
+        memory_budget (int): The maximum number of bytes held by checkpoints.
+        n_wires (int): The number of ions of the schedules.
+    """
+
+    def __init__(self, graph, checkpoint_every=8, memory_budget=256 * 2**20, n_wires=DEFAULT_WIRES):
+        self.graph = graph
+        self.n_wires = n_wires
+        self.checkpoint_every = checkpoint_every
+        self.memory_budget = memory_budget
+        self.checkpoints = OrderedDict()
+        self.memory = 0
+        self.steps_simulated = 0
+        self.steps_skipped = 0
+
+    def prefix_keys(self, gates_schedule, temperature):
+        """Return the hash of the schedule prefix ending at every step."""
+        keys = []
+        digest = b""
+        for i, step in enumerate(gates_schedule):
+            probs = [ms_error_probability(g, temperature[i]) for g in step if g[0] == "MS"]
+            digest = hashlib.blake2b(
+                digest + repr((step, probs)).encode(), digest_size=16
+            ).digest()
+            keys.append(digest)
+        return keys
+
+    def simulate(self, positions_history, gates_schedule) -> np.ndarray:
+        """
+        Simulate the noisy circuit, resuming from the longest cached prefix.
+
+        Args:
+            positions_history (list): A list of positions of the ions.
+            gates_schedule (list): A list of gates where each gate is represented as a tuple.
+
+        Returns:
+            np.ndarray: The density matrix of the noisy circuit.
+        """
+        temperature = get_temperatures(positions_history, self.graph)
+        _check_ions(temperature, self.n_wires)
+        keys = self.prefix_keys(gates_schedule, temperature)
+        state = MixedState(n_wires=self.n_wires)
+        start = 0
+        for i in range(len(keys) - 1, -1, -1):
+            if keys[i] in self.checkpoints:
+                self.checkpoints.move_to_end(keys[i])
+                state.rho[...] = self.checkpoints[keys[i]]
+                start = i + 1
+                break
+        self.steps_skipped += start
+
+        for i in range(start, len(gates_schedule)):
+            _apply_step(state, gates_schedule[i], temperature[i])
+            self.steps_simulated += 1
+            if (i + 1) % self.checkpoint_every == 0 and keys[i] not in self.checkpoints:
+                self._store(keys[i], state.rho.copy())
+        return state.matrix()
+
+    def fidelity(self, positions_history, gates_schedule) -> float:
+        """Fidelity between the ideal and noisy circuit, see ``fidelity``."""
+        rho = self.simulate(positions_history, gates_schedule)
+        return pure_state_fidelity(qft_reference_state(self.n_wires), rho)
+
+    def _store(self, key, rho):
+        if rho.nbytes > self.memory_budget:
+            return
+        self.checkpoints[key] = rho
+        self.memory += rho.nbytes
+        while self.memory > self.memory_budget:
+            _, evicted = self.checkpoints.popitem(last=False)
+            self.memory -= evicted.nbytes
+
+
+def temperature_summary(gates_schedule, temperature) -> dict:
+    """
+    Summarise the ion temperatures of a schedule.
+
+    Args:
+        gates_schedule (list): A list of gates where each gate is represented as a tuple.
+        temperature (list): The temperature of each ion at each step.
+
+    Returns:
+        dict: The final temperature of each ion, the highest temperature reached and
+        the highest average temperature of the two ions of an MS gate.
+    """
+    max_ms_temperature = 0.0
+    for i, step in enumerate(gates_schedule):
+        for gate in step:
+            if gate[0] == "MS":
+                temp = temperature[i]
+                average_temp = (temp[gate[2][0]] + temp[gate[2][1]]) / 2
+                max_ms_temperature = max(max_ms_temperature, float(average_temp))
+    return {
+        "final_temperature": [float(t) for t in temperature[-1]] if len(temperature) else [],
+        "max_temperature": float(np.max(temperature)) if len(temperature) else 0.0,
+        "max_ms_temperature": max_ms_temperature,
+    }
+
+
+def fidelity(positions_history, gates_schedule, graph, backend="pennylane", max_bond=64, n_wires=DEFAULT_WIRES) -> float:
     """
     Fidelity between the ideal and noisy circuit.
 
     Args:
         positions_history (list): A list of positions of the ions.
         gates_schedule (list): A list of gates where each gate is represented as a tuple.
+        graph (nx.Graph): The graph representing the Penning trap.
+        backend (str): ``"pennylane"`` to simulate on a ``default.mixed`` device,
+            ``"native"`` to use the NumPy density-matrix engine, ``"mps"`` for a
+            matrix product density operator, whose memory grows with the bond
+            dimension instead of ``4**n_wires``, or ``"trajectory"`` for the
+            Monte-Carlo estimate of ``trajectory.trajectory_fidelity``.
+        max_bond (int): The largest bond dimension of the ``"mps"`` backend.
+        n_wires (int): The number of ions (and qubits) of the schedule.
 
     Returns:
-        float: The fidelity of the circuit.
-    """
-    expected_result = circuit()
-    noisy_user_result = compiled_circuit_noisy(
-        gates_schedule, get_temperatures(positions_history, graph)
-    )()
-    noisy_user_fidelity = qml.math.fidelity(expected_result, noisy_user_result)
-    print("Fidelity of the circuit when including noise:", noisy_user_fidelity)
+        float: The fidelity of the circuit, also logged at the INFO level.
+
+    Raises:
+        ValueError: If the positions history does not have ``n_wires`` ions.
+    """
+    temperature = get_temperatures(positions_history, graph)
+    _check_ions(temperature, n_wires)
+    if backend == "trajectory":
+        from trajectory import trajectory_fidelity
+
+        noisy_user_fidelity = trajectory_fidelity(gates_schedule, temperature, n_wires, eps=eps)["fidelity"]
+        logger.info("Fidelity of the circuit when including noise: %s", noisy_user_fidelity)
+        return noisy_user_fidelity
+    if backend == "mps":
+        state = simulate_mps(gates_schedule, n_wires, temperature, max_bond=max_bond, eps=eps)
+        noisy_user_fidelity = qft_fidelity(state)
+        logger.info("Fidelity of the circuit when including noise: %s", noisy_user_fidelity)
+        return noisy_user_fidelity
+    if backend == "pennylane":
+        qnode = compiled_circuit_noisy(gates_schedule, temperature, n_wires)
+        with phase("pennylane_simulation"):
+            noisy_user_result = qnode()
+    elif backend == "native":
+        noisy_user_result = simulate_noisy_native(gates_schedule, temperature, n_wires)
+    else:
+        raise ValueError(f"Unknown backend: {backend}")
+    noisy_user_fidelity = pure_state_fidelity(
+        qft_reference_state(n_wires), np.asarray(noisy_user_result)
+    )
+    logger.info("Fidelity of the circuit when including noise: %s", noisy_user_fidelity)
     return noisy_user_fidelity
+
+
+def fidelity_batch(candidates, graph, n_wires=DEFAULT_WIRES):
+    """
+    Fidelity between the ideal and noisy circuit for many candidate schedules.
+
+    A convenience loop over the candidates with the native engine; they are
+    simulated one after the other, as ``fidelity`` would.
+
+    Args:
+        candidates (list): ``(positions_history, gates_schedule)`` pairs.
+        graph (nx.Graph): The graph representing the Penning trap.
+        n_wires (int): The number of ions of every candidate.
+
+    Returns:
+        tuple: The fidelities as an array and the ``temperature_summary`` of each
+        candidate.
+    """
+    fidelities, summaries = [], []
+    for positions_history, gates_schedule in candidates:
+        temperature = get_temperatures(positions_history, graph)
+        _check_ions(temperature, n_wires)
+        rho = simulate_noisy_native(gates_schedule, temperature, n_wires)
+        fidelities.append(pure_state_fidelity(qft_reference_state(n_wires), rho))
+        summaries.append(temperature_summary(gates_schedule, temperature))
+    return np.array(fidelities, dtype=float), summaries
@@ -0,0 +1,90 @@
+import numpy as np
+
+from statevector import GATE_MATRICES, apply_gate
+
+
+def _embed(block_wires, block, gate, wires):
+    # Multiply a gate on some of the block's wires into the block's matrix.
+    k = len(block_wires)
+    tensor = block.reshape((2,) * k + (2**k,))
+    axes = [block_wires.index(w) for w in wires]
+    return apply_gate(tensor, gate, axes).reshape(2**k, 2**k)
+
+
+def fuse(gates_schedule, temperature=None, max_width=2):
+    """
+    Fuse the noise-free spans of a schedule into dense blocks.
+
+    Gates are collected in open blocks of at most ``max_width`` wires (or the
+    gate's own wires, if more); a gate joins (and merges) the blocks of its
+    wires if they fit, otherwise those blocks are emitted first. Runs of
+    rotations on one wire thus become one 2x2 matrix and gates on a few wires
+    one small unitary. With temperatures every MS gate closes its block and is
+    followed by its depolarizing channel (see
+    ``fidelity.ms_error_probability``); without them the schedule is treated
+    as noiseless. The order of the operations on every wire is kept, so the
+    fused list implements the same channel.
+
+    Args:
+        gates_schedule (list): A list of gates where each gate is represented as a tuple.
+        temperature (np.ndarray): The temperature of each ion at each step, or
+            None for a noiseless schedule.
+        max_width (int): The largest number of wires of a fused block.
+
+    Returns:
+        tuple: The operations ``("U", matrix, wires)`` and
+        ``("DEPOLARIZING", p, wires)`` in order, and a report with the number of
+        ``gates``, fused ``unitaries``, ``channels`` and ``operations``.
+    """
+    if temperature is not None:
+        from fidelity import ms_error_probability
+
+    operations = []
+    blocks = {}  # wire -> [wires, matrix], shared by the wires of a block
+    n_gates = 0
+
+    def flush(block):
+        for w in block[0]:
+            del blocks[w]
+        operations.append(("U", block[1], tuple(block[0])))
+
+    for i, step in enumerate(gates_schedule):
+        for gate in step:
+            if gate[0] not in GATE_MATRICES:
+                continue
+            n_gates += 1
+            wires = (gate[2],) if isinstance(gate[2], (int, np.integer)) else tuple(gate[2])
+            touched = []
+            for w in wires:
+                if w in blocks and not any(blocks[w] is block for block in touched):
+                    touched.append(blocks[w])
+            merged = [w for block in touched for w in block[0]]
+            merged += [w for w in wires if w not in merged]
+            if len(merged) > max(max_width, len(wires)):
+                for block in touched:
+                    flush(block)
+                touched = []
+                merged = list(wires)
+            matrix = np.eye(1, dtype=complex)
+            for block in touched:
+                matrix = np.kron(matrix, block[1])
+            matrix = np.kron(matrix, np.eye(2 ** (len(merged) - sum(len(b[0]) for b in touched))))
+            block = [merged, _embed(merged, matrix, GATE_MATRICES[gate[0]](gate[1]), wires)]
+            for w in merged:
+                blocks[w] = block
+            if temperature is not None and gate[0] == "MS":
+                flush(block)
+                p = ms_error_probability(gate, temperature[i])
+                operations.append(("DEPOLARIZING", p, wires))
+
+    while blocks:
+        flush(next(iter(blocks.values())))
+
+    n_channels = sum(op[0] == "DEPOLARIZING" for op in operations)
+    return operations, {
+        "gates": n_gates,
+        "unitaries": len(operations) - n_channels,
+        "channels": n_channels,
+        "operations": len(operations),
+        "max_width": max_width,
+    }
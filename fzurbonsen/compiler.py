@@ -1,33 +1,31 @@
+import logging
 import sys
 import os
-import networkx as nx
-import matplotlib.pyplot as plt
-import pennylane as qml
-from pennylane import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import numpy as np
 
 # Add the parent directory to the path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 import trap  # Import trap module
-import verifier # Import verifier module
+import router  # Import router module
+import scheduler  # Import scheduler module
+import peephole  # Import peephole module
+import resynthesis  # Import resynthesis module
+import placement  # Import placement module
+
+logger = logging.getLogger(__name__)
 
 n_qubits = 8
 
 n_ = 0.01
 
-dev = qml.device("default.mixed", wires=n_qubits)
-dev0 = qml.device("default.mixed", wires=n_qubits)
-dev1 = qml.device("default.mixed", wires=n_qubits)
-
-gates_schedule = []
-positions_history = []
-time_step = 0  # global time step tracker
+# Router settings for gate lists packed by the scheduler, where the next gate
+# of an ion is further down the list than in program order.
+ROUTER_OPTIONS = {"lookahead": 12, "zone_candidates": 6}
 
-def add_to_schedule(gate_type, param, wires):
-    """Helper function to add gate to the current time step schedule."""
-    while len(gates_schedule) <= time_step:
-        gates_schedule.append([])  # Ensure enough time slots
-    gates_schedule[time_step].append((gate_type, param, wires))
 
 def build_ms_gate(theta):
     I = np.eye(2)
@@ -35,105 +33,331 @@ def build_ms_gate(theta):
     XX = np.kron(X, X)
     return np.cos(theta / 2) * np.eye(4) - 1j * np.sin(theta / 2) * XX
 
-def apply_ms_gate(wire1, wire2, theta):
-    U = build_ms_gate(theta)
-    qml.QubitUnitary(U, wires=[wire1, wire2])
-    print(f"MS, {theta/np.pi}*pi, [{wire1}, {wire2}]")
-    add_to_schedule("MS", theta, (wire1, wire2))
-
-def apply_rx_gate(wire, theta):
-    qml.RX(theta, wires=wire)
-    print(f"RX, {theta/np.pi}*pi, {wire}")
-    add_to_schedule("RX", theta, wire)
-
-def apply_ry_gate(wire, theta):
-    qml.RY(theta, wires=wire)
-    print(f"RY, {theta/np.pi}*pi, {wire}")
-    add_to_schedule("RY", theta, wire)
-
-def apply_hadamard_approx(wire):
-    print("H:")
-    apply_ry_gate(wire, np.pi/2)
-    apply_rx_gate(wire, np.pi)
-    print("\n")
-
-def apply_isingXX_gate(control, target, theta):
-    apply_ry_gate(target, -np.pi/2)
-    apply_ry_gate(control, -np.pi/2)
-    apply_ms_gate(control, target, theta)
-    apply_ry_gate(target, np.pi/2)
-    apply_ry_gate(control, np.pi/2)
-
-def apply_cnot_approx(control, target):
-    apply_ry_gate(control, np.pi/2)
-    # apply_ms_gate(control, target, np.pi/4*n_)
-    qml.IsingXX(np.pi/2*n_, wires=[control, target])
-    # apply_isingXX_gate(control, target, np.pi/4*n_)
-    apply_rx_gate(target, -np.pi/2*n_)
-    apply_rx_gate(control, -np.pi/2*n_)
-    apply_ry_gate(control, -np.pi/2)
-
-def apply_rz_approx(wire, theta):
-    apply_ry_gate(wire, np.pi/2)
-    apply_rx_gate(wire, theta)
-    apply_ry_gate(wire, -np.pi/2)
-
-def apply_controlled_phase(control, target, angle):
-    print(f"P, {angle/np.pi}*pi, {target}, {control}")
-    apply_ry_gate(control, -np.pi/2)
-    apply_ry_gate(target, -np.pi/2*n_)
-
-    apply_ms_gate(control, target, np.pi/4*n_)
-    apply_rx_gate(target, -angle/2*n_)
-    apply_ms_gate(control, target, -np.pi/4*n_)
-
-    apply_ry_gate(control, np.pi/2)
-    apply_ry_gate(target, np.pi/2*n_)
-
-    # apply_ry_gate(control, -np.pi/2)
-    # apply_ry_gate(target, np.pi/2)
-    # apply_rx_gate(control, -np.pi/2)
-    # apply_rx_gate(target, np.pi/2)
-    # apply_ms_gate(target, control, angle/4)
-    # apply_ry_gate(control, np.pi/2)
-    # apply_ry_gate(target, -np.pi/2)
-
-    # apply_ry_gate(control, -np.pi/2)
-    # apply_ry_gate(target, -np.pi/2)
-    # apply_ms_gate(control, target, np.pi/4)        # Entangle
-    # apply_rx_gate(target, -angle / 2)              # Apply phase on target
-    # apply_ms_gate(control, target, -np.pi/4)       # Undo entanglement
-    # apply_ry_gate(control, np.pi/2)
-    # apply_ry_gate(target, np.pi/2)
-
-    # apply_cnot_approx(control, target)
-    # apply_rz_approx(target, angle)
-    # apply_cnot_approx(control, target)
-
-    # qml.ControlledPhaseShift(angle, wires=[control, target])
-    print("\n")
-
-@qml.qnode(dev0)
-def qft_circuit():
-    global time_step
-
-    for target in range(n_qubits):
-        apply_hadamard_approx(target)
-
-        time_step += 1
-
-        for control in range(target + 1, n_qubits):
-            angle = np.pi/ (2 ** (control - target))
-            apply_controlled_phase(control, target, angle)
-
-        time_step += 1
-    
-    return qml.density_matrix(wires=range(n_qubits))
-
-@qml.qnode(device=dev1)
-def qft_bench():
-    qml.QFT(wires=range(n_qubits))
-    return qml.density_matrix(wires=range(n_qubits))
+
+class Compiler:
+    """
+    Compile QFT(n_qubits) to RX, RY and MS gates and route it on the trap.
+
+    Every instance holds its own gate list and time step, so several
+    compilations can run in one process or in parallel processes.
+
+    Args:
+        n_qubits (int): The number of qubits of the QFT.
+        graph (networkx.Graph): The trap graph from ``trap.create_trap_graph``,
+            the default trap if None.
+        schedule_mode (str): How ``scheduler.schedule`` packs the gates before
+            routing, ``"asap"`` or ``"alap"``; None routes them in program order.
+        optimize (bool): Run ``peephole.optimize`` on the gates before
+            scheduling; its report is kept in ``self.report``.
+        max_order (int): Approximate QFT: only controlled phases by
+            ``pi / 2**k`` with ``k <= max_order`` are emitted; None keeps all.
+        place (bool): Choose the starting nodes and MS zones with
+            ``placement.optimize_placement`` (in this process); the result is
+            kept in ``self.placement``.
+        **router_options: Passed on to ``router.Router``, on top of
+            ``ROUTER_OPTIONS``.
+    """
+
+    def __init__(
+        self,
+        n_qubits=n_qubits,
+        graph=None,
+        schedule_mode="asap",
+        optimize=True,
+        max_order=None,
+        place=False,
+        **router_options,
+    ):
+        self.n_qubits = n_qubits
+        self.graph = graph if graph is not None else trap.create_trap_graph()
+        self.layout = trap.layout_of(self.graph)
+        if self.layout is None:
+            raise ValueError("The graph must be created by trap.create_trap_graph.")
+        self.schedule_mode = schedule_mode
+        self.optimize = optimize
+        self.max_order = max_order
+        self.place = place
+        self.placement = None
+        self.report = None
+        self.router_options = {**ROUTER_OPTIONS, **router_options}
+        self.reset()
+
+    def reset(self):
+        """Forget all gates added so far."""
+        self.gates_schedule = []
+        self.time_step = 0  # time step tracker
+
+    def add_to_schedule(self, gate_type, param, wires):
+        """Helper function to add gate to the current time step schedule."""
+        while len(self.gates_schedule) <= self.time_step:
+            self.gates_schedule.append([])  # Ensure enough time slots
+        self.gates_schedule[self.time_step].append((gate_type, param, wires))
+
+    def apply_ms_gate(self, wire1, wire2, theta):
+        logger.debug("MS, %s*pi, [%s, %s]", theta / np.pi, wire1, wire2)
+        self.add_to_schedule("MS", theta, (wire1, wire2))
+
+    def apply_rx_gate(self, wire, theta):
+        logger.debug("RX, %s*pi, %s", theta / np.pi, wire)
+        self.add_to_schedule("RX", theta, wire)
+
+    def apply_ry_gate(self, wire, theta):
+        logger.debug("RY, %s*pi, %s", theta / np.pi, wire)
+        self.add_to_schedule("RY", theta, wire)
+
+    def apply_hadamard_approx(self, wire):
+        logger.debug("H:")
+        self.apply_ry_gate(wire, np.pi/2)
+        self.apply_rx_gate(wire, np.pi)
+
+    def apply_isingXX_gate(self, control, target, theta):
+        self.apply_ry_gate(target, -np.pi/2)
+        self.apply_ry_gate(control, -np.pi/2)
+        self.apply_ms_gate(control, target, theta)
+        self.apply_ry_gate(target, np.pi/2)
+        self.apply_ry_gate(control, np.pi/2)
+
+    def apply_cnot_approx(self, control, target):
+        self.apply_ry_gate(control, np.pi/2)
+        self.apply_ms_gate(control, target, np.pi/2*n_)
+        self.apply_rx_gate(target, -np.pi/2*n_)
+        self.apply_rx_gate(control, -np.pi/2*n_)
+        self.apply_ry_gate(control, -np.pi/2)
+
+    def apply_rz_approx(self, wire, theta):
+        self.apply_ry_gate(wire, np.pi/2)
+        self.apply_rx_gate(wire, theta)
+        self.apply_ry_gate(wire, -np.pi/2)
+
+    def apply_controlled_phase(self, control, target, angle):
+        logger.debug("P, %s*pi, %s, %s", angle / np.pi, target, control)
+        # One MS gate, see resynthesis.controlled_phase_template
+        for name, theta, wires in resynthesis.controlled_phase(control, target, angle):
+            if name == "MS":
+                self.apply_ms_gate(*wires, theta)
+            elif name == "RX":
+                self.apply_rx_gate(wires, theta)
+            else:
+                self.apply_ry_gate(wires, theta)
+
+    def qft(self):
+        """
+        Add the gates of QFT(n_qubits), or of the approximate QFT if
+        ``max_order`` is set.
+
+        Returns:
+            list: The gates grouped by logical time step.
+        """
+        for target in range(self.n_qubits):
+            self.apply_hadamard_approx(target)
+
+            self.time_step += 1
+
+            for control in range(target + 1, self.n_qubits):
+                if self.max_order is not None and control - target > self.max_order:
+                    continue
+                angle = np.pi/ (2 ** (control - target))
+                self.apply_controlled_phase(control, target, angle)
+
+            self.time_step += 1
+
+        return self.gates_schedule
+
+    def schedule(self):
+        """
+        Optimise the gates added so far and pack them into parallel time steps.
+
+        Returns:
+            list: The ``gates_schedule`` from ``scheduler.schedule``, or one gate
+            per step in program order if ``schedule_mode`` is None.
+        """
+        operations = router.flatten(self.gates_schedule)
+        if self.optimize:
+            operations, self.report = peephole.optimize(operations)
+            logger.debug("Peephole: %s", self.report)
+        if self.schedule_mode is None:
+            return [[gate] for gate in operations]
+        return scheduler.schedule(operations, mode=self.schedule_mode)
+
+    def compile(self, initial_positions=None, seed=None):
+        """
+        Compile the QFT and route it on the trap.
+
+        Args:
+            initial_positions (list): The starting node of every ion.
+            seed (int): Draws random starting nodes among the parking nodes when
+                ``initial_positions`` is None; None or 0 keeps the default ones.
+                With ``place`` it seeds the placement search instead.
+
+        Returns:
+            tuple: ``(positions_history, gates_schedule)``.
+        """
+        self.reset()
+        self.qft()
+        operations = router.flatten(self.schedule())
+        zone_plan = None
+        if self.place and initial_positions is None:
+            self.placement = placement.optimize_placement(
+                operations, self.layout, self.n_qubits, seeds=[seed or 0], max_workers=1
+            )
+            logger.debug("Placement: %s", self.placement)
+            initial_positions = self.placement["initial_positions"]
+            zone_plan = self.placement["zone_plan"]
+        elif initial_positions is None and seed:
+            initial_positions = random_placement(self.layout, self.n_qubits, seed)
+        return router.Router(self.layout, n_ions=self.n_qubits, **self.router_options).route(
+            operations, initial_positions, zone_plan
+        )
+
+
+def random_placement(layout, n_ions, seed):
+    """Return ``n_ions`` distinct parking nodes drawn at random with ``seed``."""
+    rng = np.random.default_rng(seed)
+    parking = router.parking_nodes(layout)
+    return [layout.nodes[k] for k in rng.choice(parking, size=n_ions, replace=False)]
+
+
+def compile_and_score(seed, n_qubits=n_qubits, router_options=None):
+    """
+    Compile with one seed, check the result and score it.
+
+    Args:
+        seed (int): The seed passed to ``Compiler.compile``.
+        n_qubits (int): The number of qubits of the QFT.
+        router_options (dict): Passed on to ``router.Router``.
+
+    Returns:
+        tuple: ``(fidelity, seed, positions_history, gates_schedule)``; the
+        fidelity is None if the schedule breaks a trap rule.
+    """
+    from fidelity import fidelity_batch
+    from structural import verify_structure
+
+    graph = trap.create_trap_graph()
+    compiler = Compiler(n_qubits, graph, **(router_options or {}))
+    positions_history, gates_schedule = compiler.compile(seed=seed)
+    try:
+        verify_structure(positions_history, gates_schedule, graph, n_wires=n_qubits)
+    except ValueError:
+        return None, seed, positions_history, gates_schedule
+    fidelities, _ = fidelity_batch([(positions_history, gates_schedule)], graph, n_wires=n_qubits)
+    return float(fidelities[0]), seed, positions_history, gates_schedule
+
+
+def multi_start(seeds, n_qubits=n_qubits, max_workers=None, **router_options):
+    """
+    Compile with many seeds in parallel processes and keep the best result.
+
+    Every candidate is checked against the trap rules and scored with the noisy
+    fidelity in its worker, so only the winner is sent back in full.
+
+    Args:
+        seeds (iterable): The seeds to try, see ``Compiler.compile``.
+        n_qubits (int): The number of qubits of the QFT.
+        max_workers (int): The number of processes, all cores if None.
+        **router_options: Passed on to ``router.Router``.
+
+    Returns:
+        tuple: ``(fidelity, seed, positions_history, gates_schedule)`` of the
+        best candidate.
+    """
+    seeds = list(seeds)
+    workers = max_workers or os.cpu_count() or 1
+    chunksize = max(1, len(seeds) // (4 * workers))
+    best = None
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(
+            _best_of_chunk,
+            _chunks(seeds, chunksize),
+            repeat(n_qubits),
+            repeat(router_options),
+        )
+        for result in results:
+            if result is not None and (best is None or result[0] > best[0]):
+                best = result
+    if best is None:
+        raise ValueError("No seed produced a valid schedule.")
+    return best
+
+
+def _chunks(seeds, size):
+    for start in range(0, len(seeds), size):
+        yield seeds[start : start + size]
+
+
+def _best_of_chunk(seeds, n_qubits, router_options):
+    best = None
+    for seed in seeds:
+        result = compile_and_score(seed, n_qubits, router_options)
+        if result[0] is not None and (best is None or result[0] > best[0]):
+            best = result
+    return best
+
+
+def unitary_fidelity(operations, reference, n_qubits=n_qubits):
+    """
+    Overlap ``|Tr(U^dagger V)|^2 / d^2`` of the unitaries of two gate lists.
+
+    Args:
+        operations (list): The gates ``(name, angle, wires)`` of ``V``.
+        reference (list): The gates of ``U``.
+        n_qubits (int): The number of wires.
+
+    Returns:
+        float: 1 for equal unitaries up to a global phase.
+    """
+    wires = tuple(range(n_qubits))
+    u = peephole.local_unitary(reference, wires)
+    v = peephole.local_unitary(operations, wires)
+    return float(abs(np.trace(u.conj().T @ v)) ** 2 / 4**n_qubits)
+
+
+def sweep_cutoffs(cutoffs=None, n_qubits=n_qubits, **options):
+    """
+    Compile the approximate QFT for several cutoffs and score each one.
+
+    Every cutoff is checked with ``verify_structure`` and scored with the noisy
+    ``fidelity.fidelity`` (native backend). On |0...0> all controlled phases act
+    trivially, so that fidelity alone always favours dropping them; the
+    ``unitary_fidelity`` against the full QFT measures what is lost on other
+    inputs, and the best operating point maximises the product of the two.
+
+    Args:
+        cutoffs (iterable): The ``max_order`` values, 0 to ``n_qubits - 1`` if
+            None.
+        n_qubits (int): The number of qubits of the QFT.
+        **options: Passed on to ``Compiler``.
+
+    Returns:
+        tuple: One dict per cutoff with ``max_order``, ``fidelity``,
+        ``unitary_fidelity``, ``score``, ``steps`` and ``ms_gates``, and the
+        dict of the best cutoff.
+    """
+    from fidelity import fidelity
+    from structural import verify_structure
+
+    if cutoffs is None:
+        cutoffs = range(n_qubits)
+    reference = router.flatten(Compiler(n_qubits, optimize=False, **options).qft())
+    rows = []
+    for max_order in cutoffs:
+        compiler = Compiler(n_qubits, max_order=max_order, **options)
+        positions_history, gates_schedule = compiler.compile()
+        verify_structure(positions_history, gates_schedule, compiler.graph, n_wires=n_qubits)
+        noisy = float(fidelity(positions_history, gates_schedule, compiler.graph, backend="native", n_wires=n_qubits))
+        exact = unitary_fidelity(router.flatten(gates_schedule), reference, n_qubits)
+        rows.append(
+            {
+                "max_order": max_order,
+                "fidelity": noisy,
+                "unitary_fidelity": exact,
+                "score": noisy * exact,
+                "steps": len(positions_history),
+                "ms_gates": sum(gate[0] == "MS" for step in gates_schedule for gate in step),
+            }
+        )
+    return rows, max(rows, key=lambda row: row["score"])
+
 
 def print_gate_schedule(schedule):
     print("Gate Schedule:\n")
@@ -150,53 +374,66 @@ def print_gate_schedule(schedule):
     print()
 
 
-# Run and get final state
-# state = qft_like_circuit()
-np.set_printoptions(linewidth=200, precision=5, suppress=True)
-state = qft_circuit()
-# print(state)
-# print("Quantum state after approximate QFT with RX, RY, MS:", state)
+if __name__ == "__main__":
+    import pennylane as qml
+
+    import verifier  # Import verifier module
 
-# print(qml.density_matrix(wires=range(8)))
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
 
-bench = qft_bench()
-# print(bench)
+    dev1 = qml.device("default.mixed", wires=n_qubits)
 
-np.set_printoptions(threshold=np.inf, linewidth=np.inf, precision=5, suppress=True)
+    @qml.qnode(device=dev1)
+    def qft_bench():
+        qml.QFT(wires=range(n_qubits))
+        return qml.density_matrix(wires=range(n_qubits))
 
+    np.set_printoptions(linewidth=200, precision=5, suppress=True)
 
-# with open("qft_output.txt", "w") as f:
-#     f.write("State (Custom QFT Approx):\n")
-#     f.write(str(state) + "\n\n")
-    
-#     f.write("Bench (qml.QFT):\n")
-#     f.write(str(bench) + "\n\n")
+    compiler = Compiler()
+    logger.setLevel(logging.DEBUG)  # log every gate this compiler adds
+    state = verifier.compiled_circuit(compiler.qft())()
+    bench = qft_bench()
 
-np.set_printoptions(threshold=200, linewidth=200, precision=5, suppress=True)
-    
+    print("Max difference:", np.max(np.abs(state - bench)))
+    print("Are they close?", np.allclose(state, bench, atol=1e-3))
+    print("Fidelity: ", np.abs(np.vdot(state, bench)))
 
-print("Max difference:", np.max(np.abs(state - bench)))
-print("Are they close?", np.allclose(state, bench, atol=1e-3))
-print("Fidelity: ", np.abs(np.vdot(state, bench)))
+    diff_matrix = np.abs(state - bench)
+    max_diff_idx = np.unravel_index(np.argmax(diff_matrix), diff_matrix.shape)
+    print(f"Largest difference at index {max_diff_idx}:")
+    print(f"state: {state[max_diff_idx]}")
+    print(f"bench: {bench[max_diff_idx]}")
 
-diff_matrix = np.abs(state - bench)
-max_diff_idx = np.unravel_index(np.argmax(diff_matrix), diff_matrix.shape)
-print(f"Largest difference at index {max_diff_idx}:")
-print(f"state: {state[max_diff_idx]}")
-print(f"bench: {bench[max_diff_idx]}")
+    ms = build_ms_gate(np.pi/4*n_)
 
-ms = build_ms_gate(np.pi/4*n_)
+    print(ms)
 
-print(ms)
+    # Route the ions and schedule the gates on the trap
+    graph = compiler.graph
+    positions_history, gates_schedule = compiler.compile()
+    logger.setLevel(logging.NOTSET)
 
-# print_gate_schedule(gates_schedule)
+    verifier.verifier(positions_history, gates_schedule, graph)
 
-# Create the trap graph
-graph = trap.create_trap_graph()
+    # Try other starting placements on all cores and keep the best one
+    score, seed, positions_history, gates_schedule = multi_start(range(4 * (os.cpu_count() or 1)))
+    print(f"Best fidelity {score} with seed {seed}")
 
-print(gates_schedule)
+    # Where the fidelity of the best schedule goes
+    import estimator  # Import estimator module
 
-verifier.verifier(positions_history, gates_schedule, graph)
+    budget = estimator.FidelityEstimator(graph).attribution(positions_history, gates_schedule)
+    print("Estimated fidelity:", budget["fidelity"])
+    for gate in budget["gates"][:5]:
+        print(gate)
+    for segment in budget["segments"][:5]:
+        print(segment)
 
+    # Trade approximation error against noise
+    rows, best = sweep_cutoffs()
+    for row in rows:
+        print(row)
+    print(f"Best cutoff: {best['max_order']}")
 
-print("done")
+    print("done")
@@ -0,0 +1,168 @@
+import os
+import sys
+
+import numpy as np
+
+# Add the parent directory to the path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from density import ms_matrix, rx_matrix, ry_matrix
+import scheduler  # Import scheduler module
+
+# Rotations by a multiple of 4*pi are the identity.
+PERIOD = 4 * np.pi
+
+MATRICES = {"RX": rx_matrix, "RY": ry_matrix, "MS": ms_matrix}
+
+
+def is_identity(angle, atol=1e-12):
+    """Return whether a rotation by ``angle`` is the identity (angle = 0 mod 4*pi)."""
+    r = np.mod(angle, PERIOD)
+    return r < atol or PERIOD - r < atol
+
+
+def local_unitary(gates, wires):
+    """
+    Return the unitary of a short gate list on a few wires.
+
+    Args:
+        gates (list): The gates ``(name, angle, wires)``, all acting on ``wires``.
+        wires (tuple): The wires, the first one being the most significant.
+
+    Returns:
+        np.ndarray: The ``(2**k, 2**k)`` unitary for ``k = len(wires)``.
+    """
+    position = {w: k for k, w in enumerate(wires)}
+    n = len(wires)
+    unitary = np.eye(2**n, dtype=complex)
+    for name, angle, gate_wires in gates:
+        matrix = MATRICES[name](angle)
+        acts = [position[w] for w in scheduler.gate_wires((name, angle, gate_wires))]
+        full = matrix.reshape((2,) * (2 * len(acts)))
+        tensor = unitary.reshape((2,) * n + (2**n,))
+        # Contract the gate's input axes with the wire axes of the unitary.
+        moved = np.tensordot(full, tensor, axes=(list(range(len(acts), 2 * len(acts))), acts))
+        unitary = np.moveaxis(moved, list(range(len(acts))), acts).reshape(2**n, 2**n)
+    return unitary
+
+
+def check_equivalent(old, new, atol=1e-9):
+    """
+    Raise a ValueError unless two gate lists implement the same unitary.
+
+    The lists may only act on one or two wires, so the check is a 2x2 or 4x4
+    matrix comparison.
+    """
+    wires = tuple(sorted({w for gate in old + new for w in scheduler.gate_wires(gate)}))
+    if not np.allclose(local_unitary(old, wires), local_unitary(new, wires), atol=atol):
+        raise ValueError(f"Rewrite is not equivalent: {old} -> {new}")
+
+
+def optimize(operations, check=True):
+    """
+    Merge and cancel rotations in a gate list.
+
+    The pass repeats until nothing changes:
+
+    - adjacent rotations about the same axis on a wire are merged,
+    - rotations by a multiple of 4*pi are dropped,
+    - RX commutes with MS (an XX rotation), so an RX is moved back through MS
+      gates on its wire to merge with an earlier RX, and two MS gates on the
+      same pair that are only separated by RX gates are merged.
+
+    Every rewrite is checked with ``check_equivalent`` on the one or two wires
+    it touches.
+
+    Args:
+        operations (list): The gates ``(name, angle, wires)`` in program order.
+        check (bool): Check every rewrite.
+
+    Returns:
+        tuple: The optimised gate list and a report with the gate counts and the
+        depth (see ``scheduler.schedule``) before and after, and the number of
+        ``merged`` rotations, ``dropped`` identities, RX gates ``commuted``
+        through MS gates and ``ms_merged`` MS gates.
+    """
+    operations = list(operations)
+    report = {"merged": 0, "dropped": 0, "commuted": 0, "ms_merged": 0}
+    optimized = operations
+    while True:
+        optimized, changes = _sweep(optimized, report, check)
+        if not changes:
+            break
+    report.update(
+        gates_before=len(operations),
+        gates_after=len(optimized),
+        ms_before=sum(gate[0] == "MS" for gate in operations),
+        ms_after=sum(gate[0] == "MS" for gate in optimized),
+        depth_before=scheduler.depth(scheduler.schedule(operations)),
+        depth_after=scheduler.depth(scheduler.schedule(optimized)),
+    )
+    return optimized, report
+
+
+def _look_back(out, history, skip):
+    # Index of the last live gate on a wire that is not of kind ``skip``, and
+    # the live ``skip`` gates passed on the way.
+    passed = []
+    for j in reversed(history):
+        gate = out[j]
+        if gate is None:
+            continue
+        if gate[0] == skip:
+            passed.append(j)
+            continue
+        return j, passed
+    return None, passed
+
+
+def _sweep(operations, report, check):
+    out = []
+    history = {}
+    changes = 0
+    for gate in operations:
+        name, angle, wires = gate
+        wires_ = scheduler.gate_wires(gate)
+        if name == "MS":
+            found = [_look_back(out, history.get(w, []), "RX") for w in wires_]
+            j = found[0][0]
+            if (
+                j is not None
+                and out[j][0] == "MS"
+                and all(f[0] == j for f in found)
+                and set(scheduler.gate_wires(out[j])) == set(wires_)
+            ):
+                # MS ... RX ... MS on the same pair: the RX gates commute.
+                between = sorted(set(found[0][1] + found[1][1]))
+                merged = ("MS", out[j][1] + angle, out[j][2])
+                if check:
+                    old = [out[j]] + [out[k] for k in between] + [gate]
+                    check_equivalent(old, [merged] + [out[k] for k in between])
+                out[j] = None if is_identity(merged[1]) else merged
+                report["ms_merged"] += 1
+                report["commuted"] += len(between)
+                report["dropped"] += out[j] is None
+                changes += 1
+                continue
+        else:
+            j, passed = _look_back(out, history.get(wires_[0], []), "MS" if name == "RX" else None)
+            if j is not None and out[j][0] == name:
+                merged = (name, out[j][1] + angle, out[j][2])
+                if check:
+                    for k in passed:
+                        check_equivalent([out[k], gate], [gate, out[k]])
+                    check_equivalent([out[j], gate], [merged])
+                out[j] = None if is_identity(merged[1]) else merged
+                report["merged"] += 1
+                report["commuted"] += len(passed) > 0
+                report["dropped"] += out[j] is None
+                changes += 1
+                continue
+        if is_identity(angle):
+            report["dropped"] += 1
+            changes += 1
+            continue
+        for w in wires_:
+            history.setdefault(w, []).append(len(out))
+        out.append(gate)
+    return [gate for gate in out if gate is not None], changes
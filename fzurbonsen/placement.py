@@ -0,0 +1,195 @@
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import numpy as np
+
+# Add the parent directory to the path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import trap  # Import trap module
+import router  # Import router module
+from fidelity import DWELL_HEAT, MOVE_HEAT, MS_NOISE
+
+
+class PlacementModel:
+    """
+    Predicted shuttling heat of a gate list for given start nodes and zones.
+
+    Every MS gate is modelled as both ions travelling from their start node to
+    the gate's interaction node along a shortest path, dwelling there for the
+    two steps of the gate and travelling back. The temperature of an ion at an
+    MS gate is the heat of its earlier trips plus the way in, and the energy is
+    the sum of the MS depolarizing probabilities at those temperatures.
+
+    Args:
+        operations (list): The gates ``(name, angle, wires)`` in program order.
+        layout (trap.TrapLayout): The trap.
+        n_ions (int): The number of ions.
+    """
+
+    def __init__(self, operations, layout, n_ions=trap.DEFAULT_WIRES):
+        self.layout = layout
+        self.n_ions = n_ions
+        pairs = [gate[2] for gate in operations if gate[0] == "MS"]
+        self.pairs = np.array(pairs, dtype=np.int64).reshape(-1, 2)
+        self.distance = layout.distance
+        self.zones = np.flatnonzero(layout.node_type == trap.INTERACTION)
+        self.nodes = np.array(router.parking_nodes(layout))
+        if len(self.nodes) < n_ions:
+            raise ValueError(f"The trap has {len(self.nodes)} parking nodes for {n_ions} ions.")
+
+    def nearest_zones(self, homes):
+        """Return, for every MS gate, the interaction node closest to both ions."""
+        a, b = self.pairs[:, 0], self.pairs[:, 1]
+        total = self.distance[np.ix_(homes[a], self.zones)] + self.distance[np.ix_(homes[b], self.zones)]
+        return self.zones[np.argmin(total, axis=1)]
+
+    def evaluate(self, homes, zones):
+        """
+        Evaluate a placement.
+
+        Args:
+            homes (np.ndarray): The start node id of every ion.
+            zones (np.ndarray): The interaction node id of every MS gate.
+
+        Returns:
+            dict: The ``energy``, the total ``distance`` in moves and the
+            ``peak_ms_temperature`` (pair average) the model predicts.
+        """
+        n_ms = len(self.pairs)
+        if n_ms == 0:
+            return {"energy": 0.0, "distance": 0, "peak_ms_temperature": 0.0}
+        a, b = self.pairs[:, 0], self.pairs[:, 1]
+        way_a = self.distance[homes[a], zones]
+        way_b = self.distance[homes[b], zones]
+        heat = np.zeros((n_ms, self.n_ions))
+        rows = np.arange(n_ms)
+        heat[rows, a] = 2 * MOVE_HEAT * way_a + 2 * DWELL_HEAT
+        heat[rows, b] = 2 * MOVE_HEAT * way_b + 2 * DWELL_HEAT
+        before = np.cumsum(heat, axis=0) - heat
+        temperature = (
+            before[rows, a] + MOVE_HEAT * way_a + before[rows, b] + MOVE_HEAT * way_b
+        ) / 2
+        return {
+            "energy": float(np.sum(MS_NOISE * temperature * (2 * temperature + 1))),
+            "distance": int(2 * (way_a.sum() + way_b.sum())),
+            "peak_ms_temperature": float(temperature.max()),
+        }
+
+
+def anneal(operations, layout=None, n_ions=trap.DEFAULT_WIRES, seed=0, steps=4000, start_temperature=None):
+    """
+    Simulated annealing over start nodes and zone assignments.
+
+    A step swaps the start nodes of two ions, moves an ion to a free parking
+    node or reassigns the interaction node of one MS gate. Seed 0 starts from
+    the first parking nodes, other seeds from a random placement; zones start
+    at the nearest ones.
+
+    Args:
+        operations (list): The gates ``(name, angle, wires)`` in program order.
+        layout (trap.TrapLayout): The trap, the default trap if None.
+        n_ions (int): The number of ions.
+        seed (int): The random seed.
+        steps (int): The number of annealing steps.
+        start_temperature (float): The initial annealing temperature, a tenth
+            of the initial energy if None; it decays geometrically to 1e-3 of it.
+
+    Returns:
+        dict: The best placement, see ``placement_result``.
+    """
+    layout = layout if layout is not None else trap.get_trap_layout()
+    model = PlacementModel(operations, layout, n_ions)
+    rng = np.random.default_rng(seed)
+    if seed:
+        homes = rng.choice(model.nodes, size=n_ions, replace=False)
+    else:
+        homes = model.nodes[:n_ions].copy()
+    zones = model.nearest_zones(homes)
+    energy = model.evaluate(homes, zones)["energy"]
+    best = (energy, homes.copy(), zones.copy())
+    n_ms = len(model.pairs)
+    if start_temperature is None:
+        start_temperature = max(energy / 10, 1e-12)
+    decay = 1e-3 ** (1 / max(steps, 1))
+    temperature = start_temperature
+
+    for _ in range(steps):
+        new_homes, new_zones = homes.copy(), zones.copy()
+        move = rng.random()
+        if move < 0.4 or n_ms == 0:
+            i, j = rng.choice(n_ions, size=2, replace=False)
+            new_homes[[i, j]] = new_homes[[j, i]]
+        elif move < 0.6:
+            free = np.setdiff1d(model.nodes, homes)
+            if len(free) == 0:
+                continue
+            new_homes[rng.integers(n_ions)] = rng.choice(free)
+        else:
+            new_zones[rng.integers(n_ms)] = rng.choice(model.zones)
+        new_energy = model.evaluate(new_homes, new_zones)["energy"]
+        if new_energy <= energy or rng.random() < np.exp((energy - new_energy) / temperature):
+            homes, zones, energy = new_homes, new_zones, new_energy
+            if energy < best[0]:
+                best = (energy, homes.copy(), zones.copy())
+        temperature *= decay
+
+    return placement_result(model, best[1], best[2], seed)
+
+
+def placement_result(model, homes, zones, seed=None):
+    """
+    Package a placement for the router.
+
+    Returns:
+        dict: ``initial_positions`` (the node of every ion, i.e.
+        ``positions_history[0]``), ``zone_plan`` (the interaction node of every
+        MS gate in program order), the ``seed`` and the ``PlacementModel.evaluate``
+        figures.
+    """
+    nodes = model.layout.nodes
+    return {
+        "initial_positions": [nodes[k] for k in homes],
+        "zone_plan": [nodes[k] for k in zones],
+        "seed": seed,
+        **model.evaluate(homes, zones),
+    }
+
+
+def optimize_placement(
+    operations, layout=None, n_ions=trap.DEFAULT_WIRES, seeds=range(8), max_workers=None, steps=4000
+):
+    """
+    Run ``anneal`` from several seeds in parallel processes and keep the best.
+
+    Args:
+        operations (list): The gates ``(name, angle, wires)`` in program order.
+        layout (trap.TrapLayout): The trap, the default trap if None.
+        n_ions (int): The number of ions.
+        seeds (iterable): The seeds of the runs.
+        max_workers (int): The number of processes, all cores if None; 1 runs
+            in this process.
+        steps (int): The number of annealing steps per run.
+
+    Returns:
+        dict: The placement with the lowest energy, see ``placement_result``.
+    """
+    layout = layout if layout is not None else trap.get_trap_layout()
+    seeds = list(seeds)
+    if max_workers == 1:
+        results = [anneal(operations, layout, n_ions, seed, steps) for seed in seeds]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            results = list(
+                pool.map(
+                    anneal,
+                    repeat(operations),
+                    repeat(layout),
+                    repeat(n_ions),
+                    seeds,
+                    repeat(steps),
+                )
+            )
+    return min(results, key=lambda result: result["energy"])
@@ -0,0 +1,121 @@
+from functools import lru_cache
+
+import numpy as np
+
+
+def controlled_phase_matrix(angle):
+    """Return ``diag(1, 1, 1, exp(i angle))``, the controlled phase shift."""
+    return np.diag([1, 1, 1, np.exp(1j * angle)])
+
+
+@lru_cache(maxsize=None)
+def controlled_phase_template(angle):
+    """
+    Return an RX/RY/MS sequence for a controlled phase with the fewest MS gates.
+
+    ``CP(angle) = exp(i angle / 4) RZ(angle / 2) RZ(angle / 2) ZZ(-angle / 2)``
+    and ``ZZ`` is ``XX`` conjugated by ``RY(pi / 2)`` on both wires, so up to a
+    global phase one MS gate suffices; turned into the ``RY(pi / 2)`` frame the
+    ``RZ`` rotations become ``RX`` rotations. An angle that is a multiple of
+    2*pi needs no gates at all.
+
+    Sequences are cached per angle, with the wires 0 (control) and 1 (target).
+
+    Args:
+        angle (float): The phase.
+
+    Returns:
+        tuple: The gates ``(name, angle, wires)``.
+    """
+    if np.isclose(np.mod(angle + np.pi, 2 * np.pi), np.pi):
+        return ()
+    return (
+        ("RY", np.pi / 2, 0),
+        ("RY", np.pi / 2, 1),
+        ("MS", -angle / 2, (0, 1)),
+        ("RX", angle / 2, 0),
+        ("RX", angle / 2, 1),
+        ("RY", -np.pi / 2, 0),
+        ("RY", -np.pi / 2, 1),
+    )
+
+
+def controlled_phase(control, target, angle):
+    """Return the gates of ``controlled_phase_template`` on the given wires."""
+    wires = (control, target)
+    return [
+        (name, theta, tuple(wires[w] for w in gate_wires) if name == "MS" else wires[gate_wires])
+        for name, theta, gate_wires in controlled_phase_template(float(angle))
+    ]
+
+
+def _batched(name, angles):
+    # (B, 2, 2) or (B, 4, 4) matrices of one gate kind for many angles.
+    c, s = np.cos(angles / 2), np.sin(angles / 2)
+    if name == "RX":
+        return np.stack([np.stack([c, -1j * s], -1), np.stack([-1j * s, c], -1)], -2)
+    if name == "RY":
+        return np.stack([np.stack([c, -s], -1), np.stack([s, c], -1)], -2).astype(complex)
+    out = np.zeros(angles.shape + (4, 4), dtype=complex)
+    out[:, [0, 1, 2, 3], [0, 1, 2, 3]] = c[:, None]
+    out[:, [0, 1, 2, 3], [3, 2, 1, 0]] = -1j * s[:, None]
+    return out
+
+
+def sequence_unitaries(angles, template=controlled_phase_template):
+    """
+    Return the 4x4 unitaries of the sequences for many angles at once.
+
+    All angles must give sequences of the same shape (the non-trivial ones of
+    ``controlled_phase_template`` do); every gate is built for the whole batch
+    and multiplied in with one einsum.
+
+    Args:
+        angles (np.ndarray): The phases.
+        template (callable): Maps an angle to its gate sequence on wires 0 and 1.
+
+    Returns:
+        np.ndarray: The unitaries, shape ``(len(angles), 4, 4)``.
+    """
+    angles = np.asarray(angles, dtype=float)
+    sequences = [template(float(angle)) for angle in angles]
+    unitary = np.broadcast_to(np.eye(4, dtype=complex), angles.shape + (4, 4)).copy()
+    eye = np.eye(2)
+    for k, gate in enumerate(sequences[0]):
+        name, wires = gate[0], gate[2]
+        matrices = _batched(name, np.array([seq[k][1] for seq in sequences]))
+        if name != "MS":
+            pair = (matrices, eye) if wires == 0 else (eye, matrices)
+            matrices = np.einsum("...ij,...kl->...ikjl", *pair).reshape(angles.shape + (4, 4))
+        unitary = np.einsum("...ij,...jk->...ik", matrices, unitary)
+    return unitary
+
+
+def check_controlled_phases(angles, atol=1e-9):
+    """
+    Check the synthesised sequences of many angles against the controlled phase.
+
+    The sequences are compared up to a global phase.
+
+    Args:
+        angles (np.ndarray): The phases; multiples of 2*pi are skipped, their
+            sequence is empty.
+        atol (float): The tolerance.
+
+    Returns:
+        np.ndarray: Whether each angle's sequence is correct.
+    """
+    angles = np.asarray(angles, dtype=float)
+    ok = np.ones(angles.shape, dtype=bool)
+    trivial = np.array([not controlled_phase_template(float(a)) for a in angles], dtype=bool)
+    active = angles[~trivial]
+    if active.size:
+        unitary = sequence_unitaries(active)
+        target = np.zeros(active.shape + (4, 4), dtype=complex)
+        target[:, [0, 1, 2], [0, 1, 2]] = 1
+        target[:, 3, 3] = np.exp(1j * active)
+        # Global phase from the overlap, then an elementwise comparison.
+        phase = np.einsum("...ij,...ij->...", target.conj(), unitary) / 4
+        close = np.abs(unitary - phase[:, None, None] * target).max(axis=(1, 2)) <= atol
+        ok[~trivial] = close & np.isclose(np.abs(phase), 1, atol=atol)
+    return ok
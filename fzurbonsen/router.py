@@ -0,0 +1,551 @@
+import heapq
+import os
+import sys
+
+import numpy as np
+
+# Add the parent directory to the path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import trap  # Import trap module
+
+# Temperature increments per step, in units of 0.01.
+MOVE_COST = 3
+STAY_IDLE_COST = 1
+STAY_COST = 2
+
+
+def flatten(gates_schedule):
+    """Return the gates of a schedule as one list, in execution order."""
+    return [gate for step in gates_schedule for gate in step]
+
+
+def parking_nodes(layout):
+    """
+    Choose the idle nodes ions park at between operations.
+
+    An ion parked at an idle node blocks the standard node below it. Idle nodes
+    are taken closest to an interaction node first, as long as every blocked
+    standard node still has a free neighbour and the free standard and
+    interaction nodes stay connected, so parked ions never cut the trap.
+
+    Args:
+        layout (trap.TrapLayout): The trap.
+
+    Returns:
+        list: The ids of the parking nodes, best first.
+    """
+    interaction = np.flatnonzero(layout.node_type == trap.INTERACTION)
+    idle = np.flatnonzero(layout.node_type == trap.IDLE)
+    closeness = layout.distance[np.ix_(layout.partner[idle], interaction)].min(axis=1)
+    free = layout.node_type != trap.IDLE
+    chosen = []
+    for k in idle[np.argsort(closeness, kind="stable")]:
+        below = layout.partner[k]
+        free[below] = False
+        blocked = [layout.partner[p] for p in chosen] + [below]
+        if _connected(layout, free) and all(free[layout.neighbors(s)].any() for s in blocked):
+            chosen.append(int(k))
+        else:
+            free[below] = True
+    return chosen
+
+
+def _connected(layout, free):
+    nodes = np.flatnonzero(free)
+    seen = {int(nodes[0])}
+    stack = [int(nodes[0])]
+    while stack:
+        v = stack.pop()
+        for w in layout.neighbors(v):
+            if free[w] and int(w) not in seen:
+                seen.add(int(w))
+                stack.append(int(w))
+    return len(seen) == len(nodes)
+
+
+class Router:
+    """
+    Space-time router that turns a gate list into positions and a gates schedule.
+
+    Operations are planned one at a time in program order, each as early as its
+    ions allow, on the time-expanded trap graph. A reservation table of
+    ``(step, node)`` entries enforces the trap rules against every ion planned
+    so far: no two ions on a node (except the two ions of an MS gate at an
+    interaction node, for exactly the two steps of the gate), no ion on the
+    standard node below an occupied idle node and vice versa, and no two ions
+    exchanging nodes. Paths are found with A* where a step costs the temperature
+    it adds (0.01 idle, 0.02 elsewhere, 0.03 for a move), and the interaction
+    node of an MS gate is the one where its two ions arrive coolest.
+
+    Between operations ions return to parking nodes (see ``parking_nodes``),
+    unless their next operation follows within ``lookahead`` operations, in
+    which case they wait where they are. An operation that cannot be planned
+    is rolled back and planned again after every ion has parked and all
+    reservations so far have ended.
+
+    Args:
+        layout (trap.TrapLayout): The trap, the default trap if None.
+        n_ions (int): The number of ions.
+        lookahead (int): How many operations ahead an ion's next operation may be
+            for the ion to wait in place instead of parking.
+        horizon (int): The number of steps a single search may look ahead.
+        zone_candidates (int): The number of interaction nodes, nearest first,
+            tried for every MS gate.
+        slack (int): How many steps before its MS partner is free an ion that
+            waits for it starts moving.
+        meeting_tries (int): How many open steps of an interaction node are
+            tried for an MS gate before moving on to the next node.
+    """
+
+    def __init__(
+        self,
+        layout=None,
+        n_ions=trap.DEFAULT_WIRES,
+        lookahead=3,
+        horizon=64,
+        zone_candidates=3,
+        slack=8,
+        meeting_tries=4,
+    ):
+        self.layout = layout if layout is not None else trap.get_trap_layout()
+        self.n_ions = n_ions
+        self.lookahead = lookahead
+        self.horizon = horizon
+        self.zone_candidates = zone_candidates
+        self.slack = slack
+        self.meeting_tries = meeting_tries
+
+        layout = self.layout
+        self.neighbors = [list(map(int, layout.neighbors(v))) for v in range(layout.n_nodes)]
+        self.partner = layout.partner.tolist()
+        self.is_idle = (layout.node_type == trap.IDLE).tolist()
+        self.is_standard = (layout.node_type == trap.STANDARD).tolist()
+        self.zones = np.flatnonzero(layout.node_type == trap.INTERACTION).tolist()
+        self.parking = parking_nodes(layout)
+        self.distance = layout.distance.tolist()
+        self.is_parking = [v in self.parking for v in range(layout.n_nodes)]
+        self.to_parking = layout.distance[:, self.parking].min(axis=1).tolist()
+        standard = np.flatnonzero(layout.node_type == trap.STANDARD)
+        self.to_standard = layout.distance[:, standard].min(axis=1).tolist()
+
+    def route(self, operations, initial_positions=None, zone_plan=None):
+        """
+        Route a list of gates.
+
+        Args:
+            operations (list): The gates ``(name, angle, wires)`` in program order.
+            initial_positions (list): The starting node of every ion, the first
+                parking nodes if None.
+            zone_plan (list): The interaction node to use for every MS gate, in
+                program order (see ``placement.anneal``); a gate falls back to
+                the nearest nodes if its planned one cannot be reached.
+
+        Returns:
+            tuple: ``(positions_history, gates_schedule)``.
+        """
+        if initial_positions is None:
+            if len(self.parking) < self.n_ions:
+                raise ValueError(
+                    f"The trap has {len(self.parking)} parking nodes for {self.n_ions} ions."
+                )
+            start = self.parking[: self.n_ions]
+        else:
+            start = [self.layout.index[p] for p in initial_positions]
+        self._reset(start)
+        self._zone_plan = {}
+        if zone_plan is not None:
+            ms_gates = [k for k, op in enumerate(operations) if op[0] == "MS"]
+            if len(zone_plan) != len(ms_gates):
+                raise ValueError(
+                    f"The zone plan has {len(zone_plan)} entries for {len(ms_gates)} MS gates."
+                )
+            self._zone_plan = {k: self.layout.index[z] for k, z in zip(ms_gates, zone_plan)}
+
+        wires = [_wires(op) for op in operations]
+        upcoming = [[] for _ in range(self.n_ions)]
+        for k in range(len(operations) - 1, -1, -1):
+            for w in wires[k]:
+                upcoming[w].append(k)
+
+        for k, op in enumerate(operations):
+            for w in wires[k]:
+                upcoming[w].pop()
+            mark = len(self._log)
+            if self._route_operation(k, op, wires[k], upcoming):
+                continue
+            # The operation was squeezed between earlier reservations it cannot
+            # get out of, or ions waiting in place are in the way: park every
+            # ion and plan the operation after all reservations.
+            self._rollback(mark)
+            waiting = list(range(self.n_ions))
+            while waiting:
+                # An ion may be boxed in by ions that still have to park.
+                parked = [ion for ion in waiting if self._park(ion)]
+                if not parked:
+                    raise RuntimeError(f"Could not park ions {waiting} to route operation {k}: {op}")
+                waiting = [ion for ion in waiting if ion not in parked]
+            latest = max(len(path) - 1 for path in self.path)
+            for w in wires[k]:
+                self._wait(w, latest)
+            if not self._route_operation(k, op, wires[k], upcoming):
+                raise RuntimeError(f"Could not route operation {k}: {op}")
+        return self._materialize()
+
+    def _route_operation(self, k, op, wires, upcoming):
+        if op[0] == "MS":
+            planned = self._plan_ms(op, *wires, self._zone_plan.get(k))
+        else:
+            planned = self._plan_single(op, wires[0])
+        if not planned:
+            return False
+        for w in wires:
+            if upcoming[w] and upcoming[w][-1] - k <= self.lookahead and self._hold(w):
+                continue
+            if not self._park(w):
+                return False
+        return True
+
+    def _reset(self, start):
+        self.path = [[v] for v in start]
+        self.heat = [0] * self.n_ions
+        self.occ = {}
+        self.shared = {}
+        self.static = {}
+        self.last_used = [-1] * self.layout.n_nodes
+        self.gates = {}
+        self._log = []
+        for ion, v in enumerate(start):
+            self._reserve(ion, 0, v)
+            self._set_static(v, (ion, 0))
+
+    # Reservation table. Every change is logged so that ``_rollback`` can undo
+    # tentative plans.
+
+    def _reserve(self, ion, t, v):
+        if (t, v) in self.occ:
+            self.shared[(t, v)] = ion
+            self._log.append(("shared", (t, v)))
+        else:
+            self.occ[(t, v)] = ion
+            self._log.append(("occ", (t, v)))
+        if t > self.last_used[v]:
+            self._log.append(("last", v, self.last_used[v]))
+            self.last_used[v] = t
+
+    def _set_static(self, v, held):
+        self._log.append(("static", v, self.static.get(v)))
+        if held is None:
+            self.static.pop(v, None)
+        else:
+            self.static[v] = held
+
+    def _rollback(self, mark):
+        while len(self._log) > mark:
+            entry = self._log.pop()
+            kind = entry[0]
+            if kind == "occ":
+                del self.occ[entry[1]]
+            elif kind == "shared":
+                del self.shared[entry[1]]
+            elif kind == "last":
+                self.last_used[entry[1]] = entry[2]
+            elif kind == "static":
+                if entry[2] is None:
+                    self.static.pop(entry[1], None)
+                else:
+                    self.static[entry[1]] = entry[2]
+            elif kind == "path":
+                _, ion, length, heat = entry
+                del self.path[ion][length:]
+                self.heat[ion] = heat
+            elif kind == "gate":
+                self.gates[entry[1]].pop()
+
+    def _free(self, ion, t, v, share=None):
+        # ``share`` is ``(node, step, partner)``: the MS partner may be on that
+        # node from that step on.
+        ignore = share[2] if share is not None and v == share[0] and t >= share[1] else ion
+        other = self.occ.get((t, v))
+        if other is not None and other != ion and other != ignore:
+            return False
+        if (t, v) in self.shared:
+            return False
+        held = self.static.get(v)
+        if held is not None and held[0] not in (ion, ignore) and held[1] <= t:
+            return False
+        p = self.partner[v]
+        if p >= 0:
+            other = self.occ.get((t, p))
+            if other is not None and other != ion:
+                return False
+            held = self.static.get(p)
+            if held is not None and held[0] != ion and held[1] <= t:
+                return False
+        return True
+
+    def _swap(self, ion, t, u, v):
+        for occupants in (self.occ, self.shared):
+            other = occupants.get((t - 1, v))
+            if other is not None and other != ion and (
+                self.occ.get((t, u)) == other or self.shared.get((t, u)) == other
+            ):
+                return True
+        return False
+
+    def _restable(self, ion, t, v):
+        # The ion may stay at v for every step from t on.
+        held = self.static.get(v)
+        if held is not None and held[0] != ion:
+            return False
+        p = self.partner[v]
+        if p >= 0:
+            held = self.static.get(p)
+            if held is not None and held[0] != ion:
+                return False
+            if any(self.occ.get((s, p), ion) != ion for s in range(t, self.last_used[p] + 1)):
+                return False
+        return all(
+            self.occ.get((s, v), ion) == ion and (s, v) not in self.shared
+            for s in range(t, self.last_used[v] + 1)
+        )
+
+    def _commit(self, ion, path, gate=None, gate_step=None):
+        t0 = len(self.path[ion]) - 1
+        v0 = self.path[ion][-1]
+        self._log.append(("path", ion, t0 + 1, self.heat[ion]))
+        if self.static.get(v0, (None,))[0] == ion:
+            self._set_static(v0, None)
+        u = v0
+        for t, v in enumerate(path, start=t0 + 1):
+            self._reserve(ion, t, v)
+            self.heat[ion] += self._step_cost(u, v)
+            u = v
+        self.path[ion].extend(path)
+        if gate is not None:
+            self.gates.setdefault(gate_step, []).append(gate)
+            self._log.append(("gate", gate_step))
+
+    def _hold(self, ion):
+        v = self.path[ion][-1]
+        t = len(self.path[ion]) - 1
+        if not self._restable(ion, t + 1, v):
+            return False
+        self._set_static(v, (ion, t))
+        return True
+
+    def _wait(self, ion, step):
+        # Extend the plan of a resting ion by staying in place up to ``step``.
+        v = self.path[ion][-1]
+        t = len(self.path[ion]) - 1
+        if step > t:
+            self._commit(ion, [v] * (step - t))
+            self._set_static(v, (ion, step))
+
+    def _park(self, ion):
+        v = self.path[ion][-1]
+        t = len(self.path[ion]) - 1
+        if self.is_parking[v] and self._restable(ion, t + 1, v):
+            self._set_static(v, (ion, t))
+            return True
+        path = self._search(
+            ion,
+            v,
+            t,
+            goal=lambda w, s: self.is_parking[w] and self._restable(ion, s + 1, w),
+            heuristic=lambda w, s: MOVE_COST * self.to_parking[w],
+        )
+        if path is None:
+            return False
+        self._commit(ion, path)
+        self._set_static(path[-1], (ion, len(self.path[ion]) - 1))
+        return True
+
+    # Planning
+
+    def _step_cost(self, u, v):
+        if u != v:
+            return MOVE_COST
+        return STAY_IDLE_COST if self.is_idle[u] else STAY_COST
+
+    def _search(self, ion, start, t0, goal, heuristic, share=None, forbid=None, weights=None):
+        """A* from ``(start, t0)`` to the first ``(node, step)`` satisfying ``goal``."""
+        move, stay_idle, stay = weights or (MOVE_COST, STAY_IDLE_COST, STAY_COST)
+        limit = t0 + self.horizon
+        queue = [(heuristic(start, t0), 0, t0, start)]
+        parent = {(start, t0): None}
+        best = {(start, t0): 0}
+        while queue:
+            _, g, t, v = heapq.heappop(queue)
+            if g > best[(v, t)]:
+                continue
+            if t > t0 and goal(v, t):
+                path = []
+                state = (v, t)
+                while state[1] > t0:
+                    path.append(state[0])
+                    state = parent[state]
+                return path[::-1]
+            if t >= limit:
+                continue
+            s = t + 1
+            for w in [v] + self.neighbors[v]:
+                if forbid is not None and forbid(w, s):
+                    continue
+                if not self._free(ion, s, w, share) or (w != v and self._swap(ion, s, v, w)):
+                    continue
+                cost = g + (move if w != v else (stay_idle if self.is_idle[v] else stay))
+                if cost < best.get((w, s), cost + 1):
+                    best[(w, s)] = cost
+                    parent[(w, s)] = (v, t)
+                    heapq.heappush(queue, (cost + heuristic(w, s), cost, s, w))
+        return None
+
+    def _plan_single(self, op, ion):
+        v = self.path[ion][-1]
+        t = len(self.path[ion]) - 1
+        path = self._search(
+            ion,
+            v,
+            t,
+            goal=lambda w, s: self.is_standard[w],
+            heuristic=lambda w, s: MOVE_COST * self.to_standard[w],
+        )
+        if path is None:
+            return False
+        self._commit(ion, path, op, t + len(path))
+        return True
+
+    def _plan_ms(self, op, a, b, planned=None):
+        # The ion that is free first parks and waits for the other one.
+        ta, tb = len(self.path[a]) - 1, len(self.path[b]) - 1
+        lagging = a if ta < tb else b
+        start = max(ta, tb) - self.slack
+        if start > min(ta, tb):
+            if not self.is_idle[self.path[lagging][-1]] and not self._park(lagging):
+                return False
+            self._wait(lagging, start)
+        ta, tb = len(self.path[a]) - 1, len(self.path[b]) - 1
+        va, vb = self.path[a][-1], self.path[b][-1]
+        nearest = sorted(self.zones, key=lambda z: self.distance[va][z] + self.distance[vb][z])
+        nearest = nearest[: self.zone_candidates]
+        if planned is not None and planned not in nearest:
+            nearest.append(planned)
+        best = None
+        for thorough in (False, True):
+            for z in nearest:
+                plan = self._plan_meeting(a, b, va, vb, ta, tb, z, thorough)
+                if plan is not None and (best is None or plan[0] < best[0]):
+                    best = plan
+            if best is not None:
+                break
+        if best is None:
+            return False
+        _, step, path_a, path_b = best
+        self._commit(a, path_a, op, step)
+        self._commit(b, path_b)
+        return True
+
+    def _plan_meeting(self, a, b, va, vb, ta, tb, z, thorough=False):
+        def zone_open(ion, partner, s):
+            share = (z, 0, partner)
+            return self._free(ion, s, z, share) and self._free(ion, s + 1, z, share)
+
+        def earliest(ion, partner, v, t):
+            # Earliest step the ion can stand on the open zone.
+            path = self._search(
+                ion,
+                v,
+                t,
+                goal=lambda w, s: w == z and zone_open(ion, partner, s),
+                heuristic=lambda w, s: self.distance[w][z],
+                share=(z, 0, partner),
+                weights=(1, 1, 1),
+            )
+            return None if path is None else t + len(path)
+
+        # The distance bound is usually close; when reservations or parked
+        # ions force detours, search for the earliest arrivals instead.
+        if thorough:
+            arrive_a, arrive_b = earliest(a, b, va, ta), earliest(b, a, vb, tb)
+            if arrive_a is None or arrive_b is None:
+                return None
+            first = max(arrive_a, arrive_b)
+        else:
+            first = max(ta + max(self.distance[va][z], 1), tb + max(self.distance[vb][z], 1))
+        tries = 0
+        for step in range(first, first + self.horizon):
+            if not (zone_open(a, b, step) and zone_open(b, a, step)):
+                continue
+            tries += 1
+            if tries > self.meeting_tries:
+                break
+            path_a = self._exact(a, va, ta, z, step, b)
+            if path_a is None:
+                continue
+            path_a.append(z)
+            mark = len(self._log)
+            self._commit(a, path_a)
+            path_b = self._exact(b, vb, tb, z, step, a)
+            self._rollback(mark)
+            if path_b is None:
+                continue
+            path_b.append(z)
+            heat_a = self.heat[a] + self._path_cost(va, path_a[:-1])
+            heat_b = self.heat[b] + self._path_cost(vb, path_b[:-1])
+            return (heat_a + heat_b, step), step, path_a, path_b
+        return None
+
+    def _exact(self, ion, start, t0, z, step, partner):
+        # Reach z exactly at ``step``, sharing it with the partner from then on.
+        if step <= t0:
+            return None
+        return self._search(
+            ion,
+            start,
+            t0,
+            goal=lambda w, s: w == z and s == step,
+            heuristic=lambda w, s: (step - s) + 2 * self.distance[w][z],
+            share=(z, step, partner),
+            forbid=lambda w, s: self.distance[w][z] > step - s,
+        )
+
+    def _path_cost(self, start, path):
+        cost, u = 0, start
+        for v in path:
+            cost += self._step_cost(u, v)
+            u = v
+        return cost
+
+    def _materialize(self):
+        n_steps = max(len(p) for p in self.path)
+        nodes = self.layout.nodes
+        positions_history = [
+            tuple(nodes[p[min(t, len(p) - 1)]] for p in self.path) for t in range(n_steps)
+        ]
+        gates_schedule = [self.gates.get(t, []) for t in range(n_steps)]
+        return positions_history, gates_schedule
+
+
+def _wires(op):
+    return (op[2],) if isinstance(op[2], int) else tuple(op[2])
+
+
+def route(operations, graph=None, initial_positions=None, zone_plan=None, **kwargs):
+    """
+    Route a list of gates on the trap, see ``Router``.
+
+    Args:
+        operations (list): The gates ``(name, angle, wires)`` in program order.
+        graph (networkx.Graph): The trap graph from ``trap.create_trap_graph``,
+            the default trap if None.
+        initial_positions (list): The starting node of every ion.
+        zone_plan (list): The interaction node of every MS gate.
+
+    Returns:
+        tuple: ``(positions_history, gates_schedule)``.
+    """
+    layout = trap.layout_of(graph) if graph is not None else None
+    if graph is not None and layout is None:
+        raise ValueError("The graph must be created by trap.create_trap_graph.")
+    return Router(layout, **kwargs).route(operations, initial_positions, zone_plan)
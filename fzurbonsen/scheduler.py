@@ -0,0 +1,158 @@
+import heapq
+
+# Number of steps an MS gate keeps its ions and interaction node busy.
+MS_DURATION = 2
+N_ZONES = 6
+
+
+def gate_wires(gate):
+    """Return the wires of a gate ``(name, angle, wires)`` as a tuple."""
+    wires = gate[2]
+    return tuple(wires) if isinstance(wires, (tuple, list)) else (wires,)
+
+
+def duration(gate):
+    """Return the number of steps a gate occupies its wires."""
+    return MS_DURATION if gate[0] == "MS" else 1
+
+
+def build_dag(operations):
+    """
+    Build the dependency DAG of a gate list.
+
+    A gate depends on the previous gate on each of its wires.
+
+    Args:
+        operations (list): The gates ``(name, angle, wires)`` in program order.
+
+    Returns:
+        list: The predecessors of every gate, as lists of gate indices.
+    """
+    last = {}
+    predecessors = []
+    for k, gate in enumerate(operations):
+        preds = []
+        for w in gate_wires(gate):
+            if w in last and last[w] not in preds:
+                preds.append(last[w])
+            last[w] = k
+        predecessors.append(preds)
+    return predecessors
+
+
+def critical_path(operations, predecessors):
+    """Return, for every gate, the number of steps from its start to the end of the circuit."""
+    tail = [duration(gate) for gate in operations]
+    for k in range(len(operations) - 1, -1, -1):
+        for p in predecessors[k]:
+            tail[p] = max(tail[p], duration(operations[p]) + tail[k])
+    return tail
+
+
+def list_schedule(operations, predecessors, n_zones=N_ZONES):
+    """
+    Greedy list scheduling with resource constraints.
+
+    At every step the ready gates are started longest critical path first, as
+    long as each of their wires is free for the gate's duration and at most
+    ``n_zones`` MS gates run at once.
+
+    Args:
+        operations (list): The gates ``(name, angle, wires)``.
+        predecessors (list): The dependency DAG from ``build_dag``.
+        n_zones (int): The number of MS gates that may run in parallel.
+
+    Returns:
+        list: The start step of every gate.
+    """
+    n_ops = len(operations)
+    tail = critical_path(operations, predecessors)
+    successors = [[] for _ in range(n_ops)]
+    waiting = [len(preds) for preds in predecessors]
+    for k, preds in enumerate(predecessors):
+        for p in preds:
+            successors[p].append(k)
+    earliest = [0] * n_ops
+    start = [None] * n_ops
+    busy = {}  # wire -> first free step
+    zones = {}  # step -> number of running MS gates
+
+    ready = [(-tail[k], k) for k in range(n_ops) if waiting[k] == 0]
+    heapq.heapify(ready)
+    step = 0
+    scheduled = 0
+    while scheduled < n_ops:
+        deferred = []
+        while ready:
+            entry = heapq.heappop(ready)
+            k = entry[1]
+            gate = operations[k]
+            length = duration(gate)
+            wires = gate_wires(gate)
+            fits = earliest[k] <= step and all(busy.get(w, 0) <= step for w in wires)
+            if fits and gate[0] == "MS":
+                fits = all(zones.get(step + d, 0) < n_zones for d in range(length))
+            if not fits:
+                deferred.append(entry)
+                continue
+            start[k] = step
+            scheduled += 1
+            for w in wires:
+                busy[w] = step + length
+            if gate[0] == "MS":
+                for d in range(length):
+                    zones[step + d] = zones.get(step + d, 0) + 1
+            for s in successors[k]:
+                earliest[s] = max(earliest[s], step + length)
+                waiting[s] -= 1
+                if waiting[s] == 0:
+                    deferred.append((-tail[s], s))
+        for entry in deferred:
+            heapq.heappush(ready, entry)
+        step += 1
+    return start
+
+
+def schedule(operations, n_zones=N_ZONES, mode="asap"):
+    """
+    Pack a gate list into parallel time steps.
+
+    The gates keep their order on every wire; independent gates share steps.
+    Every wire runs at most one gate per step, an MS gate keeps its wires busy
+    for two steps and at most ``n_zones`` MS gates run at once.
+
+    Args:
+        operations (list): The gates ``(name, angle, wires)`` in program order.
+        n_zones (int): The number of interaction zones.
+        mode (str): ``"asap"`` starts every gate as early as possible, ``"alap"``
+            as late as possible, which keeps ions idle until they are needed.
+
+    Returns:
+        list: The ``gates_schedule``, one list of gates per step.
+    """
+    operations = list(operations)
+    if mode == "asap":
+        start = list_schedule(operations, build_dag(operations), n_zones)
+    elif mode == "alap":
+        # Schedule the reversed circuit and mirror it in time.
+        reverse = operations[::-1]
+        end = list_schedule(reverse, build_dag(reverse), n_zones)[::-1]
+        makespan = max((e + duration(g) for e, g in zip(end, operations)), default=0)
+        start = [makespan - e - duration(g) for e, g in zip(end, operations)]
+    else:
+        raise ValueError(f"Unknown scheduling mode: {mode}")
+
+    n_steps = max((s + duration(g) for s, g in zip(start, operations)), default=0)
+    gates_schedule = [[] for _ in range(n_steps)]
+    for k in sorted(range(len(operations)), key=lambda k: (start[k], k)):
+        gates_schedule[start[k]].append(operations[k])
+    return gates_schedule
+
+
+def depth(gates_schedule):
+    """Return the number of steps of a schedule, counting the second step of a final MS gate."""
+    n_steps = 0
+    for t, step in enumerate(gates_schedule):
+        for gate in step:
+            n_steps = max(n_steps, t + duration(gate))
+    return n_steps
@@ -0,0 +1,203 @@
+import numpy as np
+
+from density import ms_matrix, rx_matrix, ry_matrix
+from profiling import instrumented
+from trap import DEFAULT_WIRES
+
+GATE_MATRICES = {"RX": rx_matrix, "RY": ry_matrix, "MS": ms_matrix}
+
+
+class MatrixProductState:
+    """
+    Matrix product state of ``n_sites`` sites of dimension ``local_dim``.
+
+    Site ``k`` is a ``(left bond, local_dim, right bond)`` tensor. The state is
+    kept in mixed canonical form around ``center``, so that the SVD of a
+    two-site update at the center gives the optimal truncation. Gates on two
+    sites that are not neighbours are applied after swapping the second site
+    next to the first and the sites are swapped back afterwards. Every split
+    keeps at most ``max_bond`` singular values larger than ``cutoff`` times the
+    largest; the discarded weight (relative to the norm) is summed in
+    ``truncation_error``.
+
+    With ``local_dim=2`` the state is a pure state vector. With ``local_dim=4``
+    it is a vectorised density matrix (a matrix product density operator), site
+    index ``2 * row + column``, on which gates act as superoperators.
+
+    Args:
+        n_sites (int): The number of sites.
+        local_dim (int): The dimension of a site.
+        max_bond (int): The largest bond dimension, unlimited if None.
+        cutoff (float): The relative singular value cutoff.
+    """
+
+    def __init__(self, n_sites, local_dim=2, max_bond=None, cutoff=1e-12):
+        self.n_sites = n_sites
+        self.local_dim = local_dim
+        self.max_bond = max_bond
+        self.cutoff = cutoff
+        self.truncation_error = 0.0
+        self.center = 0
+        self.tensors = []
+        for _ in range(n_sites):
+            tensor = np.zeros((1, local_dim, 1), dtype=complex)
+            tensor[0, 0, 0] = 1.0
+            self.tensors.append(tensor)
+        d = local_dim
+        self._swap = np.eye(d * d).reshape(d, d, d, d).transpose(0, 1, 3, 2).reshape(d * d, d * d)
+
+    @property
+    def bond_dimensions(self) -> list:
+        """The dimensions of the ``n_sites - 1`` inner bonds."""
+        return [tensor.shape[2] for tensor in self.tensors[:-1]]
+
+    def apply_one(self, matrix, site):
+        """Apply a ``(local_dim, local_dim)`` matrix to one site."""
+        self.tensors[site] = np.einsum("ij,ajb->aib", matrix, self.tensors[site])
+
+    def apply_two(self, matrix, sites):
+        """
+        Apply a ``(local_dim**2, local_dim**2)`` matrix to two sites.
+
+        Args:
+            matrix (np.ndarray): The matrix, acting on ``sites[0]`` as the more
+                significant site.
+            sites (tuple): The two distinct sites.
+        """
+        a, b = sites
+        d = self.local_dim
+        if a > b:
+            matrix = matrix.reshape(d, d, d, d).transpose(1, 0, 3, 2).reshape(d * d, d * d)
+            a, b = b, a
+        for k in range(b - 1, a, -1):
+            self._apply_adjacent(self._swap, k)
+        self._apply_adjacent(matrix, a)
+        for k in range(a + 1, b):
+            self._apply_adjacent(self._swap, k)
+
+    def overlap_product(self, vectors) -> complex:
+        """Return the contraction of the state with one ``local_dim`` vector per site."""
+        environment = np.ones(1, dtype=complex)
+        for vector, tensor in zip(vectors, self.tensors):
+            environment = environment @ np.einsum("j,ajb->ab", vector, tensor)
+        return complex(environment[0])
+
+    def _move_center(self, site):
+        # QR sweeps leaving left-orthonormal tensors to the left of ``site``
+        # and right-orthonormal ones to its right.
+        while self.center < site:
+            k = self.center
+            tensor = self.tensors[k]
+            dl, d, dr = tensor.shape
+            q, r = np.linalg.qr(tensor.reshape(dl * d, dr))
+            self.tensors[k] = q.reshape(dl, d, -1)
+            self.tensors[k + 1] = np.einsum("ab,bjc->ajc", r, self.tensors[k + 1])
+            self.center += 1
+        while self.center > site:
+            k = self.center
+            tensor = self.tensors[k]
+            dl, d, dr = tensor.shape
+            q, r = np.linalg.qr(tensor.reshape(dl, d * dr).T)
+            self.tensors[k] = q.T.reshape(-1, d, dr)
+            self.tensors[k - 1] = np.einsum("ajb,cb->ajc", self.tensors[k - 1], r)
+            self.center -= 1
+
+    def _apply_adjacent(self, matrix, i):
+        d = self.local_dim
+        if self.center not in (i, i + 1):
+            self._move_center(i if self.center < i else i + 1)
+        left, right = self.tensors[i], self.tensors[i + 1]
+        theta = np.einsum("ajb,bkc->ajkc", left, right)
+        dl, dr = theta.shape[0], theta.shape[3]
+        theta = np.einsum("xy,ayc->axc", matrix, theta.reshape(dl, d * d, dr))
+        u, s, vh = np.linalg.svd(theta.reshape(dl * d, d * dr), full_matrices=False)
+        keep = int(np.count_nonzero(s > self.cutoff * s[0])) if s[0] > 0 else 1
+        if self.max_bond is not None:
+            keep = min(keep, self.max_bond)
+        keep = max(keep, 1)
+        total = np.sum(s**2)
+        if total > 0:
+            self.truncation_error += float(np.sum(s[keep:] ** 2) / total)
+        self.tensors[i] = u[:, :keep].reshape(dl, d, keep)
+        self.tensors[i + 1] = (s[:keep, None] * vh[:keep]).reshape(keep, d, dr)
+        self.center = i + 1
+
+
+def unitary_superoperator(matrix):
+    """
+    Return the superoperator ``rho -> U rho U^dagger`` in the site order of a
+    matrix product density operator, ``(row, column)`` per wire.
+    """
+    k = int(np.log2(matrix.shape[0]))
+    if k == 1:
+        return np.kron(matrix, matrix.conj())
+    u = matrix.reshape(2, 2, 2, 2)
+    return np.einsum("abcd,efgh->aebfcgdh", u, u.conj()).reshape(16, 16)
+
+
+def depolarizing_superoperator(p, eps=0.0):
+    """
+    Return the superoperator of the two-qubit depolarizing channel.
+
+    It is ``(1 - 16 p / 15) rho + 4 (p / 15 + eps) (I (x) Tr rho)``, the closed
+    form of ``density.MixedState.apply_depolarizing``.
+    """
+    trace = np.zeros(16)
+    trace[[0, 3, 12, 15]] = 1.0
+    return (1 - 16 * p / 15) * np.eye(16) + 4 * (p / 15 + eps) * np.outer(trace, trace)
+
+
+@instrumented("mps_simulation")
+def simulate_mps(gates_schedule, n_wires=DEFAULT_WIRES, temperature=None, max_bond=64, cutoff=1e-12, eps=0.0):
+    """
+    Simulate a gates schedule with a matrix product state.
+
+    Without temperatures the noiseless circuit is simulated on a pure state.
+    With them every MS gate is followed by its depolarizing channel (see
+    ``fidelity.ms_error_probability``) on a matrix product density operator.
+
+    Args:
+        gates_schedule (list): A list of gates where each gate is represented as a tuple.
+        n_wires (int): The number of wires.
+        temperature (np.ndarray): The temperature of each ion at each step, or
+            None for a noiseless run.
+        max_bond (int): The largest bond dimension, unlimited if None.
+        cutoff (float): The relative singular value cutoff.
+        eps (float): The regularisation added to the Kraus weights.
+
+    Returns:
+        MatrixProductState: The final state.
+    """
+    from fidelity import ms_error_probability
+
+    noisy = temperature is not None
+    state = MatrixProductState(n_wires, 4 if noisy else 2, max_bond, cutoff)
+    for i, step in enumerate(gates_schedule):
+        for gate in step:
+            if gate[0] not in GATE_MATRICES:
+                continue
+            matrix = GATE_MATRICES[gate[0]](gate[1])
+            if noisy:
+                matrix = unitary_superoperator(matrix)
+            if gate[0] == "MS":
+                if noisy:
+                    prob = ms_error_probability(gate, temperature[i])
+                    matrix = depolarizing_superoperator(prob, eps) @ matrix
+                state.apply_two(matrix, gate[2])
+            else:
+                state.apply_one(matrix, gate[2])
+    return state
+
+
+def qft_fidelity(state) -> float:
+    """
+    Fidelity of a matrix product state with QFT applied to |0...0>.
+
+    The reference is the uniform superposition, a product state, so the
+    fidelity is a single contraction: ``|<+...+|psi>|^2`` for a pure state and
+    ``<+...+|rho|+...+>`` for a density operator.
+    """
+    if state.local_dim == 2:
+        plus = np.full(2, 2**-0.5)
+        return abs(state.overlap_product([plus] * state.n_sites)) ** 2
+    return state.overlap_product([np.full(4, 0.5)] * state.n_sites).real
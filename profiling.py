@@ -0,0 +1,190 @@
+"""
+Opt-in instrumentation of the verification and scoring hot paths.
+
+Nothing is recorded unless a ``profile`` block is active:
+
+    with profiling.profile(memory=True, cprofile_path="run.prof") as profiler:
+        fidelity(positions_history, gates_schedule, graph)
+    profiler.to_json("run.json")
+
+Instrumented functions (``instrumented``) and blocks (``phase``) then add their
+wall time, call count and, with ``memory``, the peak memory they allocated on
+top of what was live when they started (from ``tracemalloc``) to the phase
+table. The native engine records every gate it applies the same way in the
+gate table, under its gate type (``gate_phase``), or ``fused`` and
+``depolarizing`` for the blocks and channels of its fused path. The
+``cprofile_path`` dump is a ``pstats`` file, which ``snakeviz``, ``flameprof``
+or ``gprof2dot`` turn into flame graphs. Outside a profile block an
+instrumented call costs one global lookup.
+"""
+
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager
+from functools import wraps
+
+_active = None
+
+
+def active():
+    """Return the profiler of the innermost ``profile`` block, or None."""
+    return _active
+
+
+class Profiler:
+    """
+    Wall time, call counts and peak memory per phase and per gate type.
+
+    Args:
+        memory (bool): Track the peak memory of every phase and gate with
+            ``tracemalloc``, which slows down allocations.
+    """
+
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.phases = {}
+        self.gates = {}
+        self._open = []  # peak memory seen by each open phase, innermost last
+
+    def _enter(self):
+        if not self.memory:
+            return 0
+        current, peak = tracemalloc.get_traced_memory()
+        self._spread(peak)
+        tracemalloc.reset_peak()
+        self._open.append(current)
+        return current
+
+    def _exit(self, start):
+        if not self.memory:
+            return None
+        peak = max(self._open.pop(), tracemalloc.get_traced_memory()[1])
+        self._spread(peak)
+        return peak - start
+
+    def _spread(self, peak):
+        # reset_peak() forgets the peak of the enclosing phases, so it is kept
+        # on their entries of the stack.
+        self._open = [max(seen, peak) for seen in self._open]
+
+    def add_phase(self, name, seconds, peak_bytes=None, calls=1):
+        """Add calls of a phase to the table."""
+        _add(self.phases, name, seconds, peak_bytes, calls)
+
+    def add_gate(self, name, seconds, peak_bytes=None, calls=1):
+        """Add applications of a gate type to the table."""
+        _add(self.gates, name, seconds, peak_bytes, calls)
+
+    def merge(self, stats) -> None:
+        """Add the ``stats`` of another profiler, e.g. from a worker process."""
+        for name, entry in stats["phases"].items():
+            self.add_phase(name, entry["seconds"], entry["peak_bytes"], entry["calls"])
+        for name, entry in stats["gates"].items():
+            self.add_gate(name, entry["seconds"], entry["peak_bytes"], entry["calls"])
+
+    def stats(self) -> dict:
+        """
+        Return the recorded data.
+
+        Returns:
+            dict: ``phases`` and ``gates``, each mapping a name to its ``calls``,
+            total ``seconds`` and ``peak_bytes`` (None without memory
+            tracking), sorted by time; and whether ``memory`` was tracked.
+        """
+
+        def by_time(table):
+            return {name: dict(entry) for name, entry in sorted(table.items(), key=lambda e: -e[1]["seconds"])}
+
+        return {"phases": by_time(self.phases), "gates": by_time(self.gates), "memory": self.memory}
+
+    def to_json(self, path) -> None:
+        """Write ``stats()`` to a JSON file."""
+        with open(path, "w") as file:
+            json.dump(self.stats(), file, indent=2)
+
+
+def _add(table, name, seconds, peak_bytes, calls):
+    entry = table.setdefault(name, {"calls": 0, "seconds": 0.0, "peak_bytes": None})
+    entry["calls"] += calls
+    entry["seconds"] += seconds
+    if peak_bytes is not None:
+        entry["peak_bytes"] = max(entry["peak_bytes"] or 0, peak_bytes)
+
+
+@contextmanager
+def _record(name, add):
+    profiler = _active
+    if profiler is None:
+        yield
+        return
+    start = profiler._enter()
+    begin = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - begin
+        add(profiler, name, seconds, profiler._exit(start))
+
+
+def phase(name):
+    """Record the enclosed block as a call of phase ``name`` when profiling."""
+    return _record(name, Profiler.add_phase)
+
+
+def gate_phase(name):
+    """Record the enclosed block as an application of gate type ``name`` when profiling."""
+    return _record(name, Profiler.add_gate)
+
+
+def instrumented(name):
+    """Decorate a function so that its calls are recorded as phase ``name``."""
+
+    def decorate(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if _active is None:
+                return function(*args, **kwargs)
+            with phase(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+@contextmanager
+def profile(memory=False, cprofile_path=None):
+    """
+    Record the instrumented phases run inside the block.
+
+    Args:
+        memory (bool): Track the peak memory per phase, see ``Profiler``.
+        cprofile_path (str): Also run ``cProfile`` and dump its ``pstats`` here.
+
+    Yields:
+        Profiler: The profiler collecting the data.
+    """
+    global _active
+    previous = _active
+    profiler = Profiler(memory)
+    started = memory and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    profiler_c = None
+    if cprofile_path:
+        import cProfile
+
+        profiler_c = cProfile.Profile()
+    _active = profiler
+    if profiler_c is not None:
+        profiler_c.enable()
+    try:
+        yield profiler
+    finally:
+        if profiler_c is not None:
+            profiler_c.disable()
+            profiler_c.dump_stats(cprofile_path)
+        _active = previous
+        if started:
+            tracemalloc.stop()
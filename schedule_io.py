@@ -0,0 +1,236 @@
+import hashlib
+import json
+
+import numpy as np
+
+from structural import GATE_NAMES, encode_gates, graph_tables
+
+MAGIC = b"QSCHED1\n"
+ALIGNMENT = 64
+
+# Column dtypes of the on-disk format.
+POSITION_DTYPE = np.int16
+GATE_COLUMNS = {
+    "step": np.int32,
+    "opcode": np.int8,
+    "angle": np.float64,
+    "wire0": np.int16,
+    "wire1": np.int16,
+}
+
+
+def layout_fingerprint(graph) -> str:
+    """
+    Return a hash of the trap graph identifying its node ids.
+
+    Two graphs with the same fingerprint number their nodes the same way, so
+    node-id matrices can be exchanged between them.
+
+    Args:
+        graph (nx.Graph): The graph representing the Penning trap, e.g. from
+            ``trap.create_trap_graph``.
+
+    Returns:
+        str: The hex digest.
+    """
+    nodes, index, node_type, _, _ = graph_tables(graph)
+    edges = sorted(tuple(sorted((index[u], index[v]))) for u, v in graph.edges())
+    payload = repr((list(nodes), node_type.tolist(), edges)).encode()
+    return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+
+def encode_schedule(positions_history, gates_schedule, graph) -> dict:
+    """
+    Convert a schedule in the list format to columns.
+
+    Args:
+        positions_history (list): A list of positions for each step in the circuit.
+        gates_schedule (list): A list of gates where each gate is represented as a tuple.
+        graph (nx.Graph): The graph representing the Penning trap.
+
+    Returns:
+        dict: ``positions``, the int16 ``(T, N)`` node-id matrix, the gate
+        columns ``step``, ``opcode`` (index into ``GATE_NAMES``), ``angle``,
+        ``wire0`` and ``wire1`` (-1 for single-qubit gates) in schedule order,
+        and ``n_steps``, the length of the gates schedule.
+
+    Raises:
+        ValueError: If a position is not a node of the graph or a gate fails the
+            checks of ``structural.encode_gates`` (name, parameter, wires and
+            their count), with the verifier's message.
+    """
+    nodes, index, _, _, _ = graph_tables(graph)
+    if len(nodes) > np.iinfo(POSITION_DTYPE).max:
+        raise ValueError(f"The trap has {len(nodes)} nodes, too many for {POSITION_DTYPE.__name__} ids.")
+    try:
+        positions = np.array(
+            [[index[p] for p in positions] for positions in positions_history],
+            dtype=POSITION_DTYPE,
+        )
+    except KeyError as error:
+        raise ValueError(f"Unknown node in the positions history: {error.args[0]}") from None
+    if positions.ndim != 2:
+        positions = np.zeros((0, 0), dtype=POSITION_DTYPE)
+
+    # The wires are checked against the ion count, or what the columns can hold.
+    n_wires = positions.shape[1] if positions.size else np.iinfo(GATE_COLUMNS["wire0"]).max + 1
+    columns, first_error = encode_gates(gates_schedule, n_wires)
+    if first_error is not None:
+        raise ValueError(first_error[2])
+    encoded = {name: columns[name].astype(dtype) for name, dtype in GATE_COLUMNS.items()}
+    encoded["positions"] = positions
+    encoded["n_steps"] = len(gates_schedule)
+    return encoded
+
+
+def decode_schedule(columns, graph) -> tuple:
+    """
+    Convert columns from ``encode_schedule`` back to the list format.
+
+    Node ids become node keys such as ``(r, c, "idle")``, angles Python floats
+    and wires an int or a pair.
+
+    Returns:
+        tuple: ``(positions_history, gates_schedule)``.
+    """
+    nodes, _, _, _, _ = graph_tables(graph)
+    positions_history = [tuple(nodes[k] for k in row) for row in np.asarray(columns["positions"]).tolist()]
+    gates_schedule = [[] for _ in range(int(columns["n_steps"]))]
+    rows = zip(
+        np.asarray(columns["step"]).tolist(),
+        np.asarray(columns["opcode"]).tolist(),
+        np.asarray(columns["angle"]).tolist(),
+        np.asarray(columns["wire0"]).tolist(),
+        np.asarray(columns["wire1"]).tolist(),
+    )
+    for step, opcode, angle, wire0, wire1 in rows:
+        wires = wire0 if wire1 < 0 else (wire0, wire1)
+        gates_schedule[step].append((GATE_NAMES[opcode], angle, wires))
+    return positions_history, gates_schedule
+
+
+def write_schedules(path, candidates, graph) -> None:
+    """
+    Write many schedules to one binary file.
+
+    The file starts with ``MAGIC``, the length of a JSON header and the header
+    itself, which holds the layout fingerprint and the dtype, shape and offset
+    of every array. The arrays follow, each aligned to ``ALIGNMENT`` bytes: the
+    position matrices stacked along the step axis, the gate columns
+    concatenated, and ``position_offsets``, ``gate_offsets`` and ``n_steps``
+    to find each candidate.
+
+    Args:
+        path (str): The file to write.
+        candidates (list): ``(positions_history, gates_schedule)`` pairs.
+        graph (nx.Graph): The graph representing the Penning trap.
+    """
+    encoded = [encode_schedule(positions, schedule, graph) for positions, schedule in candidates]
+    n_wires = {columns["positions"].shape[1] for columns in encoded if len(columns["positions"])}
+    if len(n_wires) > 1:
+        raise ValueError(f"The candidates have different ion counts: {sorted(n_wires)}")
+    n_wires = n_wires.pop() if n_wires else 0
+
+    arrays = {
+        "positions": np.concatenate(
+            [np.zeros((0, n_wires), dtype=POSITION_DTYPE)]
+            + [c["positions"] for c in encoded if len(c["positions"])]
+        ),
+        "position_offsets": np.cumsum([0] + [len(c["positions"]) for c in encoded], dtype=np.int64),
+        "gate_offsets": np.cumsum([0] + [len(c["step"]) for c in encoded], dtype=np.int64),
+        "n_steps": np.array([c["n_steps"] for c in encoded], dtype=np.int64),
+    }
+    for name, dtype in GATE_COLUMNS.items():
+        arrays[name] = np.concatenate([np.zeros(0, dtype)] + [c[name] for c in encoded])
+
+    # Offsets are relative to the data block, which starts at the first
+    # aligned byte after the header.
+    offset = 0
+    layout = {}
+    for name, array in arrays.items():
+        layout[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    header = {
+        "fingerprint": layout_fingerprint(graph),
+        "n_candidates": len(encoded),
+        "n_wires": n_wires,
+        "arrays": layout,
+    }
+    text = json.dumps(header).encode()
+    start = _data_start(len(text))
+
+    with open(path, "wb") as file:
+        file.write(MAGIC)
+        file.write(len(text).to_bytes(8, "little"))
+        file.write(text)
+        for name, array in arrays.items():
+            file.seek(start + layout[name]["offset"])
+            file.write(np.ascontiguousarray(array).tobytes())
+
+
+def _data_start(header_size):
+    return -(-(len(MAGIC) + 8 + header_size) // ALIGNMENT) * ALIGNMENT
+
+
+class ScheduleFile:
+    """
+    Memory-mapped reader of a file written by ``write_schedules``.
+
+    The arrays are mapped read-only, so opening a file with thousands of
+    candidates reads only its header; a candidate's columns are views into the
+    mapping.
+
+    Args:
+        path (str): The file to read.
+        graph (nx.Graph): The graph the schedules are decoded against; its
+            fingerprint must match the file's. None skips the check and the
+            list-format conversion is unavailable.
+    """
+
+    def __init__(self, path, graph=None):
+        with open(path, "rb") as file:
+            if file.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"Not a schedule file: {path}")
+            size = int.from_bytes(file.read(8), "little")
+            self.header = json.loads(file.read(size))
+        start = _data_start(size)
+        self.graph = graph
+        if graph is not None and layout_fingerprint(graph) != self.header["fingerprint"]:
+            raise ValueError(f"The schedules in {path} were written for a different trap layout.")
+        self.arrays = {}
+        for name, entry in self.header["arrays"].items():
+            shape = tuple(entry["shape"])
+            if np.prod(shape) == 0:
+                self.arrays[name] = np.zeros(shape, dtype=entry["dtype"])
+            else:
+                self.arrays[name] = np.memmap(
+                    path, dtype=entry["dtype"], mode="r", offset=start + entry["offset"], shape=shape
+                )
+
+    def __len__(self) -> int:
+        return self.header["n_candidates"]
+
+    def positions(self, k) -> np.ndarray:
+        """Return the ``(T, N)`` node-id matrix of candidate ``k``, e.g. for ``fidelity.get_temperatures``."""
+        offsets = self.arrays["position_offsets"]
+        return self.arrays["positions"][offsets[k] : offsets[k + 1]]
+
+    def columns(self, k) -> dict:
+        """Return the columns of candidate ``k`` in the ``encode_schedule`` format."""
+        if not 0 <= k < len(self):
+            raise IndexError(f"Candidate {k} out of range [0, {len(self)}).")
+        offsets = self.arrays["gate_offsets"]
+        columns = {name: self.arrays[name][offsets[k] : offsets[k + 1]] for name in GATE_COLUMNS}
+        columns["positions"] = self.positions(k)
+        columns["n_steps"] = int(self.arrays["n_steps"][k])
+        return columns
+
+    def __getitem__(self, k) -> tuple:
+        """Return candidate ``k`` as ``(positions_history, gates_schedule)``."""
+        if self.graph is None:
+            raise ValueError("A graph is needed to decode the node ids.")
+        return decode_schedule(self.columns(k), self.graph)
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self[k]
@@ -0,0 +1,383 @@
+"""
+Score many schedules in worker processes.
+
+    python -m score SCHEDULES [--workers N] [--backend native] [--wires 8] [--output results.jsonl]
+                              [--profile stats.json] [--cprofile run.prof] [--verbose]
+
+``SCHEDULES`` is a schedule file written by ``schedule_io.write_schedules``
+(``.qs``), a pickle (``.pkl``) of one ``(positions_history, gates_schedule)``
+pair or a list of them, or a directory of such files. Every candidate goes
+through the structural verification, the noiseless QFT check and the noisy
+fidelity (only the first with ``--backend structural``); one JSON line per
+candidate is written as soon as it is scored. Only the ``pennylane`` backend
+imports PennyLane.
+Every candidate must have ``--wires`` ions. Results are cached on disk under a
+hash of the schedule, the trap layout, the backend, the wire count, the noise
+model and ``ENGINE_VERSION``, so unchanged candidates are never simulated
+twice. ``--profile`` writes the ``profiling`` phase and gate tables of all
+scored candidates, summed over the workers.
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import pickle
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import lru_cache
+
+import numpy as np
+
+import profiling
+import schedule_io
+import trap
+
+logger = logging.getLogger(__name__)
+
+# Bump when the verification or the simulators change so that cached results
+# are recomputed; the noise model is part of the keys (see ``noise_model``).
+ENGINE_VERSION = "1"
+
+BACKENDS = ("native", "pennylane", "mps", "trajectory", "structural")
+
+# Errors a malformed candidate raises in encoding, verification or simulation.
+# They are reported as invalid results and cached; anything else (e.g.
+# MemoryError or OSError) is reported but not cached.
+CANDIDATE_ERRORS = (ValueError, TypeError, KeyError, IndexError)
+
+_worker = {}
+
+
+def load_candidates(path):
+    """
+    Yield the candidates of a schedule file or directory.
+
+    Yields:
+        tuple: ``(source, index, columns, candidate, error)``; ``columns`` are
+        the ``schedule_io`` columns and ``candidate`` is the list format for
+        pickle inputs or None for schedule files, whose candidates are read by
+        the workers from the memory-mapped file. A pickled candidate that
+        cannot be encoded has None ``columns`` and is verified from its list
+        format; ``error`` is the message for a pickled entry that is not a
+        ``(positions_history, gates_schedule)`` pair, None otherwise.
+    """
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            if name.endswith((".qs", ".pkl")):
+                yield from load_candidates(os.path.join(path, name))
+        return
+    if path.endswith(".pkl"):
+        graph = _graph()
+        with open(path, "rb") as file:
+            data = pickle.load(file)
+        pairs = [data] if _is_pair(data) else list(data)
+        for k, candidate in enumerate(pairs):
+            if not isinstance(candidate, (tuple, list)) or len(candidate) != 2:
+                yield path, k, None, candidate, "Not a (positions_history, gates_schedule) pair."
+                continue
+            try:
+                columns = schedule_io.encode_schedule(*candidate, graph)
+            except CANDIDATE_ERRORS:
+                # The verifier reports what is wrong, as for any other input.
+                columns = None
+            yield path, k, columns, candidate, None
+        return
+    schedules = schedule_io.ScheduleFile(path, _graph())
+    for k in range(len(schedules)):
+        yield path, k, schedules.columns(k), None, None
+
+
+def _is_pair(data):
+    return (
+        isinstance(data, tuple)
+        and len(data) == 2
+        and all(isinstance(part, list) for part in data)
+        and (not data[0] or isinstance(data[0][0], tuple))
+    )
+
+
+@lru_cache(maxsize=None)
+def noise_model() -> str:
+    """Describe the noise model of ``fidelity`` for the cache keys."""
+    from fidelity import DWELL_HEAT, IDLE_HEAT, MOVE_HEAT, MS_NOISE, eps
+
+    return f"ms-depolarizing:{MS_NOISE!r},eps={eps!r};heat:move={MOVE_HEAT!r},dwell={DWELL_HEAT!r},idle={IDLE_HEAT!r}"
+
+
+def _setup(backend, fingerprint, n_wires):
+    return repr((ENGINE_VERSION, noise_model(), backend, fingerprint, n_wires)).encode()
+
+
+def cache_key(columns, backend, fingerprint, n_wires=trap.DEFAULT_WIRES) -> str:
+    """Return the content hash of a candidate's columns and the scoring setup."""
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(_setup(backend, fingerprint, n_wires))
+    for name in ("positions", *schedule_io.GATE_COLUMNS):
+        array = np.ascontiguousarray(columns[name])
+        digest.update(repr((name, array.dtype.str, array.shape)).encode())
+        digest.update(array.tobytes())
+    digest.update(str(columns["n_steps"]).encode())
+    return digest.hexdigest()
+
+
+def raw_cache_key(candidate, backend, fingerprint, n_wires=trap.DEFAULT_WIRES) -> str:
+    """Return the hash of a pickled candidate that ``cache_key`` cannot encode."""
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(_setup(backend, fingerprint, n_wires) + b"raw")
+    digest.update(pickle.dumps(candidate, protocol=4))
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Scoring results on disk, one JSON file per key.
+
+    Args:
+        directory (str): The cache directory, created when needed.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".json")
+
+    def get(self, key):
+        """Return the cached result for ``key``, or None."""
+        try:
+            with open(self._path(key)) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key, result):
+        """Store a result; the file is written aside and renamed into place."""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "w") as file:
+            json.dump(result, file)
+        os.replace(temporary, path)
+
+
+def _graph():
+    if "graph" not in _worker:
+        _worker["graph"] = trap.create_trap_graph()
+    return _worker["graph"]
+
+
+def _init_worker(backend, n_wires):
+    # Build the trap and, for PennyLane, the device once per process.
+    _graph()
+    _worker["schedules"] = {}
+    if backend == "pennylane":
+        from verifier import get_mixed_device
+
+        get_mixed_device(n_wires)
+
+
+def _invalid(error):
+    return {"valid": False, "error": error, "implements_qft": None, "fidelity": None, "max_ms_temperature": None}
+
+
+def score_candidate(positions_history, gates_schedule, graph, backend="native", n_wires=trap.DEFAULT_WIRES) -> dict:
+    """
+    Verify and score one candidate without printing.
+
+    Returns:
+        dict: ``valid`` and the first structural ``error`` (None if valid),
+        ``implements_qft``, the noisy ``fidelity`` and, from
+        ``fidelity.temperature_summary``, ``max_ms_temperature``; the later
+        entries are None once a check fails. The ``structural`` backend stops
+        after the structural check and imports nothing but ``structural``.
+    """
+    from structural import verify_structure
+
+    result = _invalid(None)
+    try:
+        verify_structure(positions_history, gates_schedule, graph, n_wires=n_wires)
+    except ValueError as error:
+        result["error"] = str(error)
+        return result
+    result["valid"] = True
+    if backend == "structural":
+        return result
+
+    from density import pure_state_fidelity, qft_reference_state
+    from fidelity import (
+        compiled_circuit_noisy,
+        get_temperatures,
+        simulate_noisy_native,
+        temperature_summary,
+    )
+    from verifier import implements_qft
+
+    result["implements_qft"] = bool(implements_qft(gates_schedule, n_wires))
+    if not result["implements_qft"]:
+        return result
+
+    temperature = get_temperatures(positions_history, graph)
+    if backend == "native":
+        rho = simulate_noisy_native(gates_schedule, temperature, n_wires)
+        value = pure_state_fidelity(qft_reference_state(n_wires), rho)
+    elif backend == "pennylane":
+        qnode = compiled_circuit_noisy(gates_schedule, temperature, n_wires)
+        with profiling.phase("pennylane_simulation"):
+            rho = np.asarray(qnode())
+        value = pure_state_fidelity(qft_reference_state(n_wires), rho)
+    elif backend == "mps":
+        from mps import qft_fidelity, simulate_mps
+
+        value = qft_fidelity(simulate_mps(gates_schedule, n_wires, temperature))
+    elif backend == "trajectory":
+        from trajectory import trajectory_fidelity
+
+        value = trajectory_fidelity(gates_schedule, temperature, n_wires, max_workers=1)["fidelity"]
+    else:
+        raise ValueError(f"Unknown backend: {backend}")
+    result["fidelity"] = float(value)
+    result["max_ms_temperature"] = temperature_summary(gates_schedule, temperature)["max_ms_temperature"]
+    return result
+
+
+def _score_task(task):
+    # Returns (result, cacheable, profiler stats or None).
+    source, index, candidate, backend, n_wires, memory = task
+    if memory is not None:
+        with profiling.profile(memory) as profiler:
+            result, cacheable, _ = _score_task((source, index, candidate, backend, n_wires, None))
+        return result, cacheable, profiler.stats()
+    graph = _graph()
+    try:
+        if candidate is None:
+            schedules = _worker.setdefault("schedules", {})
+            if source not in schedules:
+                schedules[source] = schedule_io.ScheduleFile(source, graph)
+            candidate = schedules[source][index]
+        positions_history, gates_schedule = candidate
+        return score_candidate(positions_history, gates_schedule, graph, backend, n_wires), True, None
+    except CANDIDATE_ERRORS as error:  # Report broken candidates instead of stopping the run.
+        return _invalid(f"{type(error).__name__}: {error}"), True, None
+    except Exception as error:  # Failures of this run, e.g. MemoryError, are not cached.
+        logger.warning("Scoring candidate %d of %s failed: %r", index, source, error)
+        return _invalid(f"{type(error).__name__}: {error}"), False, None
+
+
+def score_path(
+    path, backend="native", workers=None, cache_dir=".score_cache", chunksize=4, profiler=None, n_wires=trap.DEFAULT_WIRES
+):
+    """
+    Score all candidates under ``path``, yielding one result dict per candidate.
+
+    Cached candidates are answered without simulation; the others are scored
+    in ``workers`` processes (all cores if None, in this process if 1) and
+    added to the cache. Results come in input order. A candidate that cannot
+    be read or fails verification is reported as invalid with its ``error``
+    instead of stopping the run.
+
+    Args:
+        path (str): A schedule file, pickle or directory, see ``load_candidates``.
+        backend (str): The noisy simulator, one of ``BACKENDS``; ``structural``
+            runs the structural check only.
+        workers (int): The number of processes.
+        cache_dir (str): The cache directory, None to disable the cache.
+        chunksize (int): The number of candidates sent to a worker at once.
+        profiler (profiling.Profiler): Profile the scored candidates in the
+            workers and merge their stats into this profiler.
+        n_wires (int): The number of ions every candidate must have.
+
+    Yields:
+        dict: ``source``, ``index``, ``key``, ``cached`` and the
+        ``score_candidate`` entries.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend: {backend}")
+    fingerprint = schedule_io.layout_fingerprint(_graph())
+    cache = ResultCache(cache_dir) if cache_dir else None
+
+    entries = []
+    for source, index, columns, candidate, error in load_candidates(path):
+        if columns is not None or candidate is None:
+            key = cache_key(columns, backend, fingerprint, n_wires)
+        else:
+            key = raw_cache_key(candidate, backend, fingerprint, n_wires)
+        hit = cache.get(key) if cache else None
+        entries.append((source, index, key, candidate, hit, error))
+    memory = None if profiler is None else profiler.memory
+    tasks = [
+        (source, index, candidate, backend, n_wires, memory)
+        for source, index, _, candidate, hit, error in entries
+        if hit is None and error is None
+    ]
+    logger.info("%d candidates, %d cached", len(entries), sum(entry[4] is not None for entry in entries))
+
+    if workers == 1:
+        _init_worker(backend, n_wires)
+        scored = map(_score_task, tasks)
+        pool = None
+    else:
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(backend, n_wires))
+        scored = pool.map(_score_task, tasks, chunksize=chunksize)
+    try:
+        for source, index, key, _, hit, error in entries:
+            if hit is None and error is not None:
+                result = _invalid(error)
+                if cache:
+                    cache.put(key, result)
+            elif hit is None:
+                result, cacheable, stats = next(scored)
+                if profiler is not None:
+                    profiler.merge(stats)
+                if cache and cacheable:
+                    cache.put(key, result)
+            else:
+                result = hit
+            yield {"source": source, "index": index, "key": key, "cached": hit is not None, **result}
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m score", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("path", help="schedule file (.qs), pickle (.pkl) or directory")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument("--backend", choices=BACKENDS, default="native")
+    parser.add_argument("--wires", type=int, default=trap.DEFAULT_WIRES, help="ions per candidate")
+    parser.add_argument("--cache", default=".score_cache", help="result cache directory")
+    parser.add_argument("--no-cache", action="store_true", help="do not read or write the cache")
+    parser.add_argument("--output", default=None, help="JSONL file (default: stdout)")
+    parser.add_argument("--profile", default=None, help="JSON file for the phase and gate timings")
+    parser.add_argument("--profile-memory", action="store_true", help="also track the peak memory per phase and gate type")
+    parser.add_argument("--cprofile", default=None, help="pstats dump of this process (use --workers 1)")
+    parser.add_argument("--verbose", action="store_true", help="log progress to stderr")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format="%(name)s: %(message)s")
+
+    profiler = profiling.Profiler(args.profile_memory) if args.profile else None
+    output = open(args.output, "w") if args.output else sys.stdout
+    try:
+        with profiling.profile(cprofile_path=args.cprofile) if args.cprofile else nullcontext():
+            results = score_path(
+                args.path,
+                args.backend,
+                args.workers,
+                None if args.no_cache else args.cache,
+                profiler=profiler,
+                n_wires=args.wires,
+            )
+            for result in results:
+                output.write(json.dumps(result) + "\n")
+                output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    if profiler is not None:
+        profiler.to_json(args.profile)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+import numpy as np
+
+from density import ms_matrix, rx_matrix, ry_matrix
+from trap import DEFAULT_WIRES
+
+GATE_MATRICES = {"RX": rx_matrix, "RY": ry_matrix, "MS": ms_matrix}
+
+
+def apply_gate(state, matrix, wires):
+    """
+    Apply a gate to a state vector stored as a ``(2,) * n`` tensor.
+
+    Axis ``w`` of the tensor is wire ``w``, so that flattening gives the state in
+    the PennyLane wire order.
+
+    Args:
+        state (np.ndarray): The state tensor.
+        matrix (np.ndarray): The ``(2**k, 2**k)`` gate matrix.
+        wires (int or tuple): The ``k`` wires the gate acts on.
+
+    Returns:
+        np.ndarray: The new state tensor.
+    """
+    wires = (wires,) if isinstance(wires, (int, np.integer)) else tuple(wires)
+    k = len(wires)
+    gate = np.asarray(matrix, dtype=complex).reshape((2,) * (2 * k))
+    moved = np.tensordot(gate, state, axes=(list(range(k, 2 * k)), list(wires)))
+    return np.moveaxis(moved, list(range(k)), list(wires))
+
+
+def simulate_statevector(gates_schedule, n_wires=DEFAULT_WIRES, max_width=None) -> np.ndarray:
+    """
+    Simulate the noiseless circuit of a gates schedule on a state vector.
+
+    The memory grows as ``2**n_wires`` instead of the ``4**n_wires`` of a
+    density matrix. Unknown gates are skipped, as in ``verifier.compiled_circuit``.
+
+    Args:
+        gates_schedule (list): A list of gates where each gate is represented as a tuple.
+        n_wires (int): The number of wires.
+        max_width (int): Fuse the gates into blocks of up to this many wires
+            (see ``fusion.fuse``); None applies every gate on its own.
+
+    Returns:
+        np.ndarray: The state vector of length ``2**n_wires``.
+    """
+    state = np.zeros((2,) * n_wires, dtype=complex)
+    state[(0,) * n_wires] = 1.0
+    if max_width is not None:
+        from fusion import fuse
+
+        for _, matrix, wires in fuse(gates_schedule, max_width=max_width)[0]:
+            state = apply_gate(state, matrix, wires)
+        return state.reshape(-1)
+    for step in gates_schedule:
+        for gate in step:
+            if gate[0] in GATE_MATRICES:
+                state = apply_gate(state, GATE_MATRICES[gate[0]](gate[1]), gate[2])
+    return state.reshape(-1)
@@ -0,0 +1,419 @@
+import numpy as np
+
+from profiling import instrumented
+from trap import DEFAULT_WIRES, IDLE, INTERACTION, NODE_TYPES, layout_of
+
+GATE_NAMES = ["RX", "RY", "MS"]
+GATE_ARITY = {"RX": 1, "RY": 1, "MS": 2}
+
+
+def graph_tables(graph):
+    """
+    Build the array lookup tables of the trap graph used by the structural checks.
+
+    Graphs made by ``trap.create_trap_graph`` reuse the tables of their cached
+    ``trap.TrapLayout``; other graphs are tabulated on every call.
+
+    Args:
+        graph (networkx.Graph): The graph representing the Penning trap.
+
+    Returns:
+        tuple: ``(nodes, index, node_type, idle_partner, adjacency)`` where
+        ``nodes`` is the list of graph nodes, ``index`` maps a node to its integer
+        id, ``node_type`` holds the type code of every node, ``idle_partner`` holds
+        the id of the idle node above a standard node (-1 if there is none) and
+        ``adjacency`` is the boolean adjacency matrix.
+    """
+    layout = layout_of(graph)
+    if layout is not None:
+        return (
+            layout.nodes,
+            layout.index,
+            layout.node_type,
+            layout.idle_partner,
+            layout.adjacency,
+        )
+    nodes = list(graph.nodes())
+    index = {node: k for k, node in enumerate(nodes)}
+    node_type = np.array(
+        [NODE_TYPES[graph.nodes[node]["type"]] for node in nodes], dtype=np.int8
+    )
+    idle_partner = np.full(len(nodes), -1, dtype=np.int64)
+    for k, node in enumerate(nodes):
+        if node[-1] != "idle":
+            idle_partner[k] = index.get((*node[:2], "idle"), -1)
+    adjacency = np.zeros((len(nodes), len(nodes)), dtype=bool)
+    for u, v in graph.edges():
+        adjacency[index[u], index[v]] = True
+        adjacency[index[v], index[u]] = True
+    return nodes, index, node_type, idle_partner, adjacency
+
+
+def encode_positions(positions_history, index):
+    """
+    Encode the positions history as an integer ``(T, N)`` array of node ids.
+
+    Args:
+        positions_history (list): A list of positions for each step in the circuit.
+        index (dict): Mapping from graph node to integer node id.
+
+    Returns:
+        np.ndarray: The node id of every ion at every step, -1 for unknown nodes.
+    """
+    if len(positions_history) == 0:
+        return np.zeros((0, 0), dtype=np.int64)
+    return np.array(
+        [[index.get(p, -1) for p in positions] for positions in positions_history],
+        dtype=np.int64,
+    )
+
+
+def encode_gates(gates_schedule, n_wires=DEFAULT_WIRES):
+    """
+    Check the gate semantics and encode the gates schedule as parallel columns.
+
+    Gates failing the semantic checks are not encoded; the first of them is
+    returned as ``(step, gate index, message)`` instead of being raised so that
+    errors of earlier steps can take precedence.
+
+    Args:
+        gates_schedule (list): A list of gates where each gate is represented as a tuple.
+        n_wires (int): The number of ions.
+
+    Returns:
+        tuple: ``(columns, first_error)`` where ``columns`` is a dict of arrays
+        ``step``, ``order``, ``opcode``, ``angle``, ``wire0`` and ``wire1``
+        (``wire1`` is -1 for single-qubit gates).
+    """
+    step, order, opcode, angle, wire0, wire1 = [], [], [], [], [], []
+    first_error = None
+    for i, gate in enumerate(gates_schedule):
+        for k, g in enumerate(gate):
+            message = _gate_semantics_error(i, g, n_wires)
+            if message is not None:
+                if first_error is None:
+                    first_error = (i, k, message)
+                continue
+            name, param, wires = g
+            if isinstance(wires, int):
+                wires = (wires,)
+            if len(wires) != GATE_ARITY[name]:
+                if first_error is None:
+                    first_error = (
+                        i,
+                        k,
+                        f"Error: {name} gate at step {i} does not act on {GATE_ARITY[name]} wire(s). Found: {wires}",
+                    )
+                continue
+            step.append(i)
+            order.append(k)
+            opcode.append(GATE_NAMES.index(name))
+            angle.append(param)
+            wire0.append(wires[0])
+            wire1.append(wires[1] if name == "MS" else -1)
+    columns = {
+        "step": np.array(step, dtype=np.int64),
+        "order": np.array(order, dtype=np.int64),
+        "opcode": np.array(opcode, dtype=np.int8),
+        "angle": np.array(angle, dtype=float),
+        "wire0": np.array(wire0, dtype=np.int64),
+        "wire1": np.array(wire1, dtype=np.int64),
+    }
+    return columns, first_error
+
+
+def _gate_semantics_error(i, g, n_wires):
+    name, param, wires = g
+    if name not in GATE_NAMES:
+        return f"Error: Gate name at step {i} is not RX, RY, or MS. Found: {name}"
+    if not isinstance(name, str):
+        return f"Error: Gate name at step {i} is not a string. Found: {type(name)}"
+    if not isinstance(param, (float, int)):
+        return f"Error: Gate parameter at step {i} is not a float or int. Found: {type(param)}"
+    if not isinstance(wires, (int, list, tuple)) or (
+        isinstance(wires, (list, tuple)) and not all(isinstance(w, int) for w in wires)
+    ):
+        return f"Error: Gate wires at step {i} are not an int or a list/tuple of ints. Found: {type(wires)}"
+    if isinstance(wires, int):
+        if not (0 <= wires < n_wires):
+            return f"Error: Gate wire at step {i} is out of range [0, {n_wires}). Found: {wires}"
+    elif not all(0 <= w < n_wires for w in wires):
+        return f"Error: One or more gate wires at step {i} are out of range [0, {n_wires}). Found: {wires}"
+    return None
+
+
+def _first(mask):
+    """Return the indices of the first True entry of ``mask`` in row-major order."""
+    flat = np.flatnonzero(mask)
+    if flat.size == 0:
+        return None
+    return np.unravel_index(flat[0], mask.shape)
+
+
+@instrumented("verify_structure")
+def verify_structure(positions_history, gates_schedule, graph, n_wires=DEFAULT_WIRES) -> None:
+    """
+    Verify the positions history and gates schedule against the trap rules.
+
+    All rules are evaluated as array operations over the whole history. When the
+    schedule breaks several rules, the error raised is the one a step-by-step
+    check would meet first.
+
+    Args:
+        positions_history (list): A list of positions for each step in the circuit.
+        gates_schedule (list): A list of gates where each gate is represented as a tuple.
+        graph (networkx.Graph): The graph representing the Penning trap.
+        n_wires (int): The number of ions.
+
+    Raises:
+        ValueError: If a rule is violated.
+    """
+    if len(positions_history) != len(gates_schedule):
+        raise ValueError(
+            f"Length of positions history ({len(positions_history)}) does not match length of gates schedule ({len(gates_schedule)})."
+        )
+    n_steps = len(positions_history)
+    if n_steps == 0:
+        return
+
+    nodes, index, node_type, idle_partner, adjacency = graph_tables(graph)
+
+    # Every error is collected as (step, rule rank, message); a step-by-step check
+    # meets them in the lexicographic order of the first two entries.
+    errors = []
+
+    # Steps are checked in order, so only the steps before the first malformed one
+    # are encoded and checked as a rectangular array.
+    counts = np.array([len(positions) for positions in positions_history])
+    bad_count = np.flatnonzero(counts != n_wires)
+    limit = bad_count[0] if bad_count.size else n_steps
+    if bad_count.size:
+        errors.append((limit, 0, f"Invalid number of ions at step {limit}: {counts[limit]}"))
+    if limit == 0:
+        raise ValueError(errors[0][2])
+    pos = encode_positions(positions_history[:limit], index)
+    where = _first(pos < 0)
+    if where is not None:
+        i, j = where
+        limit = i
+        pos = pos[:limit]
+        errors.append(
+            (
+                i,
+                1,
+                f"Invalid position: {positions_history[i][j]} at step {i} for ion {j} is not part of the graph.",
+            )
+        )
+    if limit == 0:
+        raise ValueError(min(errors, key=lambda e: e[:2])[2])
+
+    errors += _move_errors(pos, nodes, adjacency, n_wires)
+    columns, gate_error = encode_gates(gates_schedule[:limit], n_wires)
+    errors += _gate_errors(
+        pos, columns, gate_error, positions_history, nodes, node_type, limit
+    )
+    errors += _duplicate_wire_errors(columns, gates_schedule, limit, n_wires)
+    errors += _overlap_errors(pos, columns, nodes, node_type, idle_partner, n_wires)
+
+    if errors:
+        raise ValueError(min(errors, key=lambda e: e[:2])[2])
+
+
+def _move_errors(pos, nodes, adjacency, n_wires):
+    errors = []
+    prev, curr = pos[:-1], pos[1:]
+    where = _first((prev != curr) & ~adjacency[prev, curr])
+    if where is not None:
+        i, j = where
+        errors.append(
+            (
+                i + 1,
+                2,
+                f"Error: Invalid move for ion {j} from {nodes[prev[i, j]]} to {nodes[curr[i, j]]} at step {i + 1}. Nodes are not adjacent in the graph.",
+            )
+        )
+
+    # Ions a < b swapped if a moved onto b's previous node and b onto a's.
+    swapped = (
+        (prev[:, :, None] == curr[:, None, :])
+        & (prev[:, None, :] == curr[:, :, None])
+        & (prev[:, :, None] != prev[:, None, :])
+        & np.triu(np.ones((n_wires, n_wires), dtype=bool), k=1)
+    )
+    where = _first(swapped)
+    if where is not None:
+        i, a, b = where
+        errors.append(
+            (
+                i + 1,
+                3,
+                f"Error: Ions {a} and {b} swapped positions ({nodes[prev[i, a]]} <-> {nodes[prev[i, b]]}) at step {i + 1}.",
+            )
+        )
+    return errors
+
+
+def _gate_errors(pos, columns, gate_error, positions_history, nodes, node_type, limit):
+    # Gates are checked one after the other, so errors are keyed by
+    # (step, gate index, rule rank) before being reported at their step.
+    gate_errors = []
+    if gate_error is not None:
+        i, k, message = gate_error
+        gate_errors.append((i, k, 0, message))
+
+    step, order = columns["step"], columns["order"]
+    w0, w1 = columns["wire0"], columns["wire1"]
+    is_ms = columns["opcode"] == GATE_NAMES.index("MS")
+    p0 = pos[step, w0]
+
+    ms = np.flatnonzero(is_ms)
+    ms_step, a, b = step[ms], w0[ms], w1[ms]
+    pa, pb = p0[ms], pos[ms_step, b]
+    apart = pa != pb
+    off_zone = ~apart & (node_type[pa] != INTERACTION)
+
+    # An MS gate lasts two steps, so both ions must hold still into the next step.
+    next_step = np.minimum(ms_step + 1, limit - 1)
+    held = (ms_step + 1 < limit) & (pos[next_step, a] == pa) & (pos[next_step, b] == pb)
+    for g in np.flatnonzero(ms_step + 1 == limit):
+        # The next step was not encoded; compare it as given.
+        i = ms_step[g]
+        try:
+            held[g] = (
+                positions_history[i][a[g]] == positions_history[i + 1][a[g]]
+                and positions_history[i][b[g]] == positions_history[i + 1][b[g]]
+            )
+        except IndexError:
+            held[g] = False
+    moved = ~apart & ~off_zone & ~held
+
+    for g in np.flatnonzero(apart)[:1]:
+        gate_errors.append(
+            (
+                ms_step[g],
+                order[ms[g]],
+                1,
+                f"Error: Ions {a[g]} and {b[g]} are not at the same position {nodes[pa[g]]} at step {ms_step[g]}.",
+            )
+        )
+    for g in np.flatnonzero(off_zone)[:1]:
+        gate_errors.append(
+            (
+                ms_step[g],
+                order[ms[g]],
+                1,
+                f"Error: MS gate at step {ms_step[g]} is not at an interaction node. Position: {nodes[pa[g]]}",
+            )
+        )
+    for g in np.flatnonzero(moved)[:1]:
+        gate_errors.append(
+            (
+                ms_step[g],
+                order[ms[g]],
+                1,
+                f"Error: Ions {a[g]} or {b[g]} moved during MS gate at step {ms_step[g] + 1}.",
+            )
+        )
+
+    for code, label in ((INTERACTION, "interaction"), (IDLE, "rest")):
+        for g in np.flatnonzero(~is_ms & (node_type[p0] == code))[:1]:
+            gate_errors.append(
+                (
+                    step[g],
+                    order[g],
+                    1,
+                    f"Error: RX/RY gate at step {step[g]} is on {label} node. Position: {nodes[p0[g]]}",
+                )
+            )
+
+    if not gate_errors:
+        return []
+    i, _, _, message = min(gate_errors, key=lambda e: e[:3])
+    return [(i, 4, message)]
+
+
+def _duplicate_wire_errors(columns, gates_schedule, limit, n_wires):
+    is_ms = columns["opcode"] == GATE_NAMES.index("MS")
+    usage = np.zeros((limit, n_wires), dtype=np.int64)
+    np.add.at(
+        usage,
+        (
+            np.concatenate([columns["step"], columns["step"][is_ms]]),
+            np.concatenate([columns["wire0"], columns["wire1"][is_ms]]),
+        ),
+        1,
+    )
+    for i in np.flatnonzero((usage > 1).any(axis=1))[:1]:
+        flattened_wires = []
+        for g in gates_schedule[i]:
+            wire = g[2]
+            if isinstance(wire, (list, tuple)):
+                flattened_wires.extend(wire)
+            else:
+                flattened_wires.append(wire)
+        return [
+            (i, 5, f"Error: Duplicate wires in gate at step {i}. Wires: {flattened_wires}")
+        ]
+    return []
+
+
+def _overlap_errors(pos, columns, nodes, node_type, idle_partner, n_wires):
+    errors = []
+    n_steps = len(pos)
+    steps = np.arange(n_steps)[:, None]
+    occupancy = np.zeros((n_steps, len(nodes)), dtype=np.int64)
+    np.add.at(occupancy, (np.repeat(steps[:, 0], n_wires), pos.ravel()), 1)
+    ion_count = occupancy[steps, pos]
+
+    # A standard node and the idle node above it may not both be occupied.
+    partner = idle_partner[pos]
+    partner_count = np.where(partner >= 0, occupancy[steps, np.maximum(partner, 0)], 0)
+    where = _first(partner_count == 1)
+    if where is not None:
+        i, j = where
+        errors.append(
+            (
+                i,
+                6,
+                f"Error: Overlapping ions at {nodes[pos[i, j]]} with its corresponding idle position at step {i}.",
+            )
+        )
+
+    # A shared node is judged once, on the ion with the lowest index there.
+    same = pos[:, :, None] == pos[:, None, :]
+    first_ion = ~np.tril(same, k=-1).any(axis=2)
+    shared = (ion_count > 1) & first_ion
+    if not shared.any():
+        return errors
+
+    # For nodes shared by two ions, the pair must start an MS gate at this step or
+    # at the previous one, but not at both.
+    other = np.argmax(same & ~np.eye(n_wires, dtype=bool), axis=2)
+    ion = np.arange(n_wires)[None, :]
+    pair = np.minimum(ion, other) * n_wires + np.maximum(ion, other)
+    is_ms = columns["opcode"] == GATE_NAMES.index("MS")
+    a, b = columns["wire0"][is_ms], columns["wire1"][is_ms]
+    ms_keys = columns["step"][is_ms] * n_wires**2 + np.minimum(a, b) * n_wires + np.maximum(a, b)
+    ms_during = np.isin(steps * n_wires**2 + pair, ms_keys)
+    ms_before = (steps > 0) & np.isin((steps - 1) * n_wires**2 + pair, ms_keys)
+
+    non_interaction = shared & (node_type[pos] != INTERACTION)
+    crowded = shared & ~non_interaction & (ion_count > 2)
+    paired = shared & ~non_interaction & ~crowded
+    verdict = np.select(
+        [non_interaction, crowded, paired & ~ms_during & ~ms_before, paired & ms_during & ms_before],
+        [1, 2, 3, 4],
+        default=0,
+    )
+    where = _first(verdict > 0)
+    if where is not None:
+        i, j = where
+        overlap = nodes[pos[i, j]]
+        message = {
+            1: f"Error: Overlapping ions at non-interaction node {overlap} at step {i}.",
+            2: f"Error: More than two ions overlapping at interaction node {overlap} at step {i}.",
+            3: f"Error: Overlapping ions at {overlap} at step {i} without an MS gate before, or during the overlap.",
+            4: f"Error: Overlapping ions at {overlap} at step {i} and step {i - 1} have conflicting MS gate. Only one MS gate should be present.",
+        }[verdict[i, j]]
+        errors.append((i, 7, message))
+    return errors
@@ -0,0 +1,227 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from statistics import NormalDist
+
+import numpy as np
+
+from profiling import instrumented
+from statevector import GATE_MATRICES, apply_gate, simulate_statevector
+
+_PAULI = [
+    np.eye(2, dtype=complex),
+    np.array([[0, 1], [1, 0]], dtype=complex),
+    np.array([[0, -1j], [1j, 0]], dtype=complex),
+    np.array([[1, 0], [0, -1]], dtype=complex),
+]
+# The 15 non-trivial two-qubit Paulis, in the order of DepolarizingChannel.
+PAULIS = [np.kron(a, b) for a in _PAULI for b in _PAULI][1:]
+
+
+def noisy_operations(gates_schedule, temperature, eps=0.0):
+    """
+    Flatten a schedule into gates with the Kraus weights of their channels.
+
+    Args:
+        gates_schedule (list): A list of gates where each gate is represented as a tuple.
+        temperature (np.ndarray): The temperature of each ion at each step.
+        eps (float): The regularisation added to the Kraus weights.
+
+    Returns:
+        tuple: The gates ``(name, angle, wires)`` in order and, for every gate,
+        the weight of the identity Kraus operator and of each of the 15 Pauli
+        ones (both 0 for gates without noise).
+    """
+    from fidelity import ms_error_probability
+
+    operations, identity, pauli = [], [], []
+    for i, step in enumerate(gates_schedule):
+        for gate in step:
+            if gate[0] not in GATE_MATRICES:
+                continue
+            operations.append(gate)
+            if gate[0] == "MS":
+                p = ms_error_probability(gate, temperature[i])
+                identity.append(1 - p + eps)
+                pauli.append(p / 15 + eps)
+            else:
+                identity.append(0.0)
+                pauli.append(0.0)
+    return operations, np.array(identity), np.array(pauli)
+
+
+def _error_probabilities(identity, pauli):
+    # Probability of a Pauli error after every noisy gate, the noisy gate
+    # indices and the total Kraus weight of all channels.
+    noisy = np.flatnonzero(identity + pauli > 0)
+    total = identity[noisy] + 15 * pauli[noisy]
+    return 15 * pauli[noisy] / total, noisy, float(np.prod(total))
+
+
+def _overlap(state):
+    # |<QFT|0>|psi>|^2 for the uniform superposition, from the amplitude sum.
+    return abs(state.sum()) ** 2 / state.size
+
+
+def _trajectory_chunk(operations, identity, pauli, n_wires, seeds, importance, cache_bytes):
+    """
+    Run the trajectories of some seeds in a worker.
+
+    Each trajectory draws a Pauli error (or none) after every noisy gate and
+    simulates the pure state. With ``importance`` the trajectories are drawn
+    conditioned on at least one error: the first error is drawn from its exact
+    distribution and the later ones independently. The ideal state before
+    every noisy gate is then cached (up to ``cache_bytes``) so a trajectory
+    starts at its first error.
+
+    Returns:
+        list: The fidelity of every trajectory.
+    """
+    matrices = [GATE_MATRICES[name](angle) for name, angle, _ in operations]
+    error, noisy, _ = _error_probabilities(identity, pauli)
+    # Probability that the first error happens at each noisy gate.
+    survive = np.concatenate([[1.0], np.cumprod(1 - error)[:-1]])
+    first = error * survive
+    first = first / first.sum() if first.sum() > 0 else first
+
+    cache = {}
+    state_bytes = 16 * 2**n_wires
+    if importance and len(noisy) * state_bytes <= cache_bytes:
+        state = np.zeros((2,) * n_wires, dtype=complex)
+        state[(0,) * n_wires] = 1.0
+        targets = set(noisy.tolist())
+        for k, (gate, matrix) in enumerate(zip(operations, matrices)):
+            state = apply_gate(state, matrix, gate[2])
+            if k in targets:
+                cache[k] = state
+
+    samples = []
+    for seed in seeds:
+        rng = np.random.default_rng(seed)
+        errors = np.flatnonzero(rng.random(len(noisy)) < error)
+        if importance:
+            start = rng.choice(len(noisy), p=first)
+            errors = np.concatenate([[start], errors[errors > start]])
+        paulis = dict(zip(noisy[errors].tolist(), rng.integers(15, size=len(errors)).tolist()))
+
+        begin = 0
+        state = np.zeros((2,) * n_wires, dtype=complex)
+        state[(0,) * n_wires] = 1.0
+        if importance and cache:
+            begin = int(noisy[errors[0]])
+            state = cache[begin]
+            state = apply_gate(state, PAULIS[paulis[begin]], operations[begin][2])
+            begin += 1
+        for k in range(begin, len(operations)):
+            state = apply_gate(state, matrices[k], operations[k][2])
+            if k in paulis:
+                state = apply_gate(state, PAULIS[paulis[k]], operations[k][2])
+        samples.append(_overlap(state))
+    return samples
+
+
+@instrumented("trajectory_simulation")
+def trajectory_fidelity(
+    gates_schedule,
+    temperature,
+    n_wires=None,
+    trajectories=1000,
+    batch_size=100,
+    target_halfwidth=None,
+    confidence=0.95,
+    importance=True,
+    seed=0,
+    max_workers=None,
+    eps=0.0,
+    cache_bytes=64 * 2**20,
+) -> dict:
+    """
+    Monte-Carlo estimate of the noisy fidelity from pure-state trajectories.
+
+    The depolarizing channel after every MS gate is a Pauli channel, so the
+    noisy state is the average of pure states with random two-qubit Paulis
+    inserted after the MS gates; a trajectory needs ``2**n_wires`` memory
+    instead of ``4**n_wires``. With ``importance`` the error-free trajectory,
+    which dominates at low error probabilities, is computed exactly and only
+    the trajectories with at least one error are sampled:
+    ``F = P0 F0 + (1 - P0) E[F | error]``.
+
+    Trajectories run in rounds of ``batch_size``, spread over a process pool,
+    each with its own seed from ``np.random.SeedSequence(seed)``. The run stops
+    after ``trajectories`` trajectories or once the confidence interval is at
+    most ``target_halfwidth`` wide on each side.
+
+    Args:
+        gates_schedule (list): A list of gates where each gate is represented as a tuple.
+        temperature (np.ndarray): The temperature of each ion at each step.
+        n_wires (int): The number of wires, the number of ions if None.
+        trajectories (int): The largest number of trajectories.
+        batch_size (int): The number of trajectories per round.
+        target_halfwidth (float): The half-width of the confidence interval at
+            which to stop, None to run all trajectories.
+        confidence (float): The confidence level of the interval.
+        importance (bool): Compute the error-free trajectory exactly.
+        seed (int): The root seed.
+        max_workers (int): The number of processes, all cores if None; 1 runs
+            in this process.
+        eps (float): The regularisation added to the Kraus weights.
+        cache_bytes (int): The memory for cached ideal states per worker.
+
+    Returns:
+        dict: The ``fidelity`` estimate, its ``stderr``, the confidence
+        ``interval``, the number of ``trajectories`` run, the
+        ``no_error_probability`` and whether the target was ``converged``.
+    """
+    temperature = np.asarray(temperature)
+    n_wires = temperature.shape[1] if n_wires is None else n_wires
+    operations, identity, pauli = noisy_operations(gates_schedule, temperature, eps)
+    error, _, weight = _error_probabilities(identity, pauli)
+    no_error = float(np.prod(1 - error))
+    ideal = _overlap(simulate_statevector(gates_schedule, n_wires)) if importance else 0.0
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+
+    def result(samples, converged):
+        n = len(samples)
+        factor = 1 - no_error if importance else 1.0
+        mean = float(np.mean(samples)) if n else 0.0
+        spread = float(np.std(samples, ddof=1) / np.sqrt(n)) if n > 1 else 0.0
+        estimate = float(weight * (no_error * ideal + factor * mean) if importance else weight * mean)
+        stderr = float(weight * factor * spread)
+        return {
+            "fidelity": estimate,
+            "stderr": stderr,
+            "interval": (estimate - z * stderr, estimate + z * stderr),
+            "trajectories": n,
+            "no_error_probability": no_error,
+            "converged": converged,
+        }
+
+    if importance and no_error >= 1.0:
+        return result([], True)
+
+    seeds = np.random.SeedSequence(seed).spawn(trajectories)
+    samples = []
+    pool = ProcessPoolExecutor(max_workers=max_workers) if max_workers != 1 else None
+    n_workers = 1 if pool is None else max_workers or os.cpu_count() or 1
+    try:
+        for start in range(0, trajectories, batch_size):
+            batch = seeds[start : start + batch_size]
+            chunks = [batch[k::n_workers] for k in range(n_workers) if batch[k::n_workers]]
+            args = (operations, identity, pauli, n_wires)
+            if pool is None:
+                parts = [_trajectory_chunk(*args, chunk, importance, cache_bytes) for chunk in chunks]
+            else:
+                futures = [
+                    pool.submit(_trajectory_chunk, *args, chunk, importance, cache_bytes)
+                    for chunk in chunks
+                ]
+                parts = [future.result() for future in futures]
+            for part in parts:
+                samples += part
+            if target_halfwidth is not None and len(samples) > 1:
+                current = result(samples, False)
+                if z * current["stderr"] <= target_halfwidth:
+                    return result(samples, True)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return result(samples, target_halfwidth is None)
@@ -1,41 +1,206 @@
-import networkx as nx
+from functools import lru_cache
 
+import numpy as np
 
-def create_trap_graph() -> nx.Graph:
+from profiling import instrumented
+
+INTERACTION_NODES = ((1, 1), (1, 3), (3, 1), (3, 3), (1, 5), (3, 5))
+
+# The number of ions, and so of qubits, wherever none is given.
+DEFAULT_WIRES = 8
+
+# Integer codes for the node types of the trap graph.
+INTERACTION = 0
+STANDARD = 1
+IDLE = 2
+
+NODE_TYPES = {"interaction": INTERACTION, "standard": STANDARD, "idle": IDLE}
+TYPE_NAMES = {code: name for name, code in NODE_TYPES.items()}
+
+
+class TrapLayout:
+    """Array representation of a Penning trap.
+
+    Nodes get integer ids in the order ``create_trap_graph`` adds them to the
+    graph, so node ids of a layout and ``list(graph.nodes())`` of its graph agree.
+    All tables are computed once when the layout is built:
+
+    - ``nodes`` and ``index``: node keys by id and ids by node key,
+    - ``node_type``: the type code of every node,
+    - ``partner``: the idle node above a standard node and the standard node
+      below an idle node (-1 for interaction nodes); ``idle_partner`` only
+      keeps the former,
+    - ``indptr`` and ``indices``: the adjacency in CSR form, ``adjacency``: the
+      dense boolean adjacency matrix,
+    - ``distance``: the all-pairs shortest-path distances in moves.
+
+    Use ``get_trap_layout`` to share layouts between callers.
+
+    Args:
+        rows (int): The number of rows of the grid.
+        cols (int): The number of columns of the grid.
+        interaction_nodes (tuple): The ``(row, col)`` grid sites that are
+            interaction nodes.
+    """
+
+    def __init__(self, rows=5, cols=7, interaction_nodes=INTERACTION_NODES):
+        self.rows = rows
+        self.cols = cols
+        self.interaction_nodes = tuple(interaction_nodes)
+
+        nodes, types, edges = [], [], []
+        for r in range(rows):
+            for c in range(cols):
+                base_node_id = (r, c)
+                if base_node_id in self.interaction_nodes:
+                    nodes.append(base_node_id)
+                    types.append(INTERACTION)
+                else:
+                    nodes.append(base_node_id)
+                    types.append(STANDARD)
+                    rest_node_id = (r, c, "idle")
+                    nodes.append(rest_node_id)
+                    types.append(IDLE)
+                    edges.append((base_node_id, rest_node_id))
+        for r in range(rows):
+            for c in range(cols):
+                if c + 1 < cols:
+                    edges.append(((r, c), (r, c + 1)))
+                if r + 1 < rows:
+                    edges.append(((r, c), (r + 1, c)))
+
+        self.nodes = nodes
+        self.index = {node: k for k, node in enumerate(nodes)}
+        self.edges = edges
+        self.node_type = np.array(types, dtype=np.int8)
+        self.node_type.setflags(write=False)
+
+        n_nodes = len(nodes)
+        edge_ids = np.array([[self.index[u], self.index[v]] for u, v in edges])
+        self.adjacency = np.zeros((n_nodes, n_nodes), dtype=bool)
+        self.adjacency[edge_ids[:, 0], edge_ids[:, 1]] = True
+        self.adjacency[edge_ids[:, 1], edge_ids[:, 0]] = True
+        self.indptr = np.zeros(n_nodes + 1, dtype=np.int32)
+        self.indptr[1:] = np.cumsum(self.adjacency.sum(axis=1))
+        self.indices = np.nonzero(self.adjacency)[1].astype(np.int32)
+
+        self.partner = np.full(n_nodes, -1, dtype=np.int64)
+        for k, node in enumerate(nodes):
+            if types[k] == STANDARD:
+                idle = self.index[(*node, "idle")]
+                self.partner[k] = idle
+                self.partner[idle] = k
+        self.idle_partner = np.where(self.node_type == STANDARD, self.partner, -1)
+        self.distance = _all_pairs_distance(self.indptr, self.indices)
+
+        for table in (
+            self.adjacency,
+            self.indptr,
+            self.indices,
+            self.partner,
+            self.idle_partner,
+            self.distance,
+        ):
+            table.setflags(write=False)
+
+    @property
+    def n_nodes(self) -> int:
+        return len(self.nodes)
+
+    def neighbors(self, node_id) -> np.ndarray:
+        """Return the ids of the nodes adjacent to ``node_id``."""
+        return self.indices[self.indptr[node_id] : self.indptr[node_id + 1]]
+
+    def encode(self, positions_history) -> np.ndarray:
+        """Encode a positions history as an integer ``(T, N)`` array of node ids."""
+        if len(positions_history) == 0:
+            return np.zeros((0, 0), dtype=np.int64)
+        return np.array(
+            [[self.index[p] for p in positions] for positions in positions_history],
+            dtype=np.int64,
+        )
+
+    def decode(self, ids) -> list:
+        """Convert an integer ``(T, N)`` array of node ids to a positions history."""
+        return [tuple(self.nodes[k] for k in row) for row in np.asarray(ids)]
+
+    def to_networkx(self) -> "nx.Graph":
+        """Build the NetworkX graph of the trap, as ``create_trap_graph`` returns it.
+
+        The graph keeps a reference to this layout in ``graph.graph["layout"]`` so
+        that array-based code can use the precomputed tables. NetworkX is
+        imported here, so the array code runs without it.
+        """
+        import networkx as nx
+
+        trap = nx.Graph(layout=self)
+        for node, code in zip(self.nodes, self.node_type):
+            trap.add_node(node, type=TYPE_NAMES[code])
+        trap.add_edges_from(self.edges)
+        return trap
+
+
+def _all_pairs_distance(indptr, indices) -> np.ndarray:
+    # Breadth-first search from all nodes at once over the CSR adjacency. The
+    # frontier holds (source, node) pairs, so a level costs the degrees of its
+    # nodes and the whole search O(n * E).
+    n_nodes = len(indptr) - 1
+    degree = np.diff(indptr)
+    distance = np.full((n_nodes, n_nodes), -1, dtype=np.int32)
+    source = node = np.arange(n_nodes, dtype=np.int64)
+    distance[source, node] = 0
+    step = 0
+    while len(node):
+        step += 1
+        counts = degree[node]
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        source = np.repeat(source, counts)
+        node = indices[np.repeat(indptr[node], counts) + offsets].astype(np.int64)
+        new = distance[source, node] < 0
+        source, node = source[new], node[new]
+        # Keep one copy of every pair reached twice: the last write of its
+        # (negative) claim number wins.
+        claim = -2 - np.arange(len(node), dtype=np.int32)
+        distance[source, node] = claim
+        kept = distance[source, node] == claim
+        source, node = source[kept], node[kept]
+        distance[source, node] = step
+    return distance
+
+
+@lru_cache(maxsize=None)
+def get_trap_layout(rows=5, cols=7, interaction_nodes=INTERACTION_NODES) -> TrapLayout:
+    """Return the shared ``TrapLayout`` for the given parameters."""
+    return TrapLayout(rows, cols, tuple(interaction_nodes))
+
+
+def layout_of(graph):
+    """Return the ``TrapLayout`` a graph was built from, or None.
+
+    Graphs that were modified after being built (different node or edge count)
+    are not trusted to match their layout.
+    """
+    layout = graph.graph.get("layout")
+    if layout is None:
+        return None
+    if graph.number_of_nodes() != layout.n_nodes or graph.number_of_edges() != len(layout.edges):
+        return None
+    return layout
+
+
+@instrumented("trap_graph")
+def create_trap_graph(rows=5, cols=7, interaction_nodes=INTERACTION_NODES) -> "nx.Graph":
     """Create a graph representing the Penning trap.
 
     The Penning trap is represented as a grid of nodes, where each node can be
     either an interaction node or a standard node. The interaction nodes are
     connected to their corresponding idle nodes, and the standard nodes are
     connected to their neighboring standard nodes.
-    """
 
-    trap = nx.Graph()
-
-    rows = 5
-    cols = 7
-
-    interaction_nodes = [(1, 1), (1, 3), (3, 1), (3, 3), (1, 5), (3, 5)]
-
-    for r in range(rows):
-        for c in range(cols):
-            base_node_id = (r, c)
-
-            if base_node_id in interaction_nodes:
-                trap.add_node(base_node_id, type="interaction")
-            else:
-                trap.add_node(base_node_id, type="standard")
-                rest_node_id = (r, c, "idle")
-                trap.add_node(rest_node_id, type="idle")
-                trap.add_edge(base_node_id, rest_node_id)
-
-    for r in range(rows):
-        for c in range(cols):
-            node_id = (r, c)
-            if c + 1 < cols:
-                neighbor_id = (r, c + 1)
-                trap.add_edge(node_id, neighbor_id)
-            if r + 1 < rows:
-                neighbor_id = (r + 1, c)
-                trap.add_edge(node_id, neighbor_id)
-    return trap
+    Args:
+        rows (int): The number of rows of the grid.
+        cols (int): The number of columns of the grid.
+        interaction_nodes (tuple): The ``(row, col)`` grid sites that are
+            interaction nodes.
+    """
+    return get_trap_layout(rows, cols, tuple(interaction_nodes)).to_networkx()
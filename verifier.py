@@ -1,28 +1,85 @@
-import pennylane as qml
+import logging
+from functools import lru_cache
+
 import numpy as np
 
-n_wires = 8
-mixed_device = qml.device("default.mixed", wires=n_wires)
+from density import qft_reference_density_matrix, qft_reference_state
+from profiling import instrumented, phase
+from structural import GATE_ARITY, _gate_semantics_error, graph_tables
+from trap import DEFAULT_WIRES, IDLE, INTERACTION
+
+logger = logging.getLogger(__name__)
+
+
+# PennyLane is imported and its devices are created on first use, so that the
+# structural checks and the NumPy simulators start without it.
+@lru_cache(maxsize=None)
+@instrumented("mixed_device")
+def get_mixed_device(n_wires=DEFAULT_WIRES):
+    """Return the cached ``default.mixed`` device for a wire count, created on first use."""
+    import pennylane as qml
+
+    return qml.device("default.mixed", wires=n_wires)
+
+
+def __getattr__(name):
+    # ``mixed_device`` used to be created at import time and ``n_wires`` was
+    # the name of ``DEFAULT_WIRES``.
+    if name == "mixed_device":
+        return get_mixed_device()
+    if name == "n_wires":
+        return DEFAULT_WIRES
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
-@qml.qnode(device=mixed_device)
-def circuit():
-    qml.QFT(wires=range(n_wires))
-    return qml.density_matrix(wires=range(n_wires))
+@instrumented("reference_circuit")
+def circuit(n_wires=DEFAULT_WIRES):
+    """
+    Return the density matrix of QFT applied to |0...0>.
+
+    Args:
+        n_wires (int): The number of wires.
+    """
+    import pennylane as qml
 
+    @qml.qnode(device=get_mixed_device(n_wires))
+    def qft():
+        qml.QFT(wires=range(n_wires))
+        return qml.density_matrix(wires=range(n_wires))
 
-def compiled_circuit(gates_schedule) -> qml.QNode:
+    return qft()
+
+
+def compiled_circuit(gates_schedule, n_wires=DEFAULT_WIRES, max_width=None) -> "qml.QNode":
     """
     Build the compiled circuit from the gates schedule.
 
     Args:
         gates_schedule (list): A list of gates where each gate is represented as a tuple.
+        n_wires (int): The number of wires.
+        max_width (int): Fuse the gates into ``qml.QubitUnitary`` blocks of up
+            to this many wires (see ``fusion.fuse``); None applies every gate on
+            its own.
 
     Returns:
         qml.QNode: A Pennylane QNode representing the circuit.
     """
+    import pennylane as qml
+
+    if max_width is not None:
+        from fusion import fuse
 
-    @qml.qnode(device=mixed_device)
+        operations, _ = fuse(gates_schedule, max_width=max_width)
+
+        @qml.qnode(device=get_mixed_device(n_wires))
+        def fused():
+            for _, matrix, wires in operations:
+                qml.QubitUnitary(matrix, wires=wires)
+            return qml.density_matrix(wires=range(n_wires))
+
+        return fused
+
+    @qml.qnode(device=get_mixed_device(n_wires))
     def circuit():
         for step in gates_schedule:
             for gate in step:
@@ -32,207 +89,292 @@ def compiled_circuit(gates_schedule) -> qml.QNode:
                     qml.RY(gate[1], wires=gate[2])
                 elif gate[0] == "MS":
                     qml.IsingXX(gate[1], wires=gate[2])
-        return qml.density_matrix(wires=range(8))
+        return qml.density_matrix(wires=range(n_wires))
 
     return circuit
 
 
-def verifier(positions_history, gates_schedule, graph) -> None:
+@instrumented("qft_check")
+def implements_qft(gates_schedule, n_wires=DEFAULT_WIRES, backend="statevector", max_bond=64, atol=1e-5) -> bool:
+    """
+    Check that the noiseless gates schedule implements QFT on |0...0>.
+
+    Args:
+        gates_schedule (list): A list of gates where each gate is represented as a tuple.
+        n_wires (int): The number of wires.
+        backend (str): ``"statevector"`` to simulate a state vector (memory
+            ``2**n_wires``), ``"mps"`` for a matrix product state with bond
+            dimension up to ``max_bond`` or ``"pennylane"`` to compare density
+            matrices on a ``default.mixed`` device (memory ``4**n_wires``).
+        max_bond (int): The largest bond dimension of the ``"mps"`` backend.
+        atol (float): The tolerance; the state backends allow an infidelity of
+            ``atol``, the density matrix backend ``atol`` per entry.
+
+    Returns:
+        bool: Whether the circuit prepares the QFT state up to a global phase.
+    """
+    if backend == "statevector":
+        from statevector import simulate_statevector
+
+        state = simulate_statevector(gates_schedule, n_wires)
+        return 1 - abs(np.vdot(qft_reference_state(n_wires), state)) ** 2 <= atol
+    if backend == "mps":
+        from mps import qft_fidelity, simulate_mps
+
+        return 1 - qft_fidelity(simulate_mps(gates_schedule, n_wires, max_bond=max_bond)) <= atol
+    if backend == "pennylane":
+        expected_result = qft_reference_density_matrix(n_wires)
+        user_result = compiled_circuit(gates_schedule, n_wires)()
+        return np.allclose(expected_result, user_result, atol=atol)
+    raise ValueError(f"Unknown backend: {backend}")
+
+
+class StreamingVerifier:
+    """
+    Step-by-step counterpart of ``structural.verify_structure``.
+
+    ``push`` checks one step against the trap rules in O(N) with an occupancy
+    table and the MS gates left open by the previous step, raising the same
+    ``ValueError`` the full check would. An MS gate whose ions move in the next
+    step is reported when that step is pushed, so a step with several errors
+    may report a different one than the full check, which can look ahead.
+
+    The state is immutable between pushes: ``snapshot`` returns it in O(1)
+    and ``restore`` rewinds to any earlier snapshot, which makes the verifier
+    usable as a pruning oracle in backtracking searches. ``finalize`` closes
+    the schedule and checks that it implements QFT.
+
+    Args:
+        graph (networkx.Graph): The graph representing the Penning trap.
+        n_wires (int): The number of ions.
+    """
+
+    def __init__(self, graph, n_wires=DEFAULT_WIRES):
+        self.graph = graph
+        self.n_wires = n_wires
+        self.nodes, self.index, node_type, idle_partner, self.adjacency = graph_tables(graph)
+        self.node_type = node_type.tolist()
+        self.idle_partner = idle_partner.tolist()
+        self._count = [0] * len(self.nodes)
+        self.step = 0
+        self._previous = None
+        self._previous_ms = frozenset()
+        self._pending = ()
+        self._history = None
+
+    def snapshot(self) -> tuple:
+        """Return the current state for ``restore``."""
+        return (self.step, self._previous, self._previous_ms, self._pending, self._history)
+
+    def restore(self, state) -> None:
+        """Rewind to a state returned by ``snapshot``."""
+        self.step, self._previous, self._previous_ms, self._pending, self._history = state
+
+    def push(self, positions, gates) -> None:
+        """
+        Check and append one step.
+
+        Args:
+            positions (tuple): The position of every ion at this step.
+            gates (list): The gates of this step.
+
+        Raises:
+            ValueError: If the step breaks a rule; the state is left unchanged.
+        """
+        t = self.step
+        for a, b, pa, pb in self._pending:
+            try:
+                held = positions[a] == pa and positions[b] == pb
+            except IndexError:
+                held = False
+            if not held:
+                raise ValueError(f"Error: Ions {a} or {b} moved during MS gate at step {t}.")
+
+        if len(positions) != self.n_wires:
+            raise ValueError(f"Invalid number of ions at step {t}: {len(positions)}")
+        current = [self.index.get(p, -1) for p in positions]
+        for j, node in enumerate(current):
+            if node < 0:
+                raise ValueError(
+                    f"Invalid position: {positions[j]} at step {t} for ion {j} is not part of the graph."
+                )
+
+        previous = self._previous
+        if previous is not None:
+            self._check_moves(t, previous, current)
+        pending, ms_pairs = self._check_gates(t, positions, current, gates)
+        self._check_overlaps(t, current, ms_pairs)
+
+        self.step = t + 1
+        self._previous = tuple(current)
+        self._previous_ms = ms_pairs
+        self._pending = tuple(pending)
+        self._history = (gates, self._history)
+
+    def _check_moves(self, t, previous, current):
+        nodes = self.nodes
+        for j, (u, v) in enumerate(zip(previous, current)):
+            if u != v and not self.adjacency[u, v]:
+                raise ValueError(
+                    f"Error: Invalid move for ion {j} from {nodes[u]} to {nodes[v]} at step {t}. Nodes are not adjacent in the graph."
+                )
+        was_at = {}
+        for j, u in enumerate(previous):
+            was_at.setdefault(u, []).append(j)
+        swaps = [
+            (a, b)
+            for a, v in enumerate(current)
+            for b in was_at.get(v, ())
+            if a < b and current[b] == previous[a] and previous[a] != previous[b]
+        ]
+        if swaps:
+            a, b = min(swaps)
+            raise ValueError(
+                f"Error: Ions {a} and {b} swapped positions ({nodes[previous[a]]} <-> {nodes[previous[b]]}) at step {t}."
+            )
+
+    def _check_gates(self, t, positions, current, gates):
+        nodes, n = self.nodes, self.n_wires
+        pending, ms_pairs, used = [], set(), []
+        for g in gates:
+            message = _gate_semantics_error(t, g, n)
+            if message is not None:
+                raise ValueError(message)
+            name, _, wires = g
+            wires = (wires,) if isinstance(wires, int) else tuple(wires)
+            if len(wires) != GATE_ARITY[name]:
+                raise ValueError(
+                    f"Error: {name} gate at step {t} does not act on {GATE_ARITY[name]} wire(s). Found: {wires}"
+                )
+            used += wires
+            if name == "MS":
+                a, b = wires
+                pa, pb = current[a], current[b]
+                if pa != pb:
+                    raise ValueError(
+                        f"Error: Ions {a} and {b} are not at the same position {nodes[pa]} at step {t}."
+                    )
+                if self.node_type[pa] != INTERACTION:
+                    raise ValueError(
+                        f"Error: MS gate at step {t} is not at an interaction node. Position: {nodes[pa]}"
+                    )
+                pending.append((a, b, positions[a], positions[b]))
+                ms_pairs.add((min(a, b), max(a, b)))
+            else:
+                node = current[wires[0]]
+                for code, label in ((INTERACTION, "interaction"), (IDLE, "rest")):
+                    if self.node_type[node] == code:
+                        raise ValueError(
+                            f"Error: RX/RY gate at step {t} is on {label} node. Position: {nodes[node]}"
+                        )
+        if len(set(used)) != len(used):
+            flattened_wires = []
+            for g in gates:
+                wire = g[2]
+                if isinstance(wire, (list, tuple)):
+                    flattened_wires.extend(wire)
+                else:
+                    flattened_wires.append(wire)
+            raise ValueError(f"Error: Duplicate wires in gate at step {t}. Wires: {flattened_wires}")
+        return pending, frozenset(ms_pairs)
+
+    def _check_overlaps(self, t, current, ms_pairs):
+        nodes, count = self.nodes, self._count
+        for node in current:
+            count[node] += 1
+        try:
+            for node in current:
+                partner = self.idle_partner[node]
+                if partner >= 0 and count[partner] == 1:
+                    raise ValueError(
+                        f"Error: Overlapping ions at {nodes[node]} with its corresponding idle position at step {t}."
+                    )
+            first = {}
+            for j, node in enumerate(current):
+                if count[node] < 2:
+                    continue
+                if node not in first:
+                    first[node] = [j]
+                    continue
+                first[node].append(j)
+            for j, node in enumerate(current):
+                ions = first.get(node)
+                if ions is None or ions[0] != j:
+                    continue
+                if self.node_type[node] != INTERACTION:
+                    raise ValueError(f"Error: Overlapping ions at non-interaction node {nodes[node]} at step {t}.")
+                if count[node] > 2:
+                    raise ValueError(
+                        f"Error: More than two ions overlapping at interaction node {nodes[node]} at step {t}."
+                    )
+                pair = (j, ions[1])
+                during, before = pair in ms_pairs, pair in self._previous_ms
+                if not during and not before:
+                    raise ValueError(
+                        f"Error: Overlapping ions at {nodes[node]} at step {t} without an MS gate before, or during the overlap."
+                    )
+                if during and before:
+                    raise ValueError(
+                        f"Error: Overlapping ions at {nodes[node]} at step {t} and step {t - 1} have conflicting MS gate. Only one MS gate should be present."
+                    )
+        finally:
+            for node in current:
+                count[node] = 0
+
+    def check_end(self) -> None:
+        """Raise a ValueError if an MS gate of the last step has no second step."""
+        for a, b, _, _ in self._pending:
+            raise ValueError(f"Error: Ions {a} or {b} moved during MS gate at step {self.step}.")
+
+    def gates_schedule(self) -> list:
+        """Return the gates schedule pushed so far."""
+        steps, node = [], self._history
+        while node is not None:
+            steps.append(node[0])
+            node = node[1]
+        return steps[::-1]
+
+    def finalize(self, backend="statevector") -> None:
+        """
+        Close the schedule and check the full circuit.
+
+        Args:
+            backend (str): The simulator of the noiseless check, see ``implements_qft``.
+
+        Raises:
+            ValueError: If an MS gate is left open or the circuit does not
+                implement QFT.
+        """
+        self.check_end()
+        if not implements_qft(self.gates_schedule(), self.n_wires, backend):
+            raise ValueError(f"The compiled circuit does not implement QFT({self.n_wires}).")
+
+
+def verifier(positions_history, gates_schedule, graph, n_wires=DEFAULT_WIRES, backend="statevector") -> None:
     """
     Verify the positions and gates schedule of the circuit.
 
+    The schedule is pushed step by step through a ``StreamingVerifier``. The
+    progress is logged at the INFO level.
+
     Args:
         positions_history (list): A list of positions for each step in the circuit.
         gates_schedule (list): A list of gates where each gate is represented as a tuple.
         graph (networkx.Graph): The graph representing the Penning trap.
+        n_wires (int): The number of ions every step must have.
+        backend (str): The simulator of the noiseless check, see ``implements_qft``.
     """
-    # print("Verifying the positions history and gates schedule...")
-    # if len(positions_history) != len(gates_schedule):
-    #     raise ValueError(
-    #         f"Length of positions history ({len(positions_history)}) does not match length of gates schedule ({len(gates_schedule)})."
-    #     )
-    # for i, positions in enumerate(positions_history):
-    #     if len(positions) != 8:
-    #         raise ValueError(f"Invalid number of ions at step {i}: {len(positions)}")
-    #     for j, p in enumerate(positions):
-    #         if p not in graph.nodes():
-    #             raise ValueError(
-    #                 f"Invalid position: {p} at step {i} for ion {j} is not part of the graph."
-    #             )
-
-    #     if i > 0:
-    #         prev_pos_tuple = positions_history[i - 1]
-    #         curr_pos_tuple = positions
-
-    #         for ion_idx in range(len(curr_pos_tuple)):
-    #             p_prev = prev_pos_tuple[ion_idx]
-    #             p_curr = curr_pos_tuple[ion_idx]
-
-    #             if p_prev != p_curr:
-    #                 if not graph.has_edge(p_prev, p_curr):
-    #                     raise ValueError(
-    #                         f"Error: Invalid move for ion {ion_idx} from {p_prev} to {p_curr} at step {i}. Nodes are not adjacent in the graph."
-    #                     )
-
-    #         # Check for ions swapping over the same edge
-    #         num_ions = len(curr_pos_tuple)
-    #         for ion1_idx in range(num_ions):
-    #             for ion2_idx in range(
-    #                 ion1_idx + 1, num_ions
-    #             ):  # Iterate over unique pairs
-    #                 prev_pos_ion1 = prev_pos_tuple[ion1_idx]
-    #                 curr_pos_ion1 = curr_pos_tuple[ion1_idx]
-
-    #                 prev_pos_ion2 = prev_pos_tuple[ion2_idx]
-    #                 curr_pos_ion2 = curr_pos_tuple[ion2_idx]
-
-    #                 # Check if ion1 moved to ion2's previous spot AND ion2 moved to ion1's previous spot
-    #                 if (
-    #                     prev_pos_ion1 == curr_pos_ion2
-    #                     and prev_pos_ion2 == curr_pos_ion1
-    #                 ):
-    #                     # Ensure they were at different positions before swapping.
-    #                     if prev_pos_ion1 != prev_pos_ion2:
-    #                         raise ValueError(
-    #                             f"Error: Ions {ion1_idx} and {ion2_idx} swapped positions ({prev_pos_ion1} <-> {prev_pos_ion2}) at step {i}."
-    #                         )
-
-    #     gate = gates_schedule[i]
-
-    #     for g in gate:
-    #         # Check gate semantics
-    #         name, param, wires = g
-    #         if name not in ["RX", "RY", "MS"]:
-    #             raise ValueError(
-    #                 f"Error: Gate name at step {i} is not RX, RY, or MS. Found: {name}"
-    #             )
-    #         if not isinstance(name, str):
-    #             raise ValueError(
-    #                 f"Error: Gate name at step {i} is not a string. Found: {type(name)}"
-    #             )
-    #         if not isinstance(param, (float, int)):
-    #             raise ValueError(
-    #                 f"Error: Gate parameter at step {i} is not a float or int. Found: {type(param)}"
-    #             )
-    #         if not isinstance(wires, (int, list, tuple)) or (
-    #             isinstance(wires, (list, tuple))
-    #             and not all(isinstance(w, int) for w in wires)
-    #         ):
-    #             raise ValueError(
-    #                 f"Error: Gate wires at step {i} are not an int or a list/tuple of ints. Found: {type(wires)}"
-    #             )
-
-    #         if isinstance(wires, int):
-    #             if not (0 <= wires < 8):
-    #                 raise ValueError(
-    #                     f"Error: Gate wire at step {i} is out of range [0, 8). Found: {wires}"
-    #                 )
-    #         elif isinstance(wires, (list, tuple)):
-    #             if not all(0 <= w < 8 for w in wires):
-    #                 raise ValueError(
-    #                     f"Error: One or more gate wires at step {i} are out of range [0, 8). Found: {wires}"
-    #                 )
-    #         if g[0] == "MS":
-    #             ion_0 = g[2][0]
-    #             ion_1 = g[2][1]
-
-    #             pos_0 = positions[ion_0]
-    #             pos_1 = positions[ion_1]
-    #             if pos_0 != pos_1:
-    #                 raise ValueError(
-    #                     f"Error: Ions {ion_0} and {ion_1} are not at the same position {pos_0} at step {i}."
-    #                 )
-    #             if graph.nodes[pos_0]["type"] != "interaction":
-    #                 raise ValueError(
-    #                     f"Error: MS gate at step {i} is not at an interaction node. Position: {pos_0}"
-    #                 )
-    #             pos_next = positions_history[i + 1]
-    #             if not (
-    #                 positions[ion_0] == pos_next[ion_0]
-    #                 and positions[ion_1] == pos_next[ion_1]
-    #             ):
-    #                 raise ValueError(
-    #                     f"Error: Ions {ion_0} or {ion_1} moved during MS gate at step {i + 1}."
-    #                 )
-    #         elif g[0] == "RX" or g[0] == "RY":
-    #             ion = g[2]
-    #             pos_ion = positions[ion]
-    #             if graph.nodes[pos_ion]["type"] == "interaction":
-    #                 raise ValueError(
-    #                     f"Error: RX/RY gate at step {i} is on interaction node. Position: {pos_ion}"
-    #                 )
-    #             if graph.nodes[pos_ion]["type"] == "idle":
-    #                 raise ValueError(
-    #                     f"Error: RX/RY gate at step {i} is on rest node. Position: {pos_ion}"
-    #                 )
-    #     # Check wires
-    #     wires = [g[2] for g in gate]
-
-    #     flattened_wires = []
-    #     for wire in wires:
-    #         if isinstance(wire, (list, tuple)):
-    #             flattened_wires.extend(wire)
-    #         else:
-    #             flattened_wires.append(wire)
-    #     if len(set(flattened_wires)) != len(flattened_wires):
-    #         raise ValueError(
-    #             f"Error: Duplicate wires in gate at step {i}. Wires: {flattened_wires}"
-    #         )
-
-    #     # Check for overlapping ions
-    #     positions_set = set(positions)
-    #     for p in positions_set:
-    #         if p[-1] != "idle":
-    #             corresponding_idle = (*p[:2], "idle")
-    #             if positions.count(corresponding_idle) == 1:
-    #                 raise ValueError(
-    #                     f"Error: Overlapping ions at {p} with its corresponding idle position at step {i}."
-    #                 )
-
-    #     if len(positions_set) < len(positions):
-    #         overlapping_positions = [p for p in positions if positions.count(p) > 1]
-
-    #         for overlap in overlapping_positions:
-    #             if graph.nodes[overlap]["type"] != "interaction":
-    #                 raise ValueError(
-    #                     f"Error: Overlapping ions at non-interaction node {overlap} at step {i}."
-    #                 )
-    #             if positions.count(overlap) > 2:
-    #                 raise ValueError(
-    #                     f"Error: More than two ions overlapping at interaction node {overlap} at step {i}."
-    #                 )
-    #             overlapping_ions = [
-    #                 idx for idx, p in enumerate(positions) if p == overlap
-    #             ]
-    #             has_ms_gate_b = False
-    #             has_ms_gate_d = False
-
-    #             has_ms_gate = False
-    #             for g in gates_schedule[i]:
-    #                 if g[0] == "MS" and set(g[2]) == set(overlapping_ions):
-    #                     has_ms_gate_d = True
-    #                     has_ms_gate = True
-    #                     break
-    #             if i > 0:
-    #                 for g in gates_schedule[i - 1]:
-    #                     if g[0] == "MS" and set(g[2]) == set(overlapping_ions):
-    #                         has_ms_gate_b = True
-    #                         has_ms_gate = True
-    #                         break
-    #             if not has_ms_gate:
-    #                 raise ValueError(
-    #                     f"Error: Overlapping ions at {overlap} at step {i} without an MS gate before, or during the overlap."
-    #                 )
-    #             if sum([has_ms_gate_b, has_ms_gate_d]) != 1:
-    #                 raise ValueError(
-    #                     f"Error: Overlapping ions at {overlap} at step {i} and step {i - 1} have conflicting MS gate. Only one MS gate should be present."
-    #                 )
-    # print("Positions and gates are valid.")
-    print("Verifying the fidelity of the circuit without adding noise...")
-    expected_result = circuit()
-    user_result = compiled_circuit(gates_schedule)()
-    # user_fidelity = qml.math.fidelity(expected_result, user_result)
-    # print("Fidelity of the circuit:", user_fidelity)
-    if not np.allclose(expected_result, user_result, atol=1e-5):
-        raise ValueError(f"The compiled circuit does not implement QFT({n_wires}).")
-    print(f"The compiled circuit implements QFT({n_wires}).")
+    logger.info("Verifying the positions history and gates schedule...")
+    if len(positions_history) != len(gates_schedule):
+        raise ValueError(
+            f"Length of positions history ({len(positions_history)}) does not match length of gates schedule ({len(gates_schedule)})."
+        )
+    stream = StreamingVerifier(graph, n_wires)
+    with phase("verify_structure"):
+        for positions, gates in zip(positions_history, gates_schedule):
+            stream.push(positions, gates)
+        stream.check_end()
+    logger.info("Positions and gates are valid.")
+    logger.info("Verifying the fidelity of the circuit without adding noise...")
+    stream.finalize(backend)
+    logger.info("The compiled circuit implements QFT(%d).", n_wires)